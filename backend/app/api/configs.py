@@ -5,7 +5,7 @@ import logging
 from typing import List, Dict, Any, Optional
 
 # 2. Importações de terceiros
-from fastapi import APIRouter, Depends, HTTPException, status, Body, BackgroundTasks, Request
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 
 # 3. Importações locais do projeto
@@ -19,6 +19,7 @@ from app.services.config_service import (
     ConfigValidationError,
     SITUATIONS
 )
+from app.services.sync_job_service import SyncJobNotFoundError, get_sync_job, cancel_sync_job
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -148,14 +149,15 @@ async def provision_google_resource(
 
 
 # Sincroniza a planilha de instruções (sistema ou RAG) com o banco de dados
-@router.post("/sync_sheet", summary="Sincronizar planilha do Google Sheets com uma Configuração")
+@router.post("/sync_sheet", status_code=status.HTTP_202_ACCEPTED, summary="Sincronizar planilha do Google Sheets com uma Configuração")
 async def sync_google_sheet(
     payload: Dict[str, Any] = Body(...),
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(dependencies.get_current_active_user)
 ):
     """
-    Sincroniza os dados da planilha Google Sheets vinculada e gera os embeddings apropriados.
+    Enfileira a sincronização da planilha Google Sheets vinculada (executada pelo worker de sincronização).
+    O andamento e o relatório ficam em GET /configs/sync_jobs/{job_id}.
     """
     try:
         config_id = int(payload.get("config_id"))
@@ -167,7 +169,7 @@ async def sync_google_sheet(
     company_id = current_user.company_id or 0
 
     try:
-        itens_processados = await ConfigService.sync_google_sheet(
+        job = await ConfigService.sync_google_sheet(
             db=db,
             company_id=company_id,
             config_id=config_id,
@@ -175,8 +177,9 @@ async def sync_google_sheet(
             sync_type=sync_type
         )
         return {
-            "message": f"Sincronização ({sync_type.upper()}) concluída com sucesso!", 
-            "sheets_found": itens_processados,
+            "message": f"Sincronização ({sync_type.upper()}) iniciada.",
+            "job_id": job.id,
+            "status": job.status,
         }
     except ConfigNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -187,14 +190,15 @@ async def sync_google_sheet(
 
 
 # Sincroniza a pasta do Google Drive indexando arquivos para o RAG
-@router.post("/sync_drive", summary="Sincronizar pasta do Google Drive")
+@router.post("/sync_drive", status_code=status.HTTP_202_ACCEPTED, summary="Sincronizar pasta do Google Drive")
 async def sync_google_drive(
     payload: Dict[str, Any] = Body(...),
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(dependencies.get_current_active_user)
 ):
     """
-    Sincroniza os arquivos contidos em uma pasta do Google Drive gerando embeddings de busca para RAG.
+    Enfileira a sincronização dos arquivos de uma pasta do Google Drive (embeddings de busca para RAG).
+    O andamento e o relatório ficam em GET /configs/sync_jobs/{job_id}.
     """
     try:
         config_id = int(payload.get("config_id"))
@@ -205,15 +209,16 @@ async def sync_google_drive(
     company_id = current_user.company_id or 0
 
     try:
-        itens_processados = await ConfigService.sync_google_drive(
+        job = await ConfigService.sync_google_drive(
             db=db,
             company_id=company_id,
             config_id=config_id,
             folder_id=folder_id
         )
         return {
-            "message": "Sincronização do Google Drive concluída com sucesso!",
-            "files_found": itens_processados,
+            "message": "Sincronização do Google Drive iniciada.",
+            "job_id": job.id,
+            "status": job.status,
         }
     except ConfigNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -223,11 +228,42 @@ async def sync_google_drive(
         raise HTTPException(status_code=500, detail=f"Falha ao processar o Drive: {str(e)}")
 
 
+# Consulta o andamento de uma sincronização enfileirada
+@router.get("/sync_jobs/{job_id}", response_model=schemas.SyncJob, summary="Consultar job de sincronização")
+async def get_sync_job_status(
+    job_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(dependencies.get_current_active_user)
+):
+    """
+    Retorna status, progresso da vetorização e, ao concluir, o relatório da sincronização.
+    """
+    try:
+        return await get_sync_job(db, job_id, current_user.company_id or 0)
+    except SyncJobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+# Cancela uma sincronização na fila ou em execução
+@router.post("/sync_jobs/{job_id}/cancel", response_model=schemas.SyncJob, summary="Cancelar job de sincronização")
+async def cancel_sync_job_endpoint(
+    job_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(dependencies.get_current_active_user)
+):
+    """
+    Jobs na fila são cancelados imediatamente; em execução, o worker interrompe a sincronização em seguida.
+    """
+    try:
+        return await cancel_sync_job(db, job_id, current_user.company_id or 0)
+    except SyncJobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
 # Recebe notificações de alteração de planilhas/pastas no Drive via webhook
 @router.post("/drive-webhook", summary="Webhook para receber notificações de alteração do Google Drive/Sheets")
 async def drive_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -250,7 +286,6 @@ async def drive_webhook(
             channel_id=channel_id,
             resource_state=resource_state,
             channel_token=channel_token,
-            background_tasks=background_tasks,
             query_params=query_params,
             body_json=body_json
         )
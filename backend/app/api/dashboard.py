@@ -2,7 +2,7 @@
 
 # 1. Importações nativas/padrão do Python
 import logging
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 # 2. Importações de terceiros
 from fastapi import APIRouter, Depends, Body, HTTPException
@@ -43,6 +43,34 @@ async def get_dashboard_data(
         raise HTTPException(status_code=500, detail="Erro interno ao processar dados do dashboard.")
 
 
+# Retorna o consumo de tokens da empresa a partir dos agregados diários (dia/modelo/tipo)
+@router.get("/token-usage", response_model=List[Dict[str, Any]], summary="Obter consumo de tokens agregado por período")
+async def get_token_usage(
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(dependencies.get_current_active_user),
+    start_date_str: str = None,
+    end_date_str: str = None,
+    group_by: str = None
+):
+    """
+    Endpoint que retorna o consumo de tokens do período, agrupado pelas dimensões
+    informadas em 'group_by' (ex: "day,model"), lido de linhas pré-agregadas.
+    """
+    try:
+        return await DashboardService.get_token_usage(
+            db=db,
+            current_user=current_user,
+            start_date_str=start_date_str,
+            end_date_str=end_date_str,
+            group_by=group_by
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Erro ao buscar consumo de tokens: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Erro interno ao processar consumo de tokens.")
+
+
 # Envia métricas e atendimentos de um período para o Gemini analisar de forma qualitativa e responder a uma pergunta do usuário
 @router.post("/analyze", summary="Analisar dados com IA")
 async def analyze_data_with_ia(
@@ -12,6 +12,7 @@ from app.api import dependencies
 from app.db import models, schemas
 from app.db.database import get_db
 from app.services.integration_service import (
+    IntegrationBusyError,
     IntegrationService,
     verify_webhook_token_secure,
     validate_url_security
@@ -61,7 +62,7 @@ async def create_integration(
     # Se for polling, valida segurança da URL
     if payload.integration_type == "polling" and payload.url:
         try:
-            validate_url_security(payload.url)
+            await validate_url_security(payload.url)
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
 
@@ -114,17 +115,11 @@ async def update_integration(
 
     if "url" in update_data and update_data["url"] and integration.integration_type == "polling":
         try:
-            validate_url_security(update_data["url"])
+            await validate_url_security(update_data["url"])
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
 
-    for key, value in update_data.items():
-        setattr(integration, key, value)
-
-    db.add(integration)
-    await db.commit()
-    await db.refresh(integration)
-    return integration
+    return await IntegrationService.update_integration(db, integration, update_data)
 
 
 @router.delete("/configs/integrations/{integration_id}", status_code=status.HTTP_204_NO_CONTENT, summary="Excluir Integração")
@@ -176,8 +171,10 @@ async def sync_integration_now(
         raise HTTPException(status_code=403, detail="Acesso negado a esta integração.")
 
     try:
-        count = await IntegrationService.run_integration_sync(db, integration)
+        count = await IntegrationService.run_manual_sync(db, integration)
         return {"message": f"Sincronização concluída com sucesso! {count} vetores atualizados.", "updated_items": count}
+    except IntegrationBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         logger.error(f"Erro na sincronização manual da integração {integration_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -228,14 +225,9 @@ async def test_integration_endpoint(
 
 # --- RECEIVER PÚBLICO DE WEBHOOK (AUTENTICADO VIA HEADER X-Webhook-Token) ---
 
-@router.post("/integrations/webhook", summary="Webhook de Entrada (Recepção de Dados em Tempo Real)")
-async def receive_integration_webhook(
-    request: Request,
-    db: AsyncSession = Depends(get_db)
-):
+async def _authenticate_webhook(request: Request, db: AsyncSession) -> models.Integration:
     """
-    Endpoint público de Webhook que recebe requisições de plataformas externas em tempo real.
-    A autenticação é feita obrigatoriamente através do Header `X-Webhook-Token` (ou `Authorization`).
+    Localiza a integração ativa a partir do Header `X-Webhook-Token` (ou `X-Api-Key` / `Authorization: Bearer`).
     """
     header_token = request.headers.get("x-webhook-token") or request.headers.get("x-api-key")
     if not header_token:
@@ -264,22 +256,59 @@ async def receive_integration_webhook(
     if not verify_webhook_token_secure(header_token, integration.webhook_token):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token de webhook inválido.")
 
+    return integration
+
+
+@router.post("/integrations/webhook", status_code=status.HTTP_202_ACCEPTED, summary="Webhook de Entrada (Recepção de Dados em Tempo Real)")
+async def receive_integration_webhook(
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Endpoint público de Webhook que recebe requisições de plataformas externas em tempo real.
+    A autenticação é feita obrigatoriamente através do Header `X-Webhook-Token` (ou `Authorization`).
+
+    O payload é apenas enfileirado: a vetorização roda no worker de integrações, que agrupa vários pushes
+    da mesma integração numa única execução. A resposta (202) traz o `job_id` para acompanhamento.
+    """
+    integration = await _authenticate_webhook(request, db)
+
     try:
         body_json = await request.json()
     except Exception:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Payload inválido. Esperado JSON.")
 
-    try:
-        processed_count = await IntegrationService.process_payload_for_integration(db, integration, body_json)
-        return {
-            "status": "success",
-            "message": f"Webhook recebido e processado com sucesso. {processed_count} vetores atualizados.",
-            "processed_count": processed_count
-        }
-    except Exception as e:
-        logger.error(f"Erro ao processar payload do Webhook (ID: {integration.id}): {e}", exc_info=True)
-        integration.last_status = "error"
-        integration.last_error = str(e)
-        db.add(integration)
-        await db.commit()
-        raise HTTPException(status_code=500, detail=f"Erro interno ao processar dados do webhook: {str(e)}")
+    job = models.IntegrationWebhookJob(id=uuid.uuid4().hex, integration_id=integration.id, payload=body_json, status="queued")
+    db.add(job)
+    await db.commit()
+
+    return {
+        "status": "queued",
+        "message": "Webhook recebido. O processamento ocorrerá em segundo plano.",
+        "job_id": job.id
+    }
+
+
+@router.get("/integrations/webhook/jobs/{job_id}", summary="Consultar processamento de um Webhook de Entrada")
+async def get_integration_webhook_job(
+    job_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Retorna o estado de um payload enfileirado pelo webhook. Autenticado pelo mesmo token da integração.
+    """
+    integration = await _authenticate_webhook(request, db)
+
+    job = await db.get(models.IntegrationWebhookJob, job_id)
+    if not job or job.integration_id != integration.id:
+        raise HTTPException(status_code=404, detail="Job não encontrado.")
+
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "processed_count": job.processed_count,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at
+    }
@@ -39,7 +39,108 @@ class Settings(BaseSettings):
     
     ADMIN_EMAIL: str
     ADMIN_PASSWORD: str
-    
+
+    # --- Rastreamento de chamadas LLM (JSONL) ---
+    LLM_TRACE_ENABLED: bool = True
+    LLM_TRACE_FILE: str = "llm_traces.jsonl" # Cada processo grava em llm_traces.<processo>.jsonl
+    LLM_TRACE_PROCESS_NAME: str = "" # Rótulo do processo no nome do arquivo (vazio = módulo executado)
+    LLM_TRACE_MAX_BYTES: int = 20 * 1024 * 1024 # 20 MB por arquivo antes de rotacionar
+    LLM_TRACE_BACKUP_COUNT: int = 5
+    LLM_TRACE_QUEUE_SIZE: int = 1000 # Registros excedentes são descartados (nunca bloqueiam o event loop)
+    LLM_TRACE_SAMPLE_RATE: float = 0.05 # Fração padrão (0.0 a 1.0) das chamadas registradas
+    LLM_TRACE_COMPANY_SAMPLE_RATES: str = "" # Sobrescritas por empresa (ex: "12:1.0,15:0")
+    LLM_TRACE_MAX_FIELD_CHARS: int = 20000 # Trunca prompts/respostas muito longos no registro
+
+    # --- Ledger de consumo de tokens ---
+    TOKEN_LEDGER_FLUSH_INTERVAL_SECONDS: float = 5.0 # Intervalo entre agregações do ledger no saldo das empresas
+    TOKEN_LEDGER_BATCH_SIZE: int = 1000 # Eventos aplicados por transação
+
+    # --- Índices vetoriais (pgvector HNSW) ---
+    VECTOR_HNSW_M: int = 16 # Conexões por nó do grafo (alterar recria o índice no próximo init_db)
+    VECTOR_HNSW_EF_CONSTRUCTION: int = 64 # Tamanho da lista de candidatos na construção
+    VECTOR_HNSW_EF_SEARCH: int = 100 # Tamanho da lista de candidatos por consulta (recall x latência)
+    VECTOR_HNSW_ITERATIVE_SCAN: str = "relaxed_order" # 'off', 'strict_order' ou 'relaxed_order' (pgvector >= 0.8)
+
+    # --- Cache de embeddings ---
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_LRU_SIZE: int = 4096 # Entradas mantidas em memória por processo
+    EMBEDDING_CACHE_PERSISTENT: bool = True # Segundo nível na tabela embedding_cache (compartilhado entre workers)
+    EMBEDDING_CACHE_STATS_EVERY: int = 500 # Loga a taxa de acerto a cada N consultas ao cache
+    EMBEDDING_STORE_MAX_IDLE_DAYS: int = 90 # Entradas não reaproveitadas há mais tempo são removidas
+    EMBEDDING_STORE_MAX_ENTRIES: int = 1_000_000 # Teto de entradas; as menos usadas recentemente saem primeiro
+    EMBEDDING_STORE_GC_INTERVAL_HOURS: float = 24.0
+
+    # --- Geração de embeddings em lote ---
+    EMBEDDING_MAX_CONCURRENCY: int = 4 # Lotes em voo simultaneamente
+    EMBEDDING_BATCH_MAX_ITEMS: int = 100 # Itens por requisição (limite da API)
+    EMBEDDING_BATCH_MAX_TOKENS: int = 16000 # Tokens estimados por requisição (textos longos geram lotes menores)
+    EMBEDDING_MAX_ATTEMPTS: int = 3 # Tentativas por item antes de desistir
+    EMBEDDING_REQUESTS_PER_MINUTE: int = 1000 # Cota de requisições de embedding por chave de API
+
+    # --- Cliente das APIs do Google (Sheets, Drive, Calendar) ---
+    GOOGLE_API_MAX_WORKERS: int = 16 # Threads dedicadas às chamadas síncronas do googleapiclient
+    GOOGLE_API_CONCURRENCY: str = "sheets:4,drive:8,calendar:4" # Requisições simultâneas por API
+    GOOGLE_API_DEFAULT_CONCURRENCY: int = 4 # Limite para APIs não listadas acima
+    GOOGLE_API_MAX_RETRIES: int = 4 # Novas tentativas em 429/5xx/erros de rede
+    GOOGLE_API_BACKOFF_BASE_SECONDS: float = 0.5 # Backoff exponencial: base * 2^tentativa (+ jitter)
+    SHEETS_METADATA_CACHE_TTL_SECONDS: float = 300.0 # Validade dos nomes de abas em cache (syncs sempre releem)
+    DRIVE_MAX_FILES: int = 50_000 # Arquivos listados por pasta sincronizada (0 = sem limite)
+    DRIVE_CRAWL_CONCURRENCY: int = 8 # Consultas files.list simultâneas na varredura de uma árvore
+    DRIVE_CRAWL_PARENTS_PER_QUERY: int = 20 # Pastas agrupadas por consulta ('a' in parents or 'b' in parents ...)
+
+    # --- Agendador de integrações (Polling) ---
+    INTEGRATION_SYNC_MAX_CONCURRENCY: int = 8 # Sincronizações simultâneas por réplica do worker
+    INTEGRATION_SYNC_PER_HOST_CONCURRENCY: int = 2 # Sincronizações simultâneas contra o mesmo host de destino
+    INTEGRATION_SCHEDULER_POLL_SECONDS: float = 10.0 # Intervalo entre buscas por integrações vencidas
+    INTEGRATION_SYNC_CLAIM_BATCH: int = 100 # Candidatas bloqueadas (SKIP LOCKED) por busca
+    INTEGRATION_SYNC_LEASE_MINUTES: int = 30 # Se a réplica morrer no meio da execução, outra assume após este prazo
+    INTEGRATION_STREAM_MIN_BYTES: int = 5 * 1024 * 1024 # Payloads a partir deste tamanho são lidos em streaming
+    INTEGRATION_STREAM_SPOOL_BYTES: int = 1024 * 1024 # Parte do download mantida em memória antes de ir para arquivo temporário
+    INTEGRATION_STREAM_CHUNK_ITEMS: int = 500 # Itens por bloco de checksum/embedding/gravação
+    INTEGRATION_PAYLOAD_SAMPLE_ITEMS: int = 20 # Itens guardados em last_payload quando o payload é lido em streaming
+    INTEGRATION_MAX_PAYLOAD_BYTES: int = 500 * 1024 * 1024 # Downloads maiores são abortados
+    INTEGRATION_WEBHOOK_COALESCE_MAX_JOBS: int = 50 # Pushes do webhook de uma integração processados numa mesma execução
+    INTEGRATION_WEBHOOK_JOB_RETENTION_HOURS: int = 72 # Jobs concluídos ficam consultáveis por este período
+    INTEGRATION_WEBHOOK_MAX_ATTEMPTS: int = 5 # Execuções com erro antes de descartar os pushes do lote (status 'error')
+    INTEGRATION_WEBHOOK_RETRY_SECONDS: float = 30.0 # Espera antes da 2ª execução de um lote com erro (dobra a cada nova falha)
+    INTEGRATION_DNS_CACHE_TTL_SECONDS: float = 60.0 # Validade dos IPs resolvidos (e validados contra SSRF) por host
+    INTEGRATION_DNS_CACHE_MAX_ENTRIES: int = 1024
+    INTEGRATION_HTTP_MAX_CONNECTIONS: int = 100 # Conexões simultâneas do cliente HTTP compartilhado das integrações
+    INTEGRATION_HTTP_MAX_KEEPALIVE: int = 20 # Conexões ociosas mantidas abertas para reaproveitamento
+
+    # --- Cliente HTTP da API do WhatsApp (Graph API) ---
+    GRAPH_API_HTTP2: bool = True # Requer o pacote 'h2' (httpx[http2]); sem ele o cliente usa HTTP/1.1
+    GRAPH_API_MAX_CONNECTIONS: int = 50 # Conexões simultâneas do cliente compartilhado por processo
+    GRAPH_API_MAX_KEEPALIVE: int = 20 # Conexões ociosas mantidas abertas para reaproveitamento
+    GRAPH_API_KEEPALIVE_EXPIRY_SECONDS: float = 60.0
+    GRAPH_API_CONNECT_TIMEOUT_SECONDS: float = 10.0 # Timeout de conexão (os de leitura são definidos por chamada)
+    GRAPH_API_METRICS_LOG_EVERY: int = 500 # Loga a latência por endpoint a cada N requisições (0 = só no encerramento)
+
+    # --- Limite de envios por número (token bucket compartilhado no Postgres) ---
+    OUTBOUND_RATE_LIMIT_ENABLED: bool = True
+    OUTBOUND_PHONE_MESSAGES_PER_SECOND: float = 80.0 # Throughput padrão por número (sobrescrito por Company.wbp_messages_per_second)
+    OUTBOUND_PAIR_MESSAGES_PER_MINUTE: float = 10.0 # Mensagens por minuto para o mesmo destinatário (pair rate limit da Meta)
+    OUTBOUND_PAIR_BURST: int = 20 # Rajada permitida para o mesmo destinatário antes de aplicar a cadência acima
+    OUTBOUND_RESERVE_AUTOMATED: float = 0.2 # Fração da capacidade do número reservada a respostas interativas (follow-ups)
+    OUTBOUND_RESERVE_BULK: float = 0.5 # Fração da capacidade do número reservada a tráfego de maior prioridade (disparos em massa)
+    OUTBOUND_BUCKET_IDLE_HOURS: int = 24 # Buckets sem uso há mais tempo são removidos
+
+    # --- Fila durável de entrega das mensagens da IA ---
+    OUTBOUND_DELIVERY_MAX_ATTEMPTS: int = 3 # Tentativas por mensagem antes de marcar o atendimento com 'Falha no Envio'
+    OUTBOUND_DELIVERY_RETRY_SECONDS: float = 5.0 # Espera antes da 2ª tentativa (dobra a cada nova falha)
+    OUTBOUND_DELIVERY_STALE_SECONDS: int = 300 # Entrega 'sending' há mais tempo sobrou de um processo que morreu e volta para a fila
+    OUTBOUND_DELIVERY_DRAIN_SECONDS: float = 30.0 # No encerramento do worker, tempo para terminar as entregas em andamento
+    OUTBOUND_DELIVERY_RETENTION_DAYS: int = 7 # Entregas que falharam ficam consultáveis por este período
+
+    # --- Jobs de sincronização (Planilhas/Drive) ---
+    SYNC_JOB_MAX_CONCURRENCY: int = 2 # Sincronizações simultâneas por réplica do worker de sincronização
+    SYNC_JOB_POLL_SECONDS: float = 2.0 # Intervalo entre buscas na fila (e entre heartbeats)
+    SYNC_JOB_STALE_MINUTES: int = 10 # Job em execução sem heartbeat por este prazo é encerrado com erro
+    SYNC_JOB_PROGRESS_INTERVAL_SECONDS: float = 2.0 # Intervalo mínimo entre gravações de progresso de um job
+    SYNC_JOB_RETENTION_DAYS: int = 7 # Jobs concluídos ficam consultáveis por este período
+    SYNC_JOB_DEBOUNCE_SECONDS: float = 30.0 # Silêncio exigido após a última notificação do Drive antes de sincronizar
+    SYNC_JOB_DEBOUNCE_MAX_SECONDS: float = 300.0 # Espera máxima de um job adiado (edição contínua ainda sincroniza)
+
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
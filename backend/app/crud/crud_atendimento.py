@@ -384,7 +384,6 @@ async def get_dashboard_data(
         select(
             func.date_trunc('day', func.timezone('America/Sao_Paulo', models.Atendimento.created_at)).label('day'),
             func.count(models.Atendimento.id).label('total'),
-            func.sum(models.Atendimento.token_usage).label('tokens'),
             *status_filters
         ).where(
             models.Atendimento.company_id == company_id,
@@ -418,13 +417,19 @@ async def get_dashboard_data(
             for status in status_colors.keys():
                 all_days_in_period[day_key][status] = row.get(status, 0)
             all_days_in_period[day_key]['total'] = row.get('total', 0)
-            all_days_in_period[day_key]['tokens'] = row.get('tokens', 0) or 0
+
+    # Tokens por dia vêm dos agregados diários do ledger (consumo real do dia, não do atendimento criado no dia)
+    tokens_por_dia = await crud_user.get_token_usage_report(db, company_id, start_date, end_date, group_by=["day"])
+    for row in tokens_por_dia:
+        day_key = row['day'].strftime('%d/%m')
+        if day_key in all_days_in_period:
+            all_days_in_period[day_key]['tokens'] = row['cost_units']
     
     # 3. Converte o dicionário para a lista final.
     contatos_por_dia = list(all_days_in_period.values())
     
     # --- 4. Consumo de Tokens (Real) ---
-    # Busca o total de tokens consumidos no período usando a tabela de histórico
+    # Busca o total de tokens consumidos no período usando os agregados diários do ledger
     total_tokens_periodo = await crud_user.get_token_usage_in_period(db, company_id, start_date, end_date)
     
     # Calcula a média por atendimento
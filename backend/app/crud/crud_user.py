@@ -1,14 +1,25 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import func
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import joinedload
 from app.db import models
 import logging
-from typing import Optional, List
-from datetime import datetime
+from typing import Optional, List, Dict, Any
+from datetime import datetime, timezone
+import pytz
 
 logger = logging.getLogger(__name__)
 
+# Fuso em que token_usage_daily.day é agregado
+TOKEN_USAGE_TZ = pytz.timezone("America/Sao_Paulo")
+
+def _token_usage_day(value: datetime):
+    """Converte um limite do período (naive = UTC) para o dia correspondente em America/Sao_Paulo."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(TOKEN_USAGE_TZ).date()
+
 async def get_user(db: AsyncSession, user_id: int) -> models.User | None:
     """Busca um utilizador pelo seu ID."""
     return await db.get(models.User, user_id)
@@ -47,36 +58,143 @@ async def get_company_by_wbp_phone_number_id(db: AsyncSession, phone_number_id:
     )
     return result.scalars().first()
 
-async def decrement_company_tokens(
+async def record_token_usage(
     db: AsyncSession,
-    db_company: models.Company,
+    company_id: int,
     usage: int,
     atendimento_id: Optional[int] = None,
-    token_type: str = "inference"
-):
-    """Deduz os tokens usados pela empresa do seu saldo e atualiza o atendimento."""
-    if db_company.tokens is None:
-        db_company.tokens = 0
-    
-    db_company.tokens -= usage
-    
-    if atendimento_id:
-        stmt = select(models.Atendimento).where(models.Atendimento.id == atendimento_id)
-        result = await db.execute(stmt)
-        atendimento = result.scalars().first()
-        if atendimento:
-            if atendimento.token_usage is None:
-                atendimento.token_usage = 0
-            atendimento.token_usage += usage
-            db.add(atendimento)
-    
+    token_type: str = "inference",
+    model: Optional[str] = None,
+    input_tokens: int = 0,
+    output_tokens: int = 0
+) -> models.TokenUsageLedger:
+    """
+    Registra um evento de consumo no ledger de tokens (somente INSERT, sem travar a linha da empresa).
+    O débito em Company.tokens e Atendimento.token_usage é aplicado depois por apply_pending_token_usage.
+
+    @param db: Sessão do banco de dados (o commit fica a cargo do chamador).
+    @param company_id: ID da empresa consumidora.
+    @param usage: Tokens equivalentes a debitar do saldo.
+    @param atendimento_id: Atendimento associado ao consumo, se houver.
+    @param token_type: Tipo do consumo (gemini_inference, gemini_tts, whatsapp_template...).
+    @param model: Modelo que gerou o consumo.
+    @param input_tokens: Tokens brutos de entrada reportados pelo provedor.
+    @param output_tokens: Tokens brutos de saída reportados pelo provedor.
+    @returns: O evento adicionado à sessão.
+    """
+    event = models.TokenUsageLedger(
+        company_id=company_id,
+        atendimento_id=atendimento_id,
+        model=model,
+        token_type=token_type,
+        input_tokens=input_tokens or 0,
+        output_tokens=output_tokens or 0,
+        cost_units=usage
+    )
+    db.add(event)
     logger.info(
-        f"DEDUÇÃO DE TOKENS: Tipo='{token_type}', Consumo={usage} tokens, "
-        f"Empresa={db_company.id} ({db_company.name}), "
-        f"Saldo Anterior={db_company.tokens + usage}, Saldo Atual={db_company.tokens}"
+        f"CONSUMO DE TOKENS REGISTRADO: Tipo='{token_type}', Consumo={usage} tokens, "
+        f"Empresa={company_id}, Atendimento={atendimento_id}, Modelo={model}"
+    )
+    return event
+
+async def apply_pending_token_usage(db: AsyncSession, batch_size: int = 1000) -> int:
+    """
+    Aplica um lote de eventos pendentes do ledger aos saldos, agregando por empresa e por atendimento.
+    Usa FOR UPDATE SKIP LOCKED para que várias instâncias possam agregar sem aplicar o mesmo evento duas vezes.
+
+    @param db: Sessão do banco de dados (deve estar dentro de uma transação; o commit fica a cargo do chamador).
+    @param batch_size: Quantidade máxima de eventos processados nesta chamada.
+    @returns: Número de eventos aplicados.
+    """
+    stmt = (
+        select(
+            models.TokenUsageLedger.id,
+            models.TokenUsageLedger.company_id,
+            models.TokenUsageLedger.atendimento_id,
+            models.TokenUsageLedger.model,
+            models.TokenUsageLedger.token_type,
+            models.TokenUsageLedger.input_tokens,
+            models.TokenUsageLedger.output_tokens,
+            models.TokenUsageLedger.cost_units,
+            func.date(func.timezone('America/Sao_Paulo', models.TokenUsageLedger.created_at)).label('day')
+        )
+        .where(models.TokenUsageLedger.applied_at.is_(None))
+        .order_by(models.TokenUsageLedger.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    rows = (await db.execute(stmt)).all()
+    if not rows:
+        return 0
+
+    por_empresa: Dict[int, int] = {}
+    por_atendimento: Dict[int, int] = {}
+    por_dia: Dict[tuple, Dict[str, int]] = {}
+    for row in rows:
+        por_empresa[row.company_id] = por_empresa.get(row.company_id, 0) + row.cost_units
+        if row.atendimento_id:
+            por_atendimento[row.atendimento_id] = por_atendimento.get(row.atendimento_id, 0) + row.cost_units
+        bucket = por_dia.setdefault(
+            (row.company_id, row.day, row.model or "", row.token_type),
+            {"events": 0, "input_tokens": 0, "output_tokens": 0, "cost_units": 0}
+        )
+        bucket["events"] += 1
+        bucket["input_tokens"] += row.input_tokens or 0
+        bucket["output_tokens"] += row.output_tokens or 0
+        bucket["cost_units"] += row.cost_units
+
+    # Ordem fixa de IDs evita deadlock entre agregadores concorrentes
+    for company_id in sorted(por_empresa):
+        await db.execute(
+            update(models.Company)
+            .where(models.Company.id == company_id)
+            .values(tokens=func.coalesce(models.Company.tokens, 0) - por_empresa[company_id])
+            .execution_options(synchronize_session=False)
+        )
+    for atendimento_id in sorted(por_atendimento):
+        await db.execute(
+            update(models.Atendimento)
+            .where(models.Atendimento.id == atendimento_id)
+            # Mantém updated_at: a bilhetagem não é atividade da conversa
+            .values(
+                token_usage=func.coalesce(models.Atendimento.token_usage, 0) + por_atendimento[atendimento_id],
+                updated_at=models.Atendimento.updated_at
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    # Agregados diários (empresa/dia/modelo/tipo) atualizados na mesma transação, sem dupla contagem
+    daily_rows = [
+        {"company_id": cid, "day": day, "model": model, "token_type": token_type, **totais}
+        for (cid, day, model, token_type), totais in sorted(por_dia.items())
+    ]
+    insert_stmt = pg_insert(models.TokenUsageDaily).values(daily_rows)
+    await db.execute(
+        insert_stmt.on_conflict_do_update(
+            index_elements=["company_id", "day", "model", "token_type"],
+            set_={
+                "events": models.TokenUsageDaily.events + insert_stmt.excluded.events,
+                "input_tokens": models.TokenUsageDaily.input_tokens + insert_stmt.excluded.input_tokens,
+                "output_tokens": models.TokenUsageDaily.output_tokens + insert_stmt.excluded.output_tokens,
+                "cost_units": models.TokenUsageDaily.cost_units + insert_stmt.excluded.cost_units,
+            }
+        )
     )
-    db.add(db_company)
-        
+
+    await db.execute(
+        update(models.TokenUsageLedger)
+        .where(models.TokenUsageLedger.id.in_([row.id for row in rows]))
+        .values(applied_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+
+    logger.info(
+        f"LEDGER DE TOKENS: {len(rows)} evento(s) aplicados. "
+        + ", ".join(f"Empresa {cid}: -{total}" for cid, total in sorted(por_empresa.items()))
+    )
+    return len(rows)
+
 async def get_companies_with_agent_running(db: AsyncSession) -> List[models.Company]:
     """
     Busca todas as empresas no banco de dados que estão com o
@@ -100,11 +218,64 @@ async def get_companies_with_followup_active(db: AsyncSession) -> List[models.Co
     return result.scalars().unique().all()
 
 async def get_token_usage_in_period(db: AsyncSession, company_id: int, start_date: datetime, end_date: datetime) -> int:
-    """Retorna o total de tokens consumidos em um período para cálculos de média por empresa."""
-    stmt = select(func.sum(models.Atendimento.token_usage)).where(
-        models.Atendimento.company_id == company_id,
-        models.Atendimento.created_at >= start_date,
-        models.Atendimento.created_at <= end_date
+    """Retorna o total de tokens consumidos em um período (agregados diários) para cálculos de média por empresa."""
+    stmt = select(func.sum(models.TokenUsageDaily.cost_units)).where(
+        models.TokenUsageDaily.company_id == company_id,
+        models.TokenUsageDaily.day >= _token_usage_day(start_date),
+        models.TokenUsageDaily.day <= _token_usage_day(end_date)
+    )
+    result = await db.execute(stmt)
+    return int(result.scalar() or 0)
+
+async def get_token_usage_report(
+    db: AsyncSession,
+    company_id: int,
+    start_date: datetime,
+    end_date: datetime,
+    group_by: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Consulta os agregados diários de consumo de tokens de uma empresa.
+
+    @param db: Sessão do banco de dados.
+    @param company_id: ID da empresa.
+    @param start_date: Início do período (o dia é considerado inteiro).
+    @param end_date: Fim do período (o dia é considerado inteiro).
+    @param group_by: Dimensões do agrupamento, dentre 'day', 'model' e 'token_type'. Padrão: ['day'].
+    @returns: Lista de dicionários com as dimensões pedidas e os totais (events, input_tokens, output_tokens, cost_units).
+    """
+    dimensoes_validas = {
+        "day": models.TokenUsageDaily.day,
+        "model": models.TokenUsageDaily.model,
+        "token_type": models.TokenUsageDaily.token_type,
+    }
+    group_by = group_by or ["day"]
+    invalidas = [d for d in group_by if d not in dimensoes_validas]
+    if invalidas:
+        raise ValueError(f"Dimensões de agrupamento inválidas: {', '.join(invalidas)}")
+
+    colunas = [dimensoes_validas[d].label(d) for d in group_by]
+    stmt = (
+        select(
+            *colunas,
+            func.sum(models.TokenUsageDaily.events).label("events"),
+            func.sum(models.TokenUsageDaily.input_tokens).label("input_tokens"),
+            func.sum(models.TokenUsageDaily.output_tokens).label("output_tokens"),
+            func.sum(models.TokenUsageDaily.cost_units).label("cost_units")
+        )
+        .where(
+            models.TokenUsageDaily.company_id == company_id,
+            models.TokenUsageDaily.day >= _token_usage_day(start_date),
+            models.TokenUsageDaily.day <= _token_usage_day(end_date)
+        )
+        .group_by(*colunas)
+        .order_by(*colunas)
     )
     result = await db.execute(stmt)
-    return result.scalar() or 0
+    linhas = []
+    for row in result.mappings().all():
+        linha = dict(row)
+        for campo in ("events", "input_tokens", "output_tokens", "cost_units"):
+            linha[campo] = int(linha[campo] or 0)
+        linhas.append(linha)
+    return linhas
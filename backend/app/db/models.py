@@ -1,8 +1,8 @@
-from sqlalchemy import ( Column, Integer, String, ForeignKey, Text, DateTime, func, Enum as SQLEnum )
+from sqlalchemy import ( Column, Integer, BigInteger, Float, String, ForeignKey, Text, Date, DateTime, Index, LargeBinary, func, text, Enum as SQLEnum )
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.dialects.postgresql import JSONB
 from typing import List, Optional, Dict, Any
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from pgvector.sqlalchemy import Vector
 import enum
 
@@ -17,6 +17,7 @@ class Company(Base):
 
     wbp_phone_number_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, index=True, comment="ID do Número de Telefone na WhatsApp Business Platform")
     wbp_business_account_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="ID da Conta do WhatsApp Business na Meta")
+    wbp_messages_per_second: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, comment="Throughput do número na Meta (mensagens/s); vazio usa OUTBOUND_PHONE_MESSAGES_PER_SECOND")
 
     agent_running: Mapped[bool] = mapped_column(default=False, nullable=False, server_default="false")
     atendente_online: Mapped[bool] = mapped_column(default=False, nullable=False, server_default="false", comment="Status de disponibilidade do atendente humano")
@@ -55,6 +56,7 @@ class Config(Base):
     spreadsheet_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="ID da Planilha de Instruções (System)")
     spreadsheet_rag_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="ID da Planilha de Conhecimento (RAG)")
     drive_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="ID da pasta do Google Drive contendo mídias")
+    drive_sync_state: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSONB, nullable=True, comment="Estado da sync incremental do Drive (folder_id, page_token da Changes API, IDs das pastas)")
     prompt: Mapped[Optional[str]] = mapped_column(Text, nullable=True, comment="Contexto fixo gerado a partir das abas de sistema")
     notification_active: Mapped[bool] = mapped_column(default=False, nullable=False, server_default="false", comment="Ativar notificações via ProspectAI")
     notification_destination: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="ID/JID do contato ou grupo para receber notificações")
@@ -104,13 +106,61 @@ class Integration(Base):
     last_sync_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     last_status: Mapped[Optional[str]] = mapped_column(String(50), nullable=True, default="pending")
     last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
-    item_checksums: Mapped[Optional[Dict[str, str]]] = mapped_column(JSONB, nullable=True, comment="Mapeamento item_id -> md5 hash para atualizações incrementais")
+    item_checksums: Mapped[Optional[Dict[str, str]]] = mapped_column(JSONB, nullable=True, comment="Legado: substituído pela tabela integration_items (mantido apenas para migração)")
     last_payload: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSONB, nullable=True, comment="Último payload JSON recebido via webhook")
+    payload_hash: Mapped[Optional[str]] = mapped_column(String(32), nullable=True, comment="MD5 do último payload processado por completo (somado ao mapeamento de campos)")
+    http_etag: Mapped[Optional[str]] = mapped_column(Text, nullable=True, comment="ETag da última resposta do Polling (If-None-Match)")
+    http_last_modified: Mapped[Optional[str]] = mapped_column(String(100), nullable=True, comment="Last-Modified da última resposta do Polling (If-Modified-Since)")
+    next_run_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True, server_default=func.now(), comment="Próxima execução do Polling; também serve de lease enquanto uma execução (Polling ou lote do Webhook) está em andamento")
+    leased_until: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True, comment="Fim do lease da execução em andamento (Polling, lote do Webhook ou sincronização manual); nulo ou vencido = nenhuma execução")
 
     config: Mapped["Config"] = relationship(back_populates="integrations")
 
+    __table_args__ = (
+        # Índice parcial: o agendador só busca integrações Polling ativas e vencidas
+        Index("ix_integrations_due", "next_run_at", postgresql_where=text("enabled AND integration_type = 'polling'")),
+    )
+
+class IntegrationItem(Base):
+    """Estado incremental de cada item de uma integração (checksum do último conteúdo vetorizado)."""
+    __tablename__ = "integration_items"
+
+    integration_id: Mapped[int] = mapped_column(ForeignKey("integrations.id", ondelete="CASCADE"), primary_key=True)
+    item_id: Mapped[str] = mapped_column(String(255), primary_key=True, comment="ID do item na origem (title_field, id, _id ou hash); acima de 255 caracteres, 'sha256:<hex>' do ID")
+    checksum: Mapped[str] = mapped_column(String(32), nullable=False, comment="MD5 dos campos selecionados do item")
+    vector_id: Mapped[Optional[int]] = mapped_column(ForeignKey("contextos.id", ondelete="SET NULL"), nullable=True, index=True, comment="Vetor RAG gerado a partir do item")
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class IntegrationWebhookJob(Base):
+    """
+    Payload recebido pelo webhook de entrada, aguardando processamento assíncrono pelo worker de integrações.
+    Vários jobs pendentes da mesma integração são processados juntos numa única execução; se ela falhar,
+    os jobs voltam à fila com backoff e só ficam com 'error' depois de INTEGRATION_WEBHOOK_MAX_ATTEMPTS.
+    """
+    __tablename__ = "integration_webhook_jobs"
+    __table_args__ = (
+        # Índice parcial: o worker só busca jobs ainda na fila
+        Index("ix_integration_webhook_jobs_queued", "integration_id", "created_at", postgresql_where=text("status = 'queued'")),
+    )
+
+    id: Mapped[str] = mapped_column(String(32), primary_key=True, comment="Identificador público do job (uuid hex)")
+    integration_id: Mapped[int] = mapped_column(ForeignKey("integrations.id", ondelete="CASCADE"), index=True)
+    payload: Mapped[Optional[Any]] = mapped_column(JSONB, nullable=True, comment="Payload recebido (descartado após o processamento)")
+    status: Mapped[str] = mapped_column(String(20), default="queued", server_default="'queued'", nullable=False, comment="'queued', 'processing', 'done' ou 'error'")
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False, comment="Execuções com erro; o job volta à fila até INTEGRATION_WEBHOOK_MAX_ATTEMPTS")
+    not_before: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False, comment="Nova tentativa só a partir deste instante (backoff após erro)")
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    processed_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, comment="Vetores atualizados na execução que incluiu este job")
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
 class KnowledgeVector(Base):
     __tablename__ = "contextos"
+    __table_args__ = (
+        # Localiza os vetores de um item de integração sem varrer o JSONB raw_data
+        Index("ix_contextos_integration_item", "config_id", "origin", "integration_item_id", postgresql_where=text("integration_item_id IS NOT NULL")),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     config_id: Mapped[int] = mapped_column(ForeignKey("configs.id"), index=True)
@@ -123,6 +173,8 @@ class KnowledgeVector(Base):
     content: Mapped[str] = mapped_column(Text, nullable=False, comment="Formatted text used for RAG embedding AND fast ILIKE text searches")
     origin: Mapped[str] = mapped_column(String(50), nullable=False, comment="'sheet' or 'drive'")
     embedding: Mapped[Optional[List[float]]] = mapped_column(Vector(768), nullable=True, comment="Vector embedding (Google text-embedding-004)")
+    row_checksum: Mapped[Optional[str]] = mapped_column(String(32), nullable=True, comment="MD5 de categoria + conteúdo, usado na sincronização incremental")
+    integration_item_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="ID do item na origem, para vetores de integrações (origin 'integration_<id>')")
 
     config: Mapped["Config"] = relationship(back_populates="vectors")
 
@@ -165,3 +217,130 @@ class AtendimentoMessageSearch(Base):
     company: Mapped["Company"] = relationship()
     atendimento: Mapped["Atendimento"] = relationship()
 
+class TokenUsageLedger(Base):
+    """
+    Registro append-only de cada evento de consumo de tokens (bilhetagem).
+    O saldo de Company.tokens e o Atendimento.token_usage são atualizados depois, em lote, pelo agregador.
+    """
+    __tablename__ = "token_usage_ledger"
+    __table_args__ = (
+        # Índice parcial: o agregador só varre eventos ainda não aplicados ao saldo
+        Index("ix_token_usage_ledger_pending", "id", postgresql_where=text("applied_at IS NULL")),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    company_id: Mapped[int] = mapped_column(ForeignKey("companies.id", ondelete="CASCADE"), index=True)
+    atendimento_id: Mapped[Optional[int]] = mapped_column(ForeignKey("atendimentos.id", ondelete="SET NULL"), nullable=True, index=True)
+    model: Mapped[Optional[str]] = mapped_column(String(100), nullable=True, comment="Modelo que gerou o consumo (ex: gemini-3.1-flash-lite)")
+    token_type: Mapped[str] = mapped_column(String(50), nullable=False, comment="Tipo do consumo (gemini_inference, gemini_tts, whatsapp_template...)")
+    input_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    output_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    cost_units: Mapped[int] = mapped_column(Integer, nullable=False, comment="Tokens equivalentes debitados do saldo da empresa")
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    applied_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True, comment="Momento em que o evento foi aplicado ao saldo (NULL = pendente)")
+
+class TokenUsageDaily(Base):
+    """
+    Agregado diário de consumo por empresa, modelo e tipo (dia no fuso America/Sao_Paulo).
+    Mantido pelo agregador do ledger na mesma transação que aplica os eventos ao saldo.
+    """
+    __tablename__ = "token_usage_daily"
+
+    company_id: Mapped[int] = mapped_column(ForeignKey("companies.id", ondelete="CASCADE"), primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    model: Mapped[str] = mapped_column(String(100), primary_key=True, default="", comment="Modelo do consumo ('' quando não se aplica, ex: templates)")
+    token_type: Mapped[str] = mapped_column(String(50), primary_key=True)
+    events: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    input_tokens: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    output_tokens: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    cost_units: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False, comment="Tokens equivalentes debitados no dia")
+
+class EmbeddingCacheEntry(Base):
+    """
+    Armazenamento de embeddings endereçado por conteúdo: hash de (modelo, tarefa, dimensões, texto normalizado).
+    Compartilhado entre processos/workers e por todos os fluxos de ingestão (planilhas, Drive, integrações, mensagens).
+    Entradas sem uso há muito tempo são removidas pela coleta de lixo (last_used_at).
+    """
+    __tablename__ = "embedding_cache"
+
+    key_hash: Mapped[str] = mapped_column(String(64), primary_key=True, comment="sha256 de modelo|tarefa|dimensões|texto normalizado")
+    model: Mapped[str] = mapped_column(String(100), nullable=False, comment="Ex: gemini-embedding-001:RETRIEVAL_QUERY:768")
+    embedding: Mapped[List[float]] = mapped_column(Vector(768), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    last_used_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True, comment="Último reaproveitamento (com granularidade diária) usado pela coleta de lixo")
+
+class SyncJob(Base):
+    """
+    Sincronização de Planilha (system/rag) ou Drive executada fora do processo da API pelo worker de sincronização.
+    Por (config_id, kind) existe no máximo um job em execução e um na fila; novos pedidos se juntam ao da fila.
+    Notificações do Drive agendam o job para depois de um período sem novas notificações (run_after).
+    """
+    __tablename__ = "sync_jobs"
+    __table_args__ = (
+        Index("uq_sync_jobs_queued", "config_id", "kind", unique=True, postgresql_where=text("status = 'queued'")),
+        Index("uq_sync_jobs_running", "config_id", "kind", unique=True, postgresql_where=text("status = 'running'")),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    config_id: Mapped[int] = mapped_column(ForeignKey("configs.id", ondelete="CASCADE"), index=True)
+    company_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    kind: Mapped[str] = mapped_column(String(20), nullable=False, comment="'system', 'rag' ou 'drive'")
+    resource_id: Mapped[str] = mapped_column(String(255), nullable=False, comment="ID da planilha ou da pasta do Drive")
+    force_full: Mapped[bool] = mapped_column(default=False, server_default="false", nullable=False, comment="Drive: ignora o page token e faz a varredura completa")
+    trigger: Mapped[str] = mapped_column(String(20), default="manual", server_default="'manual'", nullable=False, comment="'manual' (API) ou 'webhook' (notificação do Drive)")
+    status: Mapped[str] = mapped_column(String(20), default="queued", server_default="'queued'", nullable=False, comment="'queued', 'running', 'done', 'error' ou 'cancelled'")
+    run_after: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False, comment="O worker só reivindica o job a partir deste instante (debounce das notificações)")
+    source_revision: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, comment="Versão do arquivo no Drive lida antes da sincronização (planilhas)")
+    cancel_requested: Mapped[bool] = mapped_column(default=False, server_default="false", nullable=False)
+    progress_total: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False, comment="Textos a vetorizar na execução")
+    progress_completed: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+    progress_failed: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+    report: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSONB, nullable=True, comment="Relatório da sincronização (items, added, changed, removed...)")
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    heartbeat_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True, comment="Atualizado pelo worker durante a execução; parado há muito tempo = worker morreu")
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+class OutboundRateBucket(Base):
+    """
+    Token bucket de envios de mensagens, compartilhado por todos os processos (API e workers).
+    Chaves: 'phone:<wbp_phone_number_id>' (throughput do número) e 'pair:<wbp_phone_number_id>:<destinatário>'.
+    """
+    __tablename__ = "outbound_rate_buckets"
+
+    bucket_key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    tokens: Mapped[float] = mapped_column(Float, nullable=False, comment="Saldo no instante updated_at (a recarga é calculada na consulta)")
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+class OutboundDelivery(Base):
+    """
+    Mensagem da IA aguardando entrega ao cliente (fila durável por atendimento, consumida em ordem de id).
+    Por atendimento existe no máximo uma entrega em envio; a linha é removida depois de entregue e gravada
+    no histórico, e fica com status 'failed' quando esgota as tentativas de envio.
+    """
+    __tablename__ = "outbound_deliveries"
+    __table_args__ = (
+        Index("uq_outbound_deliveries_sending", "atendimento_id", unique=True, postgresql_where=text("status = 'sending'")),
+        Index("ix_outbound_deliveries_pending", "atendimento_id", "id", postgresql_where=text("status IN ('queued', 'sending')")),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    atendimento_id: Mapped[int] = mapped_column(ForeignKey("atendimentos.id", ondelete="CASCADE"), nullable=False)
+    company_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    kind: Mapped[str] = mapped_column(String(20), nullable=False, comment="'text', 'audio' ou 'drive'")
+    number: Mapped[str] = mapped_column(String(50), nullable=False)
+    text: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    drive_file_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    filename: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    media_type: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
+    mimetype: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    caption: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    audio_data: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True, comment="Áudio gerado pelo TTS, reaproveitado nas novas tentativas de envio")
+    sent_entry: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSONB, nullable=True, comment="Entrada do histórico da mensagem já enviada (com o ID da Meta); preenchida = nunca reenviar, só gravar o histórico")
+    status: Mapped[str] = mapped_column(String(20), default="queued", server_default="'queued'", nullable=False, comment="'queued', 'sending' ou 'failed'")
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+    not_before: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False, comment="Nova tentativa só a partir deste instante")
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True, comment="Início do envio; parado há muito tempo = processo morreu durante o envio")
@@ -96,6 +96,25 @@ class Config(ConfigBase):
     company_id: int
     model_config = {"from_attributes": True}
 
+# --- Schemas de Jobs de Sincronização (Sheets/Drive) ---
+class SyncJob(BaseModel):
+    id: int
+    config_id: int
+    kind: str
+    trigger: str
+    status: str
+    cancel_requested: bool = False
+    run_after: Optional[datetime] = None
+    progress_total: int = 0
+    progress_completed: int = 0
+    progress_failed: int = 0
+    report: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    model_config = {"from_attributes": True}
+
 # --- Schemas de Integração ---
 class IntegrationBase(BaseModel):
     name: str
@@ -133,6 +152,7 @@ class Integration(IntegrationBase):
     config_id: int
     webhook_token: Optional[str] = None
     last_sync_at: Optional[datetime] = None
+    next_run_at: Optional[datetime] = None
     last_status: Optional[str] = "pending"
     last_error: Optional[str] = None
     last_payload: Optional[Dict[str, Any]] = None
@@ -231,6 +251,7 @@ class CompanyBase(BaseModel):
     name: str
     wbp_phone_number_id: Optional[str] = None
     wbp_business_account_id: Optional[str] = None
+    wbp_messages_per_second: Optional[int] = None
     agent_running: Optional[bool] = False
     atendente_online: Optional[bool] = False
     tokens: Optional[int] = 0
@@ -246,6 +267,7 @@ class CompanyUpdate(BaseModel):
     name: Optional[str] = None
     wbp_phone_number_id: Optional[str] = None
     wbp_business_account_id: Optional[str] = None
+    wbp_messages_per_second: Optional[int] = None
     agent_running: Optional[bool] = None
     atendente_online: Optional[bool] = None
     tokens: Optional[int] = None
@@ -132,11 +132,17 @@ logger = logging.getLogger(__name__)
 
 from app.services.init_db import init_db
 from app.services.backup_service import start_backup_scheduler
+from app.services.trace_service import stop_trace_sink
+from app.services.token_ledger_service import start_token_ledger_aggregator, stop_token_ledger_aggregator
+from app.services.embedding_cache_service import start_embedding_gc, stop_embedding_gc
+from app.services.integration_http_client import close_integration_http_client
+from app.services.graph_api_client import get_graph_api_client, close_graph_api_client
 
 app = FastAPI(
     title="API AtendAI",
     version="1.0.0",
-    on_startup=[init_db, start_backup_scheduler],
+    on_startup=[init_db, start_backup_scheduler, start_token_ledger_aggregator, start_embedding_gc, get_graph_api_client],
+    on_shutdown=[stop_trace_sink, stop_token_ledger_aggregator, stop_embedding_gc, close_integration_http_client, close_graph_api_client],
 )
 
 # --- CONFIGURAÇÃO DE CORS MELHORADA ---
@@ -4,6 +4,7 @@ import logging
 import random
 import uuid
 import re
+import time
 from typing import Dict, List, Any, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
@@ -17,6 +18,8 @@ from app.services.gemini_service import get_gemini_service
 from app.services.google_calendar_service import get_google_calendar_service
 from app.services.google_drive_service import get_drive_service # <--- Import do serviço de Drive
 from app.services.config_service import SITUATIONS, ConfigService
+from app.services.trace_service import get_trace_sink, summarize_agent_messages
+from app.services.outbound_delivery_service import get_outbound_delivery_service
 parse_drive_index = ConfigService.parse_drive_index
 from app.db import models, schemas
 from app.services.agent_service import agente_atendimento, ContextoSaaS, contabilizar_tokens_pydantic
@@ -341,7 +344,7 @@ async def _process_single_atendimento_inner(atendimento_id: int, company: models
                 if persona_config.google_calendar_credentials:
                     try:
                         cal_service = get_google_calendar_service(persona_config)
-                        events = await asyncio.to_thread(cal_service.get_upcoming_events)
+                        events = await cal_service.get_upcoming_events()
                         if events:
                             booked_list = [f"- {e['start'].get('dateTime', e['start'].get('date'))}" for e in events]
                             booked_events_str = "\n# HORÁRIOS JÁ OCUPADOS (NÃO AGENDAR NESTES)\n" + "\n".join(booked_list) + "\n"
@@ -474,6 +477,10 @@ async def _process_single_atendimento_inner(atendimento_id: int, company: models
                 f"thinking_config={thinking_cfg}"
             )
 
+            trace_sink = get_trace_sink()
+            trace_sampled = trace_sink.should_sample(company.id)
+            started_at = time.perf_counter()
+
             resultado_ia = await agente_atendimento.run(
                 ultima_mensagem,
                 deps=contexto,
@@ -486,97 +493,35 @@ async def _process_single_atendimento_inner(atendimento_id: int, company: models
             dados = resultado_ia.output
             logger.info(f"[Passo 3/5 - IA] Retorno recebido com sucesso do LLM. Output Resumo: '{dados.resumo}'")
 
-            # Escreve o input e output detalhado em last_prompt.txt de forma humanizada e amigável
-            try:
-                from pydantic_core import to_jsonable_python
-                parts = []
-                parts.append("=" * 80)
-                parts.append(f"🕒 CICLO DO AGENTE: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                parts.append(f"🤖 MODELO UTILIZADO: {model_to_use}")
-                parts.append("=" * 80)
-                parts.append("")
-
-                messages = resultado_ia.all_messages()
-                system_prompt_content = ""
-                conversation_parts = []
-                
-                for msg in messages:
-                    msg_dict = to_jsonable_python(msg)
-                    role = msg_dict.get("role", "unknown")
-                    parts_list = msg_dict.get("parts", [])
-                    
-                    for p in parts_list:
-                        part_kind = p.get("part_kind")
-                        content = p.get("content") or p.get("text")
-                        
-                        if part_kind in ["system-prompt", "system"] or (content and ("--- CONTEXTO DO ATENDIMENTO ---" in str(content) or "Assistente virtual" in str(content))):
-                            system_prompt_content = str(content)
-                        elif part_kind == "user-prompt":
-                            conversation_parts.append(f"[Cliente 👤] {content}")
-                        elif part_kind == "tool-call" or ("tool_name" in p and "args" in p):
-                            tool_name = p.get("tool_name")
-                            args = p.get("args") or {}
-                            args_str = ", ".join(f"{k}={repr(v)}" for k, v in args.items())
-                            conversation_parts.append(f"[Ação da IA 🛠️] Executar ferramenta '{tool_name}' com: {args_str}")
-                        elif part_kind == "tool-return" or "outcome" in p:
-                            tool_name = p.get("tool_name")
-                            conversation_parts.append(f"[Resultado da Ferramenta '{tool_name}' 📥] {content}")
-                        elif part_kind == "text" or role == "model":
-                            conversation_parts.append(f"[IA 🤖] {content}")
-                        else:
-                            if content:
-                                conversation_parts.append(f"[{role.upper()}] {content}")
-
-                # Fallback de garantia: se o prompt do sistema não veio nas partes da mensagem, gera via construir_prompt_base
-                if not system_prompt_content:
-                    try:
+            # Registra a rodada no trace amostrado (escrita em background, fora do event loop)
+            if trace_sampled:
+                try:
+                    latency_ms = round((time.perf_counter() - started_at) * 1000)
+                    resumo_rodada = summarize_agent_messages(resultado_ia.all_messages())
+                    if not resumo_rodada["system_prompt"]:
+                        # Com message_history o PydanticAI pode não reenviar o system prompt nas partes; reconstrói a partir do contexto
                         from app.services.agent_service import construir_prompt_base
                         class MockRunContext:
                             def __init__(self, deps):
                                 self.deps = deps
-                        system_prompt_content = construir_prompt_base(MockRunContext(contexto))
-                    except Exception as sys_err:
-                        logger.warning(f"Não foi possível obter o prompt do sistema dinamicamente: {sys_err}")
-
-                if system_prompt_content:
-                    parts.append("--- 🧠 PROMPT DO SISTEMA (INSTRUÇÕES DO AGENTE) ---")
-                    parts.append(system_prompt_content.strip())
-                    parts.append("")
-                    parts.append("-" * 80)
-                    parts.append("")
-
-                if conversation_parts:
-                    parts.append("--- 💬 FLUXO DE CONVERSA E AÇÕES DA RODADA ---")
-                    parts.append("\n".join(conversation_parts))
-                    parts.append("")
-                    parts.append("-" * 80)
-                    parts.append("")
-
-                parts.append("--- 📝 RESUMO FINAL / STATUS ---")
-                parts.append(f"Resumo da Rodada: {dados.resumo}")
-                parts.append("Próximo Status: Aguardando Resposta")
-                parts.append("")
-                parts.append("-" * 80)
-                parts.append("")
-
-                if resultado_ia.usage:
-                    u = resultado_ia.usage
-                    parts.append("--- 📊 CONSUMO DE TOKENS DO CICLO ---")
-                    parts.append(f"Tokens de Entrada (Prompt): {getattr(u, 'input_tokens', 0)}")
-                    parts.append(f"Tokens de Saída (Resposta): {getattr(u, 'output_tokens', 0)}")
-                    parts.append(f"Total de Tokens Consumidos: {getattr(u, 'total_tokens', getattr(u, 'input_tokens', 0) + getattr(u, 'output_tokens', 0))}")
-                    parts.append("")
-                    parts.append("-" * 80)
-                    parts.append("")
-
-                # Adiciona o ciclo formatado ao last_prompt.txt (modo append 'a')
-                parts.append("=" * 80)
-                parts.append("\n")
-
-                with open("last_prompt.txt", "a", encoding="utf-8") as f:
-                    f.write("\n".join(parts))
-            except Exception as f_err:
-                logger.error(f"Erro ao gravar last_prompt.txt: {f_err}", exc_info=True)
+                        resumo_rodada["system_prompt"] = construir_prompt_base(MockRunContext(contexto))
+                    uso = resultado_ia.usage() if callable(resultado_ia.usage) else resultado_ia.usage
+                    trace_sink.emit({
+                        "kind": "agent_run",
+                        "company_id": company.id,
+                        "atendimento_id": atendimento_id,
+                        "model": model_to_use,
+                        "latency_ms": latency_ms,
+                        "input_tokens": getattr(uso, "input_tokens", 0) or 0,
+                        "output_tokens": getattr(uso, "output_tokens", 0) or 0,
+                        "requests": getattr(uso, "requests", None),
+                        "tool_calls": resumo_rodada["tool_calls"],
+                        "system_prompt": resumo_rodada["system_prompt"],
+                        "messages": resumo_rodada["messages"],
+                        "resumo": dados.resumo,
+                    })
+                except Exception as trace_err:
+                    logger.warning(f"[Passo 3/5 - IA] Falha ao registrar trace da rodada: {trace_err}")
             
             ia_response = {
                 "resumo": dados.resumo or "",
@@ -658,11 +603,13 @@ async def run_agent_cycle():
     Executa um ciclo completo de verificação e processamento do agente.
     Esta função é o ponto de entrada principal para o loop do agente, que é executado periodicamente.
     As tarefas de processamento são disparadas em background (create_task), portanto o ciclo retorna
-    imediatamente — sem bloquear enquanto a IA gera resposta ou os delays de digitação correm.
+    imediatamente — sem bloquear enquanto a IA gera resposta; os delays de digitação correm na fila de entrega.
     O status 'Gerando Resposta' garante que ciclos seguintes não dupliquem o processamento.
     """
     logger.info("Agente (Ciclo Otimizado): Iniciando ciclo...")
     
+    delivery_service = get_outbound_delivery_service()
+
     # Dicionário para garantir que cada atendimento seja processado apenas uma vez por ciclo, evitando duplicidade.
     atendimentos_para_processar: Dict[int, models.Atendimento] = {}
 
@@ -681,11 +628,16 @@ async def run_agent_cycle():
             # 2. Dispara cada atendimento como uma task independente em background.
             #    O ciclo retorna imediatamente; cada task roda no event loop de forma autônoma.
             if atendimentos_para_processar:
+                pendentes_entrega = await delivery_service.pending_atendimento_ids(atendimentos_para_processar.keys())
                 logger.info(f"Agente (Ciclo): Disparando {len(atendimentos_para_processar)} tarefa(s) em background.")
                 for at in atendimentos_para_processar.values():
                     if at.id in _active_processing_ids:
                         logger.info(f"Agente (Ciclo): Atendimento {at.id} já está em processamento ativo. Pulando disparo.")
                         continue
+                    # Aguarda a entrega dos balões da rodada anterior para que o histórico lido pela IA esteja completo
+                    if at.id in pendentes_entrega:
+                        logger.info(f"Agente (Ciclo): Atendimento {at.id} ainda possui mensagens em entrega. Adiando para o próximo ciclo.")
+                        continue
                     if at.company:
                         asyncio.create_task(process_single_atendimento(at.id, at.company))
                     else:
@@ -695,3 +647,9 @@ async def run_agent_cycle():
 
         except Exception as cycle_err:
             logger.error(f"Agente (Ciclo): Erro CRÍTICO no loop principal: {cycle_err}", exc_info=True)
+
+    # 3. Retoma entregas pendentes da fila durável (reinício do worker, retentativas com backoff)
+    try:
+        await delivery_service.resume_pending()
+    except Exception as resume_err:
+        logger.error(f"Agente (Ciclo): Erro ao retomar a fila de entrega: {resume_err}", exc_info=True)
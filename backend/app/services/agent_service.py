@@ -1,8 +1,6 @@
 import os
 import logging
 import math
-import asyncio
-import weakref
 from typing import Optional, Literal, Any, Dict, List
 from dataclasses import dataclass
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -22,21 +20,11 @@ from app.db import models
 from app.crud import crud_user
 from app.services.gemini_service import get_gemini_service
 from app.services.google_calendar_service import get_google_calendar_service
+from app.services.google_api_client import get_google_api_client
+from app.services.outbound_delivery_service import get_outbound_delivery_service, OutboundMessage
 
 logger = logging.getLogger(__name__)
 
-# Locks globais para garantir ordem sequencial no envio de mensagens por atendimento
-_atendimento_locks = weakref.WeakValueDictionary()
-_locks_lock = asyncio.Lock()
-
-async def get_atendimento_lock(atendimento_id: int) -> asyncio.Lock:
-    async with _locks_lock:
-        lock = _atendimento_locks.get(atendimento_id)
-        if lock is None:
-            lock = asyncio.Lock()
-            _atendimento_locks[atendimento_id] = lock
-        return lock
-
 # =====================================================================
 # 1. TABELA DE PREÇOS E CONFIGURAÇÃO FINANCEIRA
 # =====================================================================
@@ -317,119 +305,28 @@ async def pesquisar_base_de_dados(
     logger.info(f"[Tool Executada] pesquisar_base_de_dados | termo_busca='{termo_busca}', tipo_busca='{tipo_busca}', categoria_alvo='{categoria_alvo}', quantidade_resultados={limite_real}")
     config_id = ctx.deps.config_id
 
-    from app.db.database import SessionLocal
-    async with SessionLocal() as db:
-        from sqlalchemy import func
-        # LOG DE DIAGNÓSTICO: Verifica se existem registros de KnowledgeVector para esta persona
-        try:
-            count_stmt = select(func.count(models.KnowledgeVector.id)).where(models.KnowledgeVector.config_id == config_id)
-            res_count = await db.execute(count_stmt)
-            total_records = res_count.scalar() or 0
-            logger.info(f"[Diagnóstico Busca] Total de vetores de conhecimento cadastrados para a config_id {config_id}: {total_records}")
-            
-            if total_records > 0 and categoria_alvo:
-                count_cat_stmt = select(func.count(models.KnowledgeVector.id)).where(
-                    models.KnowledgeVector.config_id == config_id,
-                    models.KnowledgeVector.category.ilike(categoria_alvo.strip())
-                )
-                res_cat_count = await db.execute(count_cat_stmt)
-                total_cat_records = res_cat_count.scalar() or 0
-                logger.info(f"[Diagnóstico Busca] Total de vetores mapeados em '{categoria_alvo}' para a config_id {config_id}: {total_cat_records}")
-        except Exception as diag_err:
-            logger.error(f"[Diagnóstico Busca] Erro ao contar vetores de conhecimento: {diag_err}")
+    # O embedding é gerado uma única vez e alimenta o ramo vetorial da busca híbrida (qualquer que seja o tipo_busca)
+    query_embedding = await get_gemini_service().generate_embedding(termo_busca)
+    if not query_embedding:
+        logger.warning("Busca: Não foi possível gerar o embedding no Gemini. Executando apenas o ramo lexical.")
 
-        # Inicia a query filtrando estritamente pela persona atual
-        query = select(models.KnowledgeVector).where(models.KnowledgeVector.config_id == config_id)
-        if categoria_alvo and categoria_alvo.strip():
-            query = query.where(models.KnowledgeVector.category.ilike(categoria_alvo.strip()))
+    # 'texto' privilegia correspondência exata de palavras; 'semantica' privilegia proximidade vetorial
+    pesos = {"lexical_weight": 1.0, "vector_weight": 0.6} if tipo_busca == 'texto' else {"lexical_weight": 0.6, "vector_weight": 1.0}
 
+    from app.db.database import SessionLocal
+    from app.services.retrieval_service import hybrid_search_knowledge
+    async with SessionLocal() as db:
         try:
-            vetores_encontrados = []
-            if tipo_busca == 'texto':
-                logger.info(f"Busca TEXTUAL acionada para: '{termo_busca}' na config {config_id}")
-                
-                # Divisão simples por palavras sem stopwords hardcoded na aplicação
-                termos = [t for t in termo_busca.replace("?", "").replace("!", "").replace(",", "").replace(".", "").split() if len(t) > 1]
-                
-                text_query = query
-                for t in termos:
-                    text_query = text_query.where(models.KnowledgeVector.content.ilike(f"%{t}%"))
-                text_query = text_query.limit(limite_real)
-                
-                result = await db.execute(text_query)
-                vetores_encontrados = result.scalars().all()
-                logger.info(f"Busca TEXTUAL para '{termo_busca}' (categoria: '{categoria_alvo}') retornou {len(vetores_encontrados)} registros.")
-                
-                if not vetores_encontrados:
-                    logger.info(f"Busca TEXTUAL para '{termo_busca}' retornou zero resultados. Iniciando fallback automático para SEMÂNTICA...")
-                    tipo_busca = 'semantica'
-
-            if tipo_busca == 'semantica':
-                logger.info(f"Busca SEMÂNTICA acionada para: '{termo_busca}' na config {config_id}")
-                gemini_svc = get_gemini_service()
-                query_embedding = await gemini_svc.generate_embedding(termo_busca)
-                
-                if not query_embedding:
-                    logger.error("Busca SEMÂNTICA falhou: Não foi possível gerar o vetor/embedding no Gemini.")
-                    return "Erro interno: Não foi possível gerar o vetor para a busca."
-
-                # Para diagnóstico, vamos pesquisar os mais próximos sem threshold de corte primeiro para logar a distância
-                diag_query = select(
-                    models.KnowledgeVector,
-                    models.KnowledgeVector.embedding.cosine_distance(query_embedding).label("distancia")
-                ).where(
-                    models.KnowledgeVector.config_id == config_id
-                )
-                if categoria_alvo and categoria_alvo.strip():
-                    diag_query = diag_query.where(models.KnowledgeVector.category.ilike(categoria_alvo.strip()))
-                
-                diag_query = diag_query.order_by("distancia").limit(3)
-                diag_res = await db.execute(diag_query)
-                proximos = diag_res.all()
-                
-                if proximos:
-                    logger.info(f"Busca SEMÂNTICA - Top 3 distâncias de cosseno para '{termo_busca}':")
-                    for idx, row in enumerate(proximos):
-                        v_item, dist = row
-                        logger.info(f"  {idx+1}. ID: {v_item.id} | Distância: {dist:.4f} | Conteúdo preliminar: {v_item.content[:80]}...")
-                
-                # Busca pgvector real com threshold de similaridade de cosseno < 0.65 e limite_real definido
-                semantic_query = query.where(
-                    models.KnowledgeVector.embedding.cosine_distance(query_embedding) < 0.65
-                ).order_by(
-                    models.KnowledgeVector.embedding.cosine_distance(query_embedding)
-                ).limit(limite_real)
-
-                result = await db.execute(semantic_query)
-                vetores_encontrados = result.scalars().all()
-                logger.info(f"Busca SEMÂNTICA com threshold < 0.65 para '{termo_busca}' (categoria: '{categoria_alvo}') retornou {len(vetores_encontrados)} registros.")
-
-            # Fallback automático: se a busca com categoria_alvo retornou zero resultados, tenta sem o filtro de categoria
-            if not vetores_encontrados and categoria_alvo:
-                logger.info(f"Busca com categoria_alvo='{categoria_alvo}' retornou zero resultados. Executando fallback automático sem filtro de categoria...")
-                fallback_query = select(models.KnowledgeVector).where(models.KnowledgeVector.config_id == config_id)
-                
-                termos = [t for t in termo_busca.replace("?", "").replace("!", "").replace(",", "").replace(".", "").split() if len(t) > 1]
-                if termos:
-                    fb_text = fallback_query
-                    for t in termos:
-                        fb_text = fb_text.where(models.KnowledgeVector.content.ilike(f"%{t}%"))
-                    fb_text = fb_text.limit(limite_real)
-                    res_fb = await db.execute(fb_text)
-                    vetores_encontrados = res_fb.scalars().all()
-                
-                if not vetores_encontrados:
-                    gemini_svc = get_gemini_service()
-                    query_embedding_fb = await gemini_svc.generate_embedding(termo_busca)
-                    if query_embedding_fb:
-                        fb_semantic = fallback_query.where(
-                            models.KnowledgeVector.embedding.cosine_distance(query_embedding_fb) < 0.65
-                        ).order_by(
-                            models.KnowledgeVector.embedding.cosine_distance(query_embedding_fb)
-                        ).limit(limite_real)
-                        res_fb = await db.execute(fb_semantic)
-                        vetores_encontrados = res_fb.scalars().all()
-                        logger.info(f"Fallback semântico sem categoria retornou {len(vetores_encontrados)} registros.")
+            hits = await hybrid_search_knowledge(
+                db,
+                config_id=config_id,
+                termo_busca=termo_busca,
+                query_embedding=query_embedding,
+                categoria=categoria_alvo,
+                limit=limite_real,
+                **pesos
+            )
+            vetores_encontrados = [h.vector for h in hits]
 
             if not vetores_encontrados:
                 return "Nenhum resultado encontrado para esta busca na base de dados."
@@ -550,8 +447,7 @@ async def consultar_agenda_google(ctx: RunContext[ContextoSaaS], data_desejada:
 
         cal_service = get_google_calendar_service(persona_config)
         
-        events = await asyncio.to_thread(
-            cal_service.get_upcoming_events, 
+        events = await cal_service.get_upcoming_events(
             max_results=50, 
             time_min=start_dt.isoformat(), 
             time_max=end_dt.isoformat()
@@ -619,30 +515,33 @@ async def agendar_reuniao(
 
     try:
         calendar_service = get_google_calendar_service(persona_config)
-        service = calendar_service.get_service()
+        google_api = get_google_api_client()
+        service = await google_api.run("calendar", calendar_service.get_service)
         
         # --- Cancelar agendamentos anteriores deste contato ---
         try:
             now_iso = datetime.now(timezone.utc).isoformat()
-            existing_events = await asyncio.to_thread(
-                lambda: service.events().list(
+            existing_events = (await google_api.execute(
+                service.events().list(
                     calendarId='primary',
                     timeMin=now_iso,
                     q=atendimento.whatsapp,
                     singleEvents=True,
                     orderBy='startTime'
-                ).execute().get('items', [])
-            )
+                ),
+                "calendar"
+            )).get('items', [])
 
             for old_event in existing_events:
                 if old_event.get('description') and f"WhatsApp: {atendimento.whatsapp}" in old_event.get('description'):
                     logger.info(f"Agente: Cancelando evento anterior {old_event.get('id')} para reagendamento.")
-                    await asyncio.to_thread(
-                        lambda: service.events().delete(
+                    await google_api.execute(
+                        service.events().delete(
                             calendarId='primary', 
                             eventId=old_event.get('id'), 
                             sendUpdates='all'
-                        ).execute()
+                        ),
+                        "calendar"
                     )
         except Exception as cancel_err:
             logger.warning(f"Agente: Erro ao cancelar agendamentos anteriores: {cancel_err}")
@@ -670,13 +569,14 @@ async def agendar_reuniao(
 
         meeting_link = None
         try:
-            event = await asyncio.to_thread(
-                lambda: service.events().insert(
+            event = await google_api.execute(
+                service.events().insert(
                     calendarId='primary', 
                     body=event_body, 
                     conferenceDataVersion=1, 
                     sendUpdates='all'
-                ).execute()
+                ),
+                "calendar"
             )
             meeting_link = event.get('hangoutLink')
             logger.info(f"Agente: Reunião agendada com sucesso! Link: {meeting_link}")
@@ -685,12 +585,13 @@ async def agendar_reuniao(
             if 'conferenceData' in event_body:
                 del event_body['conferenceData']
             try:
-                event = await asyncio.to_thread(
-                    lambda: service.events().insert(
+                event = await google_api.execute(
+                    service.events().insert(
                         calendarId='primary', 
                         body=event_body, 
                         sendUpdates='all'
-                    ).execute()
+                    ),
+                    "calendar"
                 )
                 logger.info(f"Agente: Reunião agendada (sem link Meet) com sucesso!")
             except Exception as fallback_err:
@@ -742,55 +643,19 @@ async def enviar_mensagem_texto(ctx: RunContext[ContextoSaaS], texto: str) -> st
     if not partes:
         return "Erro: O texto da mensagem está vazio."
 
-    lock = await get_atendimento_lock(ctx.deps.atendimento_id)
-    async with lock:
-        for idx, parte in enumerate(partes):
-            # Simulação realista de digitação para cada balão
-            import random
-            import asyncio
-            chars_per_sec = random.uniform(0.10, 0.20)
-            typing_delay = min(max(len(parte) * chars_per_sec, 2.5), 15.0)
-            
-            logger.info(f"IA simulando digitação por {typing_delay:.1f}s antes de enviar: {parte}")
-            await asyncio.sleep(typing_delay)
+    # Os balões entram na fila de entrega da conversa; a cadência de digitação e o envio
+    # acontecem na task de entrega, liberando a rodada do agente imediatamente.
+    delivery = get_outbound_delivery_service()
+    for parte in partes:
+        await delivery.enqueue(OutboundMessage(
+            kind="text",
+            company=ctx.deps.empresa,
+            atendimento_id=ctx.deps.atendimento_id,
+            number=ctx.deps.atendimento.whatsapp,
+            text=parte
+        ))
 
-            try:
-                # Envia via WhatsApp real (fora da transação de banco)
-                await ctx.deps.whatsapp_service.send_text_message(
-                    company=ctx.deps.empresa,
-                    number=ctx.deps.atendimento.whatsapp,
-                    text=parte
-                )
-                
-                # Registra no histórico do banco instantaneamente em transação curta
-                from app.db.database import SessionLocal
-                from datetime import datetime
-                import json
-                
-                async with SessionLocal() as db_write:
-                    async with db_write.begin():
-                        at = await db_write.get(models.Atendimento, ctx.deps.atendimento_id, with_for_update=True)
-                        if at:
-                            historico_db = json.loads(at.conversa or "[]")
-                            nova_msg = {
-                                "id": f"ai_{int(datetime.now().timestamp())}_{random.randint(100, 999)}",
-                                "role": "assistant",
-                                "content": parte,
-                                "timestamp": int(datetime.now().timestamp()),
-                                "is_ai": True
-                            }
-                            historico_db.append(nova_msg)
-                            at.conversa = json.dumps(historico_db, ensure_ascii=False)
-                            db_write.add(at)
-                            
-                            # Atualiza em memória
-                            ctx.deps.atendimento.conversa = at.conversa
-
-            except Exception as e:
-                logger.error(f"Erro ao enviar parte da mensagem na tool (parte {idx}): {e}", exc_info=True)
-                return f"Erro ao enviar a mensagem: {str(e)}"
-        
-        return "Mensagens enviadas e salvas com sucesso."
+    return "Mensagens enfileiradas e serão entregues ao cliente na ordem enviada."
 
 
 @agente_atendimento.tool
@@ -816,69 +681,17 @@ async def enviar_mensagem_audio(ctx: RunContext[ContextoSaaS], texto: str) -> st
     if not partes:
         return "Erro: O texto da mensagem está vazio."
 
-    lock = await get_atendimento_lock(ctx.deps.atendimento_id)
-    async with lock:
-        gemini_svc = get_gemini_service()
-        for idx, parte in enumerate(partes):
-            import random
-            import asyncio
-            chars_per_sec = random.uniform(0.08, 0.15)
-            recording_delay = min(max(len(parte) * chars_per_sec, 2.0), 12.0)
-            
-            logger.info(f"IA simulando gravação de áudio por {recording_delay:.1f}s antes de enviar...")
-            await asyncio.sleep(recording_delay)
+    delivery = get_outbound_delivery_service()
+    for parte in partes:
+        await delivery.enqueue(OutboundMessage(
+            kind="audio",
+            company=ctx.deps.empresa,
+            atendimento_id=ctx.deps.atendimento_id,
+            number=ctx.deps.atendimento.whatsapp,
+            text=parte
+        ))
 
-            try:
-                # 1. Gera áudio via Gemini TTS em transação isolada
-                from app.db.database import SessionLocal
-                async with SessionLocal() as db_tts:
-                    audio_bytes = await gemini_svc.generate_tts(
-                        text=parte,
-                        db=db_tts,
-                        company=ctx.deps.empresa,
-                        atendimento_id=ctx.deps.atendimento_id
-                    )
-
-                # 2. Envia via WhatsApp (Rede externa)
-                sent_info = await ctx.deps.whatsapp_service.send_media_message(
-                    company=ctx.deps.empresa,
-                    number=ctx.deps.atendimento.whatsapp,
-                    media_type="audio",
-                    file_bytes=audio_bytes,
-                    filename="audio.wav",
-                    mimetype="audio/wav"
-                )
-                
-                # 3. Salva no banco de dados na transação curta
-                from datetime import datetime
-                import json
-                
-                async with SessionLocal() as db_write:
-                    async with db_write.begin():
-                        at = await db_write.get(models.Atendimento, ctx.deps.atendimento_id, with_for_update=True)
-                        if at:
-                            historico_db = json.loads(at.conversa or "[]")
-                            nova_msg = {
-                                "id": sent_info.get("id") or f"audio_{int(datetime.now().timestamp())}_{random.randint(100, 999)}",
-                                "role": "assistant",
-                                "content": parte,
-                                "timestamp": int(datetime.now().timestamp()),
-                                "type": "audio",
-                                "media_id": sent_info.get("media_id") or None,
-                                "filename": "audio.wav",
-                                "is_ai": True
-                            }
-                            historico_db.append(nova_msg)
-                            at.conversa = json.dumps(historico_db, ensure_ascii=False)
-                            db_write.add(at)
-                            
-                            ctx.deps.atendimento.conversa = at.conversa
-                            
-            except Exception as e:
-                logger.error(f"Erro ao enviar parte do áudio na tool (parte {idx}): {e}", exc_info=True)
-                return f"Erro ao enviar o áudio: {str(e)}"
-        
-        return "Áudios gerados, enviados e salvos com sucesso."
+    return "Áudios enfileirados; serão gerados e entregues ao cliente na ordem enviada."
 
 
 @agente_atendimento.tool
@@ -897,9 +710,6 @@ async def enviar_arquivo_do_drive(
     if not ctx.deps.whatsapp_service or not ctx.deps.atendimento or not ctx.deps.empresa:
         return "Erro: O serviço de mensagens ou dados da empresa não está disponível neste contexto."
 
-    from app.services.google_drive_service import get_drive_service
-    import asyncio
-    
     from app.core.config import settings
     if not settings.GOOGLE_SERVICE_ACCOUNT_JSON:
         return "Erro: Google Drive não está configurado ou autenticado no servidor."
@@ -907,12 +717,6 @@ async def enviar_arquivo_do_drive(
     logger.info(f"[Tool Executada] enviar_arquivo_do_drive | id_arquivo='{id_arquivo}', legenda='{legenda}'")
 
     try:
-        drive_service = get_drive_service()
-        
-        file_bytes = await asyncio.to_thread(drive_service.download_file_bytes, id_arquivo)
-        if not file_bytes:
-            return f"Erro: Não foi possível obter os bytes do arquivo '{id_arquivo}' no Google Drive."
-            
         filename = "arquivo"
         media_type = "document"
         mimetype = "application/octet-stream"
@@ -946,48 +750,26 @@ async def enviar_arquivo_do_drive(
                     elif "audio" in mimetype:
                         media_type = "audio"
 
-        logger.info(f"[enviar_arquivo_do_drive] Arquivo: '{filename}' | Categoria Banco: '{kv_record.category if kv_record else 'N/A'}' | media_type resolvido: '{media_type}' | mimetype: '{mimetype}' | legenda: '{str(legenda)[:80]}'")
-
-        lock = await get_atendimento_lock(ctx.deps.atendimento_id)
-        async with lock:
-            sent_info = await ctx.deps.whatsapp_service.send_media_message(
-                company=ctx.deps.empresa,
-                number=ctx.deps.atendimento.whatsapp,
-                media_type=media_type,
-                file_bytes=file_bytes,
-                filename=filename,
-                mimetype=mimetype,
-                caption=legenda
-            )
-            
-            from datetime import datetime
-            import json
-            
-            async with SessionLocal() as db_write:
-                async with db_write.begin():
-                    at = await db_write.get(models.Atendimento, ctx.deps.atendimento_id, with_for_update=True)
-                    if at:
-                        historico_db = json.loads(at.conversa or "[]")
-                        nova_msg = {
-                            "id": sent_info.get("id") or f"media_{int(datetime.now().timestamp())}",
-                            "role": "assistant",
-                            "content": f"[Arquivo Enviado: {filename}]",
-                            "timestamp": int(datetime.now().timestamp()),
-                            "type": media_type,
-                            "media_id": sent_info.get("media_id") or id_arquivo,
-                            "filename": filename,
-                            "caption": legenda or None,
-                            "is_ai": True
-                        }
-                        historico_db.append(nova_msg)
-                        at.conversa = json.dumps(historico_db, ensure_ascii=False)
-                        db_write.add(at)
-                        
-                        ctx.deps.atendimento.conversa = at.conversa
-            
-            return f"Arquivo '{filename}' enviado com sucesso para o cliente."
+        if not kv_record:
+            return f"Erro: O arquivo '{id_arquivo}' não existe na base de conhecimento desta persona. Use apenas IDs retornados por `pesquisar_base_de_dados`."
+
+        logger.info(f"[enviar_arquivo_do_drive] Arquivo: '{filename}' | Categoria Banco: '{kv_record.category}' | media_type resolvido: '{media_type}' | mimetype: '{mimetype}' | legenda: '{str(legenda)[:80]}'")
+
+        # O download e o envio ocorrem na fila de entrega da conversa, preservando a ordem com os balões de texto
+        await get_outbound_delivery_service().enqueue(OutboundMessage(
+            kind="drive",
+            company=ctx.deps.empresa,
+            atendimento_id=ctx.deps.atendimento_id,
+            number=ctx.deps.atendimento.whatsapp,
+            drive_file_id=id_arquivo,
+            filename=filename,
+            media_type=media_type,
+            mimetype=mimetype,
+            caption=legenda
+        ))
+        return f"Arquivo '{filename}' enfileirado e será entregue ao cliente na ordem enviada."
     except Exception as e:
-        logger.error(f"Erro ao enviar arquivo do Drive via tool: {e}", exc_info=True)
+        logger.error(f"Erro ao enfileirar arquivo do Drive via tool: {e}", exc_info=True)
         return f"Erro ao enviar o arquivo do Drive: {str(e)}"
 
 
@@ -1161,15 +943,16 @@ async def contabilizar_tokens_pydantic(
             from app.db.database import SessionLocal
             async with SessionLocal() as db_write:
                 async with db_write.begin():
-                    comp = await db_write.get(models.Company, empresa_model.id)
-                    if comp:
-                        await crud_user.decrement_company_tokens(
-                            db_write,
-                            db_company=comp,
-                            usage=tokens_para_deduzir,
-                            atendimento_id=ctx.atendimento_id,
-                            token_type="gemini_inference"
-                        )
+                    await crud_user.record_token_usage(
+                        db_write,
+                        company_id=empresa_model.id,
+                        usage=tokens_para_deduzir,
+                        atendimento_id=ctx.atendimento_id,
+                        token_type="gemini_inference",
+                        model=nome_modelo_limpo,
+                        input_tokens=input_tokens,
+                        output_tokens=output_tokens
+                    )
     except Exception as e:
         logger.error(f"Falha ao deduzir tokens da empresa {ctx.company_id}: {e}", exc_info=True)
 
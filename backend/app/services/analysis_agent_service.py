@@ -198,6 +198,8 @@ async def buscar_dados_atendimentos(
     )
 
     if query_embedding:
+        from app.services.vector_index_service import apply_vector_search_settings
+        await apply_vector_search_settings(db)
         stmt = stmt.order_by(models.AtendimentoMessageSearch.embedding.cosine_distance(query_embedding).asc())
     else:
         stmt = stmt.order_by(models.AtendimentoMessageSearch.message_date.desc())
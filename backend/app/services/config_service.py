@@ -1,6 +1,7 @@
 # app/services/config_service.py
 
 # 1. Importações nativas/padrão do Python
+import hashlib
 import logging
 import os
 import json
@@ -11,7 +12,7 @@ from typing import List, Dict, Any, Optional
 # 2. Importações de terceiros
 import httpx
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import delete, select, or_
+from sqlalchemy import delete, select, update, or_
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 
@@ -21,9 +22,12 @@ from app.db import models, schemas
 from app.db.database import SessionLocal
 from app.crud import crud_config, crud_user, crud_atendimento
 from app.services.google_sheets_service import GoogleSheetsService
-from app.services.google_drive_service import get_drive_service
+from app.services.google_drive_service import get_drive_service, DriveChangesTokenExpired, FOLDER_MIME_TYPE
 from app.services.google_calendar_service import get_google_calendar_service
+from app.services.google_api_client import get_google_api_client
 from app.services.gemini_service import GeminiService, get_gemini_service
+from app.services.embedding_executor import EmbeddingProgress, ProgressCallback
+from app.services.sync_job_service import enqueue_sync_job
 
 logger = logging.getLogger(__name__)
 
@@ -93,7 +97,7 @@ class ConfigService:
             
             logger.info(f"setup_drive_watch: Registrando watch para o ID '{resource_id}' (tipo: {resource_type}) na URL: {webhook_url}")
             
-            drive_service.watch_file(
+            await drive_service.watch_file(
                 file_id=resource_id, 
                 channel_id=channel_id, 
                 webhook_url=webhook_url,
@@ -226,6 +230,54 @@ class ConfigService:
             return ""
         return f"# {sheet_name}\n" + "\n".join(kv_lines)
 
+    @staticmethod
+    def build_drive_item(f: Dict[str, Any], folder_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Monta o item da base de conhecimento correspondente a um arquivo do Google Drive.
+
+        @param f: Arquivo no formato da árvore do Drive (nome, id, tipo, mimeType...).
+        @param folder_path: Caminho das pastas até o arquivo ("Raiz > Sub").
+        @returns: Dicionário com content, category e raw_data (ou None se não houver dados).
+        """
+        file_name = f.get('nome') or ""
+        file_path = f"{folder_path} > {file_name}" if folder_path else file_name
+        
+        row_data = {
+            "Arquivo": file_path,
+            "Tipo": f.get('tipo'),
+            "ID": f.get('id')
+        }
+        
+        clean_row = {str(k).strip(): v for k, v in row_data.items() if v is not None and str(v).strip() != ""}
+        if not clean_row:
+            return None
+
+        content_parts = [f"{key}: {val}" for key, val in clean_row.items()]
+        content = " | ".join(content_parts)
+        
+        tipo = (f.get('tipo') or '').lower()
+        if 'imagem' in tipo:
+            category = 'image'
+        elif 'vídeo' in tipo or 'video' in tipo:
+            category = 'video'
+        elif 'áudio' in tipo or 'audio' in tipo:
+            category = 'audio'
+        else:
+            category = 'document'
+            
+        raw_data = {
+            "id_arquivo": f.get('id'),
+            "nome_exato": file_name,
+            "mime_type": f.get('mimeType'),
+            "tipo": f.get('tipo')
+        }
+        
+        return {
+            "content": content,
+            "category": category,
+            "raw_data": raw_data
+        }
+
     @staticmethod
     def flatten_drive_tree(node: Dict[str, Any], path: str = "") -> List[Dict[str, Any]]:
         """
@@ -240,48 +292,162 @@ class ConfigService:
         current_path = f"{path} > {current_name}" if path else current_name
         
         for f in node.get("arquivos", []):
-            file_name = f.get('nome') or ""
-            file_path = f"{current_path} > {file_name}" if current_path else file_name
-            
-            row_data = {
-                "Arquivo": file_path,
-                "Tipo": f.get('tipo'),
-                "ID": f.get('id')
-            }
-            
-            clean_row = {str(k).strip(): v for k, v in row_data.items() if v is not None and str(v).strip() != ""}
-            if clean_row:
-                content_parts = [f"{key}: {val}" for key, val in clean_row.items()]
-                content = " | ".join(content_parts)
-                
-                tipo = (f.get('tipo') or '').lower()
-                if 'imagem' in tipo:
-                    category = 'image'
-                elif 'vídeo' in tipo or 'video' in tipo:
-                    category = 'video'
-                elif 'áudio' in tipo or 'audio' in tipo:
-                    category = 'audio'
-                else:
-                    category = 'document'
-                    
-                raw_data = {
-                    "id_arquivo": f.get('id'),
-                    "nome_exato": file_name,
-                    "mime_type": f.get('mimeType'),
-                    "tipo": f.get('tipo')
-                }
-                
-                results.append({
-                    "content": content,
-                    "category": category,
-                    "raw_data": raw_data
-                })
+            item = ConfigService.build_drive_item(f, current_path)
+            if item:
+                results.append(item)
             
         for sub in node.get("subpastas", []):
             results.extend(ConfigService.flatten_drive_tree(sub, current_path))
             
         return results
 
+    @staticmethod
+    def compute_row_checksum(category: str, content: str) -> str:
+        """
+        Gera o hash MD5 que identifica o conteúdo de uma linha/arquivo da base de conhecimento.
+
+        @param category: Categoria (aba ou tipo de mídia).
+        @param content: Texto indexado.
+        @returns: Hash hexadecimal.
+        """
+        return hashlib.md5(f"{category}\n{content}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def embedding_progress_logger(label: str) -> ProgressCallback:
+        """
+        Callback de progresso padrão das sincronizações: registra no log a cada 10% vetorizado.
+
+        @param label: Identificação da sincronização no log.
+        @returns: Função compatível com EmbeddingBatchExecutor.
+        """
+        ultimo_passo = {"valor": -1}
+
+        def log_progress(progress: EmbeddingProgress) -> None:
+            passo = (progress.completed + progress.failed) * 10 // max(progress.total, 1)
+            if passo > ultimo_passo["valor"]:
+                ultimo_passo["valor"] = passo
+                logger.info(
+                    f"Sync {label}: {progress.completed}/{progress.total} embeddings gerados"
+                    + (f" ({progress.failed} com falha)" if progress.failed else "")
+                )
+        return log_progress
+
+    @staticmethod
+    async def apply_knowledge_diff(
+        db: AsyncSession,
+        config_id: int,
+        origin: str,
+        items: List[Dict[str, Any]],
+        replace_origins: Optional[List[str]] = None,
+        on_progress: Optional[ProgressCallback] = None,
+        keep_missing: bool = False
+    ) -> Dict[str, int]:
+        """
+        Sincroniza incrementalmente os vetores de uma origem com a lista atual de itens.
+
+        Cada item é identificado pelo checksum de categoria + conteúdo: itens inalterados são mantidos,
+        apenas os novos/alterados são vetorizados, e os removidos são apagados. Linhas alteradas reaproveitam
+        o registro de uma linha removida da mesma categoria. Tudo é gravado em um único commit, para que
+        o agente nunca veja a base pela metade.
+
+        @param db: Sessão do banco de dados (o commit é feito aqui).
+        @param config_id: ID da configuração.
+        @param origin: Origem gravada nos vetores ('sheet', 'drive').
+        @param items: Itens atuais com 'content', 'category' e 'raw_data'.
+        @param replace_origins: Origens existentes consideradas na comparação (padrão: apenas 'origin').
+        @param on_progress: Callback de progresso da vetorização (ver EmbeddingBatchExecutor).
+        @param keep_missing: Lista incompleta (ex: varredura truncada): vetores ausentes da lista não são apagados
+                             nem reaproveitados; os itens novos/alterados são apenas adicionados.
+        @returns: Contagens 'items', 'added', 'changed', 'removed' e 'unchanged'.
+        """
+        kv = models.KnowledgeVector
+        origins = replace_origins or [origin]
+        result = await db.execute(
+            select(kv.id, kv.category, kv.content, kv.row_checksum, kv.origin)
+            .where(kv.config_id == config_id, kv.origin.in_(origins))
+        )
+
+        existing_by_checksum: Dict[str, List[int]] = {}
+        category_by_id: Dict[int, str] = {}
+        legacy_checksums: Dict[int, str] = {}
+        for row in result.all():
+            checksum = row.row_checksum or ConfigService.compute_row_checksum(row.category, row.content)
+            if not row.row_checksum or row.origin != origin:
+                legacy_checksums[row.id] = checksum
+            existing_by_checksum.setdefault(checksum, []).append(row.id)
+            category_by_id[row.id] = row.category
+
+        unchanged = 0
+        kept_legacy = []
+        to_embed = []
+        for item in items:
+            checksum = ConfigService.compute_row_checksum(item["category"], item["content"])
+            ids = existing_by_checksum.get(checksum)
+            if ids:
+                kept_id = ids.pop()
+                unchanged += 1
+                if kept_id in legacy_checksums:
+                    kept_legacy.append({"id": kept_id, "row_checksum": legacy_checksums[kept_id], "origin": origin})
+                continue
+            to_embed.append({**item, "row_checksum": checksum})
+
+        # Linhas que sumiram, agrupadas por categoria para serem reaproveitadas pelas linhas alteradas
+        removed_pool: Dict[str, List[int]] = {}
+        if not keep_missing:
+            for ids in existing_by_checksum.values():
+                for vid in ids:
+                    removed_pool.setdefault(category_by_id[vid], []).append(vid)
+
+        embeddings = []
+        if to_embed:
+            embeddings = await get_gemini_service().generate_embeddings_batch([i["content"] for i in to_embed], on_progress=on_progress)
+
+        added = changed = 0
+        updates = []
+        for item, embedding in zip(to_embed, embeddings):
+            if not embedding:
+                continue
+            pool = removed_pool.get(item["category"])
+            if pool:
+                updates.append({
+                    "id": pool.pop(),
+                    "content": item["content"],
+                    "raw_data": item["raw_data"],
+                    "embedding": embedding,
+                    "row_checksum": item["row_checksum"],
+                    "origin": origin
+                })
+                changed += 1
+            else:
+                db.add(kv(
+                    config_id=config_id,
+                    content=item["content"],
+                    origin=origin,
+                    category=item["category"],
+                    raw_data=item["raw_data"],
+                    embedding=embedding,
+                    row_checksum=item["row_checksum"]
+                ))
+                added += 1
+
+        removed_ids = [vid for ids in removed_pool.values() for vid in ids]
+        # UPDATE em lote por chave primária (executemany); cada lista tem o mesmo conjunto de colunas
+        if kept_legacy:
+            await db.execute(update(kv), kept_legacy)
+        if updates:
+            await db.execute(update(kv), updates)
+        for i in range(0, len(removed_ids), 1000):
+            await db.execute(delete(kv).where(kv.id.in_(removed_ids[i:i + 1000])))
+
+        await db.commit()
+        return {
+            "items": unchanged + added + changed,
+            "added": added,
+            "changed": changed,
+            "removed": len(removed_ids),
+            "unchanged": unchanged
+        }
+
     @staticmethod
     async def create_config(
         db: AsyncSession,
@@ -473,6 +639,7 @@ class ConfigService:
         user_creds = Credentials(token_data['access_token'])
         user_drive_service = build('drive', 'v3', credentials=user_creds)
         drive_service = get_drive_service()
+        google_api = get_google_api_client()
         
         service_account_email = "integracaoapi@integracaoapi-436218.iam.gserviceaccount.com"
         try:
@@ -494,12 +661,16 @@ class ConfigService:
                     
                 try:
                     perm = {'type': 'user', 'role': 'reader', 'emailAddress': user_email}
-                    drive_service.service.permissions().create(fileId=BASE_SYSTEM_SHEET_ID, body=perm, sendNotificationEmail=False).execute()
+                    await google_api.execute(
+                        drive_service.service.permissions().create(fileId=BASE_SYSTEM_SHEET_ID, body=perm, sendNotificationEmail=False), "drive"
+                    )
                 except Exception as e:
                     logger.warning(f"Não foi possível dar permissão de leitura prévia no template base: {e}")
                     
                 body = {'name': f"Instruções IA - {db_config.nome_config}"}
-                new_file = user_drive_service.files().copy(fileId=BASE_SYSTEM_SHEET_ID, body=body, supportsAllDrives=True).execute()
+                new_file = await google_api.execute(
+                    user_drive_service.files().copy(fileId=BASE_SYSTEM_SHEET_ID, body=body, supportsAllDrives=True), "drive"
+                )
                 new_id = new_file.get('id')
                 db_config.spreadsheet_id = new_id
                 
@@ -509,18 +680,22 @@ class ConfigService:
                     
                 try:
                     perm = {'type': 'user', 'role': 'reader', 'emailAddress': user_email}
-                    drive_service.service.permissions().create(fileId=BASE_RAG_SHEET_ID, body=perm, sendNotificationEmail=False).execute()
+                    await google_api.execute(
+                        drive_service.service.permissions().create(fileId=BASE_RAG_SHEET_ID, body=perm, sendNotificationEmail=False), "drive"
+                    )
                 except Exception as e:
                     logger.warning(f"Não foi possível dar permissão de leitura prévia no template base: {e}")
                     
                 body = {'name': f"Conhecimento IA - {db_config.nome_config}"}
-                new_file = user_drive_service.files().copy(fileId=BASE_RAG_SHEET_ID, body=body, supportsAllDrives=True).execute()
+                new_file = await google_api.execute(
+                    user_drive_service.files().copy(fileId=BASE_RAG_SHEET_ID, body=body, supportsAllDrives=True), "drive"
+                )
                 new_id = new_file.get('id')
                 db_config.spreadsheet_rag_id = new_id
                 
             elif payload.resource_type == "drive":
                 file_metadata = {'name': f"Arquivos IA - {db_config.nome_config}", 'mimeType': 'application/vnd.google-apps.folder'}
-                folder = user_drive_service.files().create(body=file_metadata, fields='id').execute()
+                folder = await google_api.execute(user_drive_service.files().create(body=file_metadata, fields='id'), "drive")
                 new_id = folder.get('id')
                 db_config.drive_id = new_id
             else:
@@ -529,7 +704,9 @@ class ConfigService:
             for email in emails_to_share:
                 if email and "@" in email:
                     perm = {'type': 'user', 'role': 'writer', 'emailAddress': email.strip()}
-                    user_drive_service.permissions().create(fileId=new_id, body=perm, sendNotificationEmail=False).execute()
+                    await google_api.execute(
+                        user_drive_service.permissions().create(fileId=new_id, body=perm, sendNotificationEmail=False), "drive"
+                    )
 
             db.add(db_config)
             await db.commit()
@@ -542,15 +719,23 @@ class ConfigService:
             raise e
 
     @staticmethod
-    async def run_sync_sheet(config_id: int, company_id: int, spreadsheet_id: str, sync_type: str) -> int:
+    async def run_sync_sheet(
+        config_id: int,
+        company_id: int,
+        spreadsheet_id: str,
+        sync_type: str,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> Dict[str, int]:
         """
         Lê planilhas e gera contexto/vetores no banco de dados.
+        No modo 'rag' a sincronização é incremental: apenas linhas novas/alteradas são vetorizadas.
 
         @param config_id: ID da configuração.
         @param company_id: ID da empresa associada.
         @param spreadsheet_id: ID da planilha no Google.
         @param sync_type: Tipo de sincronização ('system' ou 'rag').
-        @returns: O número total de itens processados.
+        @param on_progress: Callback de progresso da vetorização (padrão: log a cada 10%).
+        @returns: Relatório com 'items' (total processado) e, no modo 'rag', 'added', 'changed', 'removed' e 'unchanged'.
         """
         logger.info(f"Iniciando sincronização de Planilha (Config: {config_id}, Empresa: {company_id}, Tipo: {sync_type})")
         
@@ -562,68 +747,44 @@ class ConfigService:
                     raise Exception("Configuração não encontrada.")
 
                 sheets_service = GoogleSheetsService()
-                gemini_service = get_gemini_service()
-                sheet_data_json = await sheets_service.get_sheet_as_json(spreadsheet_id)
-                
                 prompt_buffer = []
-                contextos_buffer = []
                 itens_processados = 0
 
+                # A sync é disparada por alteração na planilha: os nomes das abas são relidos (e o cache atualizado)
                 if sync_type == "system":
+                    sheet_data_json = await sheets_service.get_sheet_as_json(spreadsheet_id, refresh_metadata=True)
                     for sheet_name, rows in sheet_data_json.items():
                         csv_section = ConfigService.format_sheet_to_csv_system(sheet_name, rows)
                         if csv_section:
                             prompt_buffer.append(csv_section)
                             itens_processados += 1
                     db_config.prompt = "\n\n".join(prompt_buffer)
-
-                elif sync_type == "rag":
-                    rag_items = []
-                    for sheet_name, rows in sheet_data_json.items():
-                        for row in rows:
-                            clean_row = {str(k).strip(): v for k, v in row.items() if v is not None and str(v).strip() != ""}
-                            if not clean_row:
-                                continue
-                            
-                            content_parts = [f"{key}: {val}" for key, val in clean_row.items()]
-                            content_str = " | ".join(content_parts)
-                            
-                            if content_str:
-                                rag_items.append({
-                                    "content": content_str,
-                                    "category": sheet_name,
-                                    "raw_data": clean_row
-                                })
+                    db.add(db_config)
+                    await db.commit()
+                    logger.info(f"Sincronização de Planilha ({sync_type}) finalizada com sucesso! Itens: {itens_processados}")
+                    return {"items": itens_processados}
+
+                rag_items = []
+                async for sheet_name, clean_row in sheets_service.iter_knowledge_rows(spreadsheet_id, refresh_metadata=True):
+                    content_parts = [f"{key}: {val}" for key, val in clean_row.items()]
+                    content_str = " | ".join(content_parts)
                     
-                    if rag_items:
-                        lines_to_embed = [item["content"] for item in rag_items]
-                        embeddings = await gemini_service.generate_embeddings_batch(lines_to_embed)
-                        
-                        for item, embedding in zip(rag_items, embeddings):
-                            if embedding:
-                                contextos_buffer.append(models.KnowledgeVector(
-                                    config_id=db_config.id,
-                                    content=item["content"],
-                                    origin="sheet",
-                                    category=item["category"],
-                                    raw_data=item["raw_data"],
-                                    embedding=embedding
-                                ))
-                                contexts_buffer = contextos_buffer # placeholder
-                                itens_processados += 1
-                    
-                    await db.execute(delete(models.KnowledgeVector).where(
-                        models.KnowledgeVector.config_id == db_config.id,
-                        models.KnowledgeVector.origin != "drive"
-                    ))
-                    
-                    if contextos_buffer:
-                        db.add_all(contextos_buffer)
-                
-                db.add(db_config)
-                await db.commit()
-                logger.info(f"Sincronização de Planilha ({sync_type}) finalizada com sucesso! Itens: {itens_processados}")
-                return itens_processados
+                    if content_str:
+                        rag_items.append({
+                            "content": content_str,
+                            "category": sheet_name,
+                            "raw_data": clean_row
+                        })
+
+                report = await ConfigService.apply_knowledge_diff(
+                    db, db_config.id, "sheet", rag_items,
+                    on_progress=on_progress or ConfigService.embedding_progress_logger(f"Planilha (Config: {config_id})")
+                )
+                logger.info(
+                    f"Sincronização de Planilha ({sync_type}) finalizada com sucesso! Itens: {report['items']} "
+                    f"(novos: {report['added']}, alterados: {report['changed']}, removidos: {report['removed']}, inalterados: {report['unchanged']})"
+                )
+                return report
 
             except Exception as e:
                 logger.error(f"Erro na sincronização da Planilha: {e}", exc_info=True)
@@ -637,16 +798,16 @@ class ConfigService:
         config_id: int,
         spreadsheet_id: Optional[str],
         sync_type: str
-    ) -> int:
+    ) -> models.SyncJob:
         """
-        Salva o link da planilha (se fornecido) e executa o processo de sincronização.
+        Salva o link da planilha (se fornecido) e enfileira a sincronização para o worker.
 
         @param db: Sessão do banco de dados.
         @param company_id: ID da empresa.
         @param config_id: ID da configuração.
         @param spreadsheet_id: ID da planilha (opcional).
         @param sync_type: Tipo de sincronização ('system' ou 'rag').
-        @returns: O número de itens processados.
+        @returns: Job de sincronização (o relatório fica em job.report ao concluir).
         """
         db_config = await crud_config.get_config(db=db, config_id=config_id, company_id=company_id)
         if not db_config:
@@ -664,60 +825,114 @@ class ConfigService:
         if not final_spreadsheet_id:
             raise ConfigValidationError(f"Nenhum link de planilha ({sync_type}) associado. Salve o link primeiro.")
 
-        itens_processados = await ConfigService.run_sync_sheet(config_id, company_id, final_spreadsheet_id, sync_type)
-        await ConfigService.setup_drive_watch(config_id, final_spreadsheet_id, sync_type)
-        return itens_processados
+        # O worker re-registra o watch ao concluir pedidos manuais
+        return await enqueue_sync_job(db, config_id, company_id, sync_type, final_spreadsheet_id)
+
+    @staticmethod
+    def _is_relevant_drive_change(change: Dict[str, Any], folder_ids: set, file_ids: set) -> bool:
+        """Indica se uma mudança da Changes API afeta a árvore da pasta sincronizada."""
+        file_id = change.get("fileId")
+        if file_id in folder_ids or file_id in file_ids:
+            return True
+        parents = (change.get("file") or {}).get("parents") or []
+        return any(p in folder_ids for p in parents)
 
     @staticmethod
-    async def run_sync_drive(config_id: int, company_id: int, folder_id: str) -> int:
+    async def run_sync_drive(
+        config_id: int,
+        company_id: int,
+        folder_id: str,
+        force_full: bool = False,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> Dict[str, int]:
         """
         Lê os metadados do Google Drive e gera embeddings correspondentes.
 
+        A sincronização é incremental: com um page token salvo, a Changes API informa o que mudou desde a
+        última execução e, se nada afetar a pasta, nenhuma listagem é feita. Havendo mudanças (ou token
+        expirado), a árvore é listada novamente e apenas os arquivos novos/alterados são vetorizados.
+
         @param config_id: ID da configuração.
         @param company_id: ID da empresa.
         @param folder_id: ID da pasta no Drive.
-        @returns: O número total de vetores indexados.
+        @param force_full: Ignora o page token salvo e força a varredura completa.
+        @param on_progress: Callback de progresso da vetorização (padrão: log a cada 10%).
+        @returns: Relatório com 'items', 'added', 'changed', 'removed', 'unchanged', 'skipped' (1 se nada mudou)
+                  e 'truncated' (1 se a listagem atingiu o limite de arquivos).
         """
-        logger.info(f"Iniciando sincronização simplificada de Drive (Config: {config_id}, Empresa: {company_id})")
+        logger.info(f"Iniciando sincronização de Drive (Config: {config_id}, Empresa: {company_id})")
         
         async with SessionLocal() as db:
             try:
                 drive_service = get_drive_service()
-                gemini_service = get_gemini_service()
-                
-                drive_data = await drive_service.list_files_in_folder(folder_id)
-                files_tree = drive_data.get("tree", {})
-                
-                drive_items = ConfigService.flatten_drive_tree(files_tree)
-                
-                contextos_buffer = []
-                if drive_items:
-                    lines_to_embed = [item["content"] for item in drive_items]
-                    embeddings = await gemini_service.generate_embeddings_batch(lines_to_embed)
-                    
-                    for item, embedding in zip(drive_items, embeddings):
-                        if embedding:
-                            contextos_buffer.append(models.KnowledgeVector(
-                                config_id=config_id,
-                                content=item["content"],
-                                origin="drive",
-                                category=item["category"],
-                                raw_data=item["raw_data"],
-                                embedding=embedding
-                            ))
-
-                logger.info(f"Drive sync: deletando vetores anteriores para config_id={config_id}...")
-                await db.execute(delete(models.KnowledgeVector).where(
-                    models.KnowledgeVector.config_id == config_id,
-                    models.KnowledgeVector.origin.in_(["drive", "drive_content"])
-                ))
-                
-                if contextos_buffer:
-                    db.add_all(contextos_buffer)
-                
-                await db.commit()
-                logger.info(f"Drive sync concluída! {len(contextos_buffer)} vetores novos indexados.")
-                return len(contextos_buffer)
+                db_config = await crud_config.get_config(db=db, config_id=config_id, company_id=company_id)
+                if not db_config:
+                    raise Exception("Configuração não encontrada.")
+
+                state = db_config.drive_sync_state or {}
+                kv = models.KnowledgeVector
+
+                if not force_full and state.get("folder_id") == folder_id and state.get("page_token"):
+                    try:
+                        changes, new_token = await drive_service.list_changes(state["page_token"])
+                        result = await db.execute(
+                            select(kv.raw_data.op("->>")("id_arquivo"))
+                            .where(kv.config_id == config_id, kv.origin == "drive")
+                        )
+                        file_ids = {fid for fid in result.scalars().all() if fid}
+                        folder_ids = set(state.get("folder_ids") or [folder_id])
+                        relevant = [c for c in changes if ConfigService._is_relevant_drive_change(c, folder_ids, file_ids)]
+
+                        if not relevant:
+                            db_config.drive_sync_state = {**state, "page_token": new_token}
+                            db.add(db_config)
+                            await db.commit()
+                            logger.info(f"Drive sync: {len(changes)} mudança(s) no Drive, nenhuma afeta a pasta da config {config_id}. Nada a fazer.")
+                            return {"items": len(file_ids), "added": 0, "changed": 0, "removed": 0, "unchanged": len(file_ids), "skipped": 1, "truncated": 0}
+
+                        logger.info(f"Drive sync: {len(relevant)} mudança(s) relevante(s) para a config {config_id}. Reindexando a árvore.")
+                    except DriveChangesTokenExpired:
+                        logger.warning(f"Drive sync: Page token expirado para a config {config_id}. Executando varredura completa.")
+
+                # O token é obtido ANTES da listagem para que mudanças feitas durante a varredura apareçam na próxima sync
+                start_token = await drive_service.get_start_page_token()
+
+                # Os itens são montados conforme as páginas da varredura paralela chegam (sem árvore intermediária)
+                crawler = drive_service.crawl(folder_id)
+                drive_items = []
+                async for _, path, entry in crawler.items():
+                    if entry['mimeType'] == FOLDER_MIME_TYPE:
+                        continue
+                    item = ConfigService.build_drive_item(drive_service.file_entry(entry), " > ".join(path))
+                    if item:
+                        drive_items.append(item)
+                if crawler.truncated:
+                    # Arquivos fora da listagem não podem ser tratados como removidos, e o page token não avança
+                    # para que a próxima sincronização refaça a varredura
+                    logger.warning(
+                        f"Drive sync: Listagem da config {config_id} truncada em {crawler.files_count} arquivos. "
+                        f"Aplicando apenas inclusões/alterações; nenhum vetor será removido."
+                    )
+                else:
+                    # O estado vai no mesmo commit da troca dos vetores
+                    db_config.drive_sync_state = {
+                        "folder_id": folder_id,
+                        "page_token": start_token,
+                        "folder_ids": crawler.folder_ids
+                    }
+                    db.add(db_config)
+                report = await ConfigService.apply_knowledge_diff(
+                    db, config_id, "drive", drive_items, replace_origins=["drive", "drive_content"],
+                    on_progress=on_progress or ConfigService.embedding_progress_logger(f"Drive (Config: {config_id})"),
+                    keep_missing=crawler.truncated
+                )
+                report["skipped"] = 0
+                report["truncated"] = int(crawler.truncated)
+                logger.info(
+                    f"Drive sync concluída! Itens: {report['items']} (novos: {report['added']}, alterados: {report['changed']}, "
+                    f"removidos: {report['removed']}, inalterados: {report['unchanged']})"
+                )
+                return report
 
             except Exception as e:
                 logger.error(f"Erro na sincronização do Drive: {e}", exc_info=True)
@@ -730,15 +945,15 @@ class ConfigService:
         company_id: int,
         config_id: int,
         folder_id: Optional[str]
-    ) -> int:
+    ) -> models.SyncJob:
         """
-        Salva o ID da pasta do Drive (se fornecido) e executa o processo de sincronização de metadados.
+        Salva o ID da pasta do Drive (se fornecido) e enfileira a sincronização de metadados para o worker.
 
         @param db: Sessão do banco de dados.
         @param company_id: ID da empresa.
         @param config_id: ID da configuração.
         @param folder_id: ID da pasta no Drive (opcional).
-        @returns: O número total de vetores gerados.
+        @returns: Job de sincronização (o relatório fica em job.report ao concluir).
         """
         db_config = await crud_config.get_config(db=db, config_id=config_id, company_id=company_id)
         if not db_config:
@@ -753,9 +968,8 @@ class ConfigService:
         if not final_folder_id:
             raise ConfigValidationError("Nenhum ID de pasta associado. Insira o ID da pasta do Google Drive.")
 
-        itens_processados = await ConfigService.run_sync_drive(config_id, company_id, final_folder_id)
-        await ConfigService.setup_drive_watch(config_id, final_folder_id, "drive")
-        return itens_processados
+        # Sincronização manual sempre faz a varredura completa (a incremental fica para as notificações do watch)
+        return await enqueue_sync_job(db, config_id, company_id, "drive", final_folder_id, force_full=True)
 
     @staticmethod
     async def process_drive_webhook(
@@ -763,18 +977,17 @@ class ConfigService:
         channel_id: Optional[str],
         resource_state: Optional[str],
         channel_token: Optional[str],
-        background_tasks: Any,
         query_params: Dict[str, Any],
         body_json: Optional[Dict[str, Any]]
     ) -> Dict[str, str]:
         """
-        Processa as requisições de webhook do Google Drive agendando sincronizações em background.
+        Processa as requisições de webhook do Google Drive enfileirando sincronizações para o worker.
+        Notificações repetidas enquanto o job ainda está na fila são absorvidas por ele.
 
         @param db: Sessão do banco de dados.
         @param channel_id: ID do canal de watch.
         @param resource_state: Estado da notificação ('sync', 'update', etc.).
         @param channel_token: Token do canal contendo parâmetros codificados.
-        @param background_tasks: Instância de background tasks do FastAPI.
         @param query_params: Parâmetros de consulta da URL do request.
         @param body_json: Payload JSON decodificado.
         @returns: Mensagem e status da requisição do webhook.
@@ -821,18 +1034,12 @@ class ConfigService:
                         return {"status": "ignored_dev"}
 
                 if resource_type == "system" and db_config.spreadsheet_id:
-                    background_tasks.add_task(
-                        ConfigService.run_sync_sheet, config_id, company_id, db_config.spreadsheet_id, "system"
-                    )
+                    await enqueue_sync_job(db, config_id, company_id, "system", db_config.spreadsheet_id, trigger="webhook")
                 elif resource_type == "rag" and db_config.spreadsheet_rag_id:
-                    background_tasks.add_task(
-                        ConfigService.run_sync_sheet, config_id, company_id, db_config.spreadsheet_rag_id, "rag"
-                    )
+                    await enqueue_sync_job(db, config_id, company_id, "rag", db_config.spreadsheet_rag_id, trigger="webhook")
                 elif resource_type == "drive" and db_config.drive_id:
-                    background_tasks.add_task(
-                        ConfigService.run_sync_drive, config_id, company_id, db_config.drive_id
-                    )
-                logger.info(f"Drive Webhook: Sincronização em background iniciada para Config: {config_id}, Tipo: {resource_type}")
+                    await enqueue_sync_job(db, config_id, company_id, "drive", db_config.drive_id, trigger="webhook")
+                logger.info(f"Drive Webhook: Sincronização enfileirada para Config: {config_id}, Tipo: {resource_type}")
                 return {"status": "sync_started"}
 
         config_id_param = query_params.get("config_id")
@@ -860,14 +1067,10 @@ class ConfigService:
                 for db_config in configs:
                     company_id = db_config.company_id
                     if db_config.spreadsheet_id == spreadsheet_id_param:
-                        background_tasks.add_task(
-                            ConfigService.run_sync_sheet, db_config.id, company_id, spreadsheet_id_param, "system"
-                        )
+                        await enqueue_sync_job(db, db_config.id, company_id, "system", spreadsheet_id_param, trigger="webhook")
                     if db_config.spreadsheet_rag_id == spreadsheet_id_param:
-                        background_tasks.add_task(
-                            ConfigService.run_sync_sheet, db_config.id, company_id, spreadsheet_id_param, "rag"
-                        )
-                logger.info(f"Webhook por Spreadsheet ID: Sincronização em background iniciada para Planilha {spreadsheet_id_param}")
+                        await enqueue_sync_job(db, db_config.id, company_id, "rag", spreadsheet_id_param, trigger="webhook")
+                logger.info(f"Webhook por Spreadsheet ID: Sincronização enfileirada para Planilha {spreadsheet_id_param}")
                 return {"status": "sync_started"}
 
         if config_id_param and type_param:
@@ -876,18 +1079,12 @@ class ConfigService:
             if db_config:
                 company_id = db_config.company_id
                 if type_param == "system" and db_config.spreadsheet_id:
-                    background_tasks.add_task(
-                        ConfigService.run_sync_sheet, config_id, company_id, db_config.spreadsheet_id, "system"
-                    )
+                    await enqueue_sync_job(db, config_id, company_id, "system", db_config.spreadsheet_id, trigger="webhook")
                 elif type_param == "rag" and db_config.spreadsheet_rag_id:
-                    background_tasks.add_task(
-                        ConfigService.run_sync_sheet, config_id, company_id, db_config.spreadsheet_rag_id, "rag"
-                    )
+                    await enqueue_sync_job(db, config_id, company_id, "rag", db_config.spreadsheet_rag_id, trigger="webhook")
                 elif type_param == "drive" and db_config.drive_id:
-                    background_tasks.add_task(
-                        ConfigService.run_sync_drive, config_id, company_id, db_config.drive_id
-                    )
-                logger.info(f"Webhook Direto: Sincronização em background iniciada para Config: {config_id}, Tipo: {type_param}")
+                    await enqueue_sync_job(db, config_id, company_id, "drive", db_config.drive_id, trigger="webhook")
+                logger.info(f"Webhook Direto: Sincronização enfileirada para Config: {config_id}, Tipo: {type_param}")
                 return {"status": "sync_started"}
                 
         return {"status": "ignored"}
@@ -925,7 +1122,7 @@ class ConfigService:
             raise ConfigNotFoundError("Configuração não encontrada.")
             
         service = get_google_calendar_service(db_config)
-        credentials = service.fetch_token(code, redirect_uri)
+        credentials = await get_google_api_client().run("calendar", service.fetch_token, code, redirect_uri)
         
         db_config.google_calendar_credentials = credentials
         db.add(db_config)
@@ -1092,8 +1289,9 @@ class ConfigService:
             alteracoes_rag_dict = [a.model_dump() for a in payload.alteracoes_rag]
             await sheets_service.apply_feedback_to_sheet(persona.spreadsheet_rag_id, alteracoes_rag_dict)
             
-            await ConfigService.run_sync_sheet(persona.id, company_id, persona.spreadsheet_rag_id, "rag")
-            mensagens_sucesso.append("Planilha RAG atualizada e embeddings regerados.")
+            # O job entra no mesmo commit das alterações da persona
+            await enqueue_sync_job(db, persona.id, company_id, "rag", persona.spreadsheet_rag_id, commit=False)
+            mensagens_sucesso.append("Planilha RAG atualizada; os embeddings serão regerados em segundo plano.")
 
         # 3. Substituir o JSON do fluxo
         if payload.novo_workflow:
@@ -1171,8 +1369,9 @@ class ConfigService:
             alteracoes_rag_dict = [a.model_dump() for a in payload.alteracoes_rag]
             await sheets_service.apply_feedback_to_sheet(persona.spreadsheet_rag_id, alteracoes_rag_dict)
             
-            await ConfigService.run_sync_sheet(persona.id, company_id, persona.spreadsheet_rag_id, "rag")
-            mensagens_sucesso.append("Planilha RAG atualizada e embeddings regerados.")
+            # O job entra no mesmo commit das alterações da persona
+            await enqueue_sync_job(db, persona.id, company_id, "rag", persona.spreadsheet_rag_id, commit=False)
+            mensagens_sucesso.append("Planilha RAG atualizada; os embeddings serão regerados em segundo plano.")
 
         # 3. Substituir o JSON do fluxo
         if payload.novo_workflow:
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 from typing import Any, Dict, List
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.db import models
-from app.crud import crud_atendimento
+from app.crud import crud_atendimento, crud_user
 from app.services.gemini_service import GeminiService
 
 logger = logging.getLogger(__name__)
@@ -33,6 +33,33 @@ class DashboardService:
             db, company_id=company_id, start_date=start_date, end_date=end_date
         )
 
+    @staticmethod
+    async def get_token_usage(
+        db: AsyncSession,
+        current_user: models.User,
+        start_date_str: str = None,
+        end_date_str: str = None,
+        group_by: str = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Retorna o consumo de tokens da empresa do usuário a partir dos agregados diários do ledger.
+
+        @param db: Sessão do banco de dados.
+        @param current_user: Modelo do usuário logado.
+        @param start_date_str: Data de início no formato ISO.
+        @param end_date_str: Data de término no formato ISO.
+        @param group_by: Dimensões separadas por vírgula ('day', 'model', 'token_type'). Padrão: 'day'.
+        @returns: Lista de linhas agregadas com events, input_tokens, output_tokens e cost_units.
+        """
+        start_date = datetime.fromisoformat(start_date_str) if start_date_str else datetime.now() - timedelta(days=30)
+        end_date = datetime.fromisoformat(end_date_str) if end_date_str else datetime.now()
+        dimensoes = [d.strip() for d in group_by.split(",") if d.strip()] if group_by else None
+
+        company_id = current_user.company_id or 0
+        return await crud_user.get_token_usage_report(
+            db, company_id=company_id, start_date=start_date, end_date=end_date, group_by=dimensoes
+        )
+
     @staticmethod
     async def analyze_data_with_ia(
         db: AsyncSession,
@@ -0,0 +1,264 @@
+import asyncio
+import hashlib
+import logging
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.core.config import settings
+from app.db import models
+from app.db.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# Tamanho dos lotes de leitura/escrita no nível persistente (limite de parâmetros por statement do asyncpg)
+DB_CHUNK_SIZE = 500
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normaliza o texto antes do hash, para que variações triviais (caixa, espaços, forma Unicode)
+    reaproveitem o mesmo embedding.
+
+    @param text: Texto original.
+    @returns: Texto normalizado.
+    """
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", text or "")).strip().casefold()
+
+
+def make_cache_key(model: str, text: str) -> str:
+    """
+    Calcula a chave do cache para um texto.
+
+    @param model: Identificador do espaço de embedding (modelo, tarefa e dimensões).
+    @param text: Texto a ser vetorizado.
+    @returns: sha256 hexadecimal de "modelo|texto normalizado".
+    """
+    return hashlib.sha256(f"{model}|{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache de embeddings em dois níveis: LRU em memória (por processo) e tabela embedding_cache
+    (armazenamento endereçado por conteúdo, compartilhado por todos os fluxos de ingestão).
+    Falhas no nível persistente nunca interrompem a geração de embeddings; apenas viram misses.
+    """
+
+    def __init__(self, max_entries: int, persistent: bool, enabled: bool = True):
+        self.enabled = enabled
+        self.persistent = persistent
+        self.max_entries = max_entries
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        self._lru[key] = embedding
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Métricas acumuladas do processo.
+
+        @returns: Acertos por nível, misses, taxa de acerto e tamanho atual da LRU.
+        """
+        total = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.db_hits) / total if total else 0.0,
+            "lru_size": len(self._lru),
+        }
+
+    def _record_lookups(self, memory_hits: int, db_hits: int, misses: int) -> None:
+        every = max(settings.EMBEDDING_CACHE_STATS_EVERY, 1)
+        before = (self.memory_hits + self.db_hits + self.misses) // every
+        self.memory_hits += memory_hits
+        self.db_hits += db_hits
+        self.misses += misses
+        if (self.memory_hits + self.db_hits + self.misses) // every > before:
+            s = self.stats()
+            logger.info(
+                f"Cache de Embeddings: taxa de acerto={s['hit_rate']:.1%} "
+                f"(memória={s['memory_hits']}, banco={s['db_hits']}, misses={s['misses']}, lru={s['lru_size']})"
+            )
+
+    async def get_many(self, model: str, texts: List[str]) -> Dict[str, List[float]]:
+        """
+        Busca embeddings já conhecidos para os textos (memória primeiro, depois banco).
+
+        @param model: Identificador do espaço de embedding.
+        @param texts: Textos consultados.
+        @returns: Mapeamento texto -> embedding apenas para os textos encontrados.
+        """
+        if not self.enabled or not texts:
+            return {}
+
+        found: Dict[str, List[float]] = {}
+        pending: Dict[str, List[str]] = {}
+        for t in texts:
+            key = make_cache_key(model, t)
+            cached = self._lru.get(key)
+            if cached is not None:
+                self._lru.move_to_end(key)
+                found[t] = cached
+            else:
+                pending.setdefault(key, []).append(t)
+        memory_hits = len(found)
+
+        if pending and self.persistent:
+            try:
+                keys = list(pending.keys())
+                async with SessionLocal() as db:
+                    for i in range(0, len(keys), DB_CHUNK_SIZE):
+                        result = await db.execute(
+                            select(models.EmbeddingCacheEntry.key_hash, models.EmbeddingCacheEntry.embedding)
+                            .where(models.EmbeddingCacheEntry.key_hash.in_(keys[i:i + DB_CHUNK_SIZE]))
+                        )
+                        hit_keys = []
+                        for key, embedding in result.all():
+                            values = [float(v) for v in embedding]
+                            self._remember(key, values)
+                            hit_keys.append(key)
+                            for t in pending.pop(key, []):
+                                found[t] = values
+                        if hit_keys:
+                            # Granularidade diária: evita reescrever a linha a cada acerto
+                            await db.execute(
+                                update(models.EmbeddingCacheEntry)
+                                .where(
+                                    models.EmbeddingCacheEntry.key_hash.in_(hit_keys),
+                                    models.EmbeddingCacheEntry.last_used_at < func.now() - text("interval '1 day'")
+                                )
+                                .values(last_used_at=func.now())
+                                .execution_options(synchronize_session=False)
+                            )
+                    await db.commit()
+            except Exception as e:
+                logger.warning(f"Cache de Embeddings: Falha ao consultar o cache persistente: {e}")
+
+        self._record_lookups(memory_hits, len(found) - memory_hits, sum(len(v) for v in pending.values()))
+        return found
+
+    async def put_many(self, model: str, embeddings: Dict[str, List[float]]) -> None:
+        """
+        Armazena embeddings recém-gerados nos dois níveis.
+
+        @param model: Identificador do espaço de embedding.
+        @param embeddings: Mapeamento texto -> embedding (vetores vazios são ignorados).
+        """
+        if not self.enabled:
+            return
+        rows = {}
+        for t, values in embeddings.items():
+            if not values:
+                continue
+            key = make_cache_key(model, t)
+            self._remember(key, list(values))
+            rows[key] = {"key_hash": key, "model": model, "embedding": list(values)}
+
+        if rows and self.persistent:
+            try:
+                values_list = list(rows.values())
+                async with SessionLocal() as db:
+                    async with db.begin():
+                        for i in range(0, len(values_list), DB_CHUNK_SIZE):
+                            await db.execute(
+                                pg_insert(models.EmbeddingCacheEntry)
+                                .values(values_list[i:i + DB_CHUNK_SIZE])
+                                .on_conflict_do_nothing(index_elements=["key_hash"])
+                            )
+            except Exception as e:
+                logger.warning(f"Cache de Embeddings: Falha ao gravar no cache persistente: {e}")
+
+
+async def collect_embedding_garbage() -> int:
+    """
+    Coleta de lixo do armazenamento persistente: remove entradas ociosas há mais de
+    EMBEDDING_STORE_MAX_IDLE_DAYS e, se ainda acima de EMBEDDING_STORE_MAX_ENTRIES, as menos usadas recentemente.
+
+    @returns: Quantidade de entradas removidas.
+    """
+    entry = models.EmbeddingCacheEntry
+    async with SessionLocal() as db:
+        async with db.begin():
+            result = await db.execute(
+                delete(entry).where(
+                    entry.last_used_at < func.now() - func.make_interval(0, 0, 0, settings.EMBEDDING_STORE_MAX_IDLE_DAYS)
+                )
+            )
+            removed = result.rowcount or 0
+
+            total = (await db.execute(select(func.count()).select_from(entry))).scalar() or 0
+            excess = total - settings.EMBEDDING_STORE_MAX_ENTRIES
+            if excess > 0:
+                oldest = select(entry.key_hash).order_by(entry.last_used_at).limit(excess).scalar_subquery()
+                result = await db.execute(delete(entry).where(entry.key_hash.in_(oldest)))
+                removed += result.rowcount or 0
+
+    if removed:
+        logger.info(f"Cache de Embeddings: Coleta de lixo removeu {removed} entrada(s) do armazenamento persistente.")
+    return removed
+
+
+async def embedding_gc_loop():
+    """
+    Loop que executa a coleta de lixo do armazenamento de embeddings na inicialização e depois a cada
+    EMBEDDING_STORE_GC_INTERVAL_HOURS (processos reiniciados com frequência também coletam).
+    """
+    logger.info("Cache de Embeddings: Iniciando loop de coleta de lixo...")
+    while True:
+        try:
+            await collect_embedding_garbage()
+        except asyncio.CancelledError:
+            logger.info("Cache de Embeddings: Loop de coleta de lixo cancelado.")
+            break
+        except Exception as e:
+            logger.error(f"Cache de Embeddings: Erro na coleta de lixo: {e}", exc_info=True)
+        try:
+            await asyncio.sleep(settings.EMBEDDING_STORE_GC_INTERVAL_HOURS * 3600)
+        except asyncio.CancelledError:
+            logger.info("Cache de Embeddings: Loop de coleta de lixo cancelado.")
+            break
+
+gc_task = None
+
+def start_embedding_gc():
+    """
+    Inicia a coleta de lixo do armazenamento de embeddings como uma tarefa de segundo plano assíncrona.
+    """
+    global gc_task
+    gc_task = asyncio.create_task(embedding_gc_loop())
+
+async def stop_embedding_gc():
+    """Cancela a coleta de lixo do armazenamento de embeddings no encerramento do processo."""
+    global gc_task
+    if gc_task is not None:
+        gc_task.cancel()
+        try:
+            await gc_task
+        except asyncio.CancelledError:
+            pass
+        gc_task = None
+
+
+_embedding_cache_instance: Optional[EmbeddingCache] = None
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache_instance
+    if _embedding_cache_instance is None:
+        _embedding_cache_instance = EmbeddingCache(
+            max_entries=settings.EMBEDDING_CACHE_LRU_SIZE,
+            persistent=settings.EMBEDDING_CACHE_PERSISTENT,
+            enabled=settings.EMBEDDING_CACHE_ENABLED
+        )
+    return _embedding_cache_instance
@@ -0,0 +1,232 @@
+import asyncio
+import inspect
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Estimativa conservadora de tokens por caractere (pt-BR fica perto de 3-4 caracteres por token)
+CHARS_PER_TOKEN = 3
+# Teto do intervalo entre tentativas
+MAX_BACKOFF_SECONDS = 30.0
+
+
+@dataclass
+class EmbeddingProgress:
+    """Andamento de uma execução de embeddings em lote, entregue aos callbacks de progresso."""
+    total: int
+    completed: int = 0
+    failed: int = 0
+
+    @property
+    def pending(self) -> int:
+        return self.total - self.completed - self.failed
+
+
+ProgressCallback = Callable[[EmbeddingProgress], Any]
+EmbedFunction = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+
+@dataclass
+class _Batch:
+    indices: List[int]
+    attempt: int = 0
+
+
+class RequestRateLimiter:
+    """
+    Token bucket de requisições por minuto. Compartilhado por chave de API, para que consultas
+    unitárias e lotes concorrentes disputem a mesma cota.
+    """
+
+    def __init__(self, requests_per_minute: int):
+        self.capacity = max(requests_per_minute, 1)
+        self.rate = self.capacity / 60.0
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Aguarda até haver cota para mais uma requisição."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_rate_limiters: Dict[str, RequestRateLimiter] = {}
+
+def get_rate_limiter(api_key: str) -> RequestRateLimiter:
+    """
+    Retorna o limitador de requisições da chave de API (criado sob demanda).
+
+    @param api_key: Chave usada nas chamadas.
+    @returns: Limitador com EMBEDDING_REQUESTS_PER_MINUTE por chave.
+    """
+    limiter = _rate_limiters.get(api_key)
+    if limiter is None:
+        limiter = _rate_limiters[api_key] = RequestRateLimiter(settings.EMBEDDING_REQUESTS_PER_MINUTE)
+    return limiter
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text or "") // CHARS_PER_TOKEN + 1
+
+
+def _is_permanent_error(error: Exception) -> bool:
+    """Erros que não mudam com nova tentativa (conteúdo bloqueado ou argumento inválido)."""
+    error_str = str(error).lower()
+    return "blocked" in error_str or "invalid argument" in error_str
+
+
+class EmbeddingBatchExecutor:
+    """
+    Executa a vetorização de muitos textos em lotes paralelos.
+
+    - Lotes montados por quantidade de itens E por tokens estimados (textos longos geram lotes menores).
+    - Até `max_concurrency` lotes em voo, cada requisição passando pelo limitador da chave.
+    - Falhas transitórias reenfileiram apenas os itens sem vetor; erros permanentes em lotes com vários
+      itens dividem o lote ao meio até isolar o texto problemático (que fica com vetor vazio).
+    """
+
+    def __init__(
+        self,
+        embed: EmbedFunction,
+        rate_limiter: RequestRateLimiter,
+        max_concurrency: int,
+        max_batch_items: int,
+        max_batch_tokens: int,
+        max_attempts: int
+    ):
+        self.embed = embed
+        self.rate_limiter = rate_limiter
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_batch_items = max(max_batch_items, 1)
+        self.max_batch_tokens = max(max_batch_tokens, 1)
+        self.max_attempts = max(max_attempts, 1)
+
+    def plan_batches(self, texts: List[str]) -> List[List[int]]:
+        """
+        Agrupa os índices dos textos respeitando os limites de itens e de tokens por requisição.
+
+        @param texts: Textos a vetorizar.
+        @returns: Lista de lotes (índices em `texts`), na ordem original.
+        """
+        batches: List[List[int]] = []
+        current: List[int] = []
+        current_tokens = 0
+        for idx, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if current and (len(current) >= self.max_batch_items or current_tokens + tokens > self.max_batch_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(idx)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    async def run(self, texts: List[str], on_progress: Optional[ProgressCallback] = None) -> List[List[float]]:
+        """
+        Vetoriza todos os textos.
+
+        @param texts: Textos a vetorizar (sem deduplicação; isso é responsabilidade do chamador).
+        @param on_progress: Callback (síncrono ou assíncrono) chamado a cada lote concluído.
+        @returns: Um vetor por texto, na mesma ordem; vazio para os textos que falharam.
+        """
+        results: List[List[float]] = [[] for _ in texts]
+        if not texts:
+            return results
+
+        progress = EmbeddingProgress(total=len(texts))
+        queue: "asyncio.Queue[_Batch]" = asyncio.Queue()
+        for indices in self.plan_batches(texts):
+            queue.put_nowait(_Batch(indices))
+
+        async def report():
+            if on_progress is None:
+                return
+            try:
+                outcome = on_progress(progress)
+                if inspect.isawaitable(outcome):
+                    await outcome
+            except Exception as e:
+                logger.warning(f"Embeddings em lote: Falha no callback de progresso: {e}")
+
+        async def retry(batch: _Batch, reason: Any):
+            if batch.attempt + 1 >= self.max_attempts:
+                logger.error(f"Embeddings em lote: {len(batch.indices)} texto(s) sem vetor após {self.max_attempts} tentativas: {reason}")
+                progress.failed += len(batch.indices)
+                await report()
+                return
+            delay = min(2 ** batch.attempt, MAX_BACKOFF_SECONDS) + random.uniform(0, 1)
+            logger.warning(
+                f"Embeddings em lote: Falha em lote de {len(batch.indices)} texto(s) ({reason}). "
+                f"Tentativa {batch.attempt + 1}/{self.max_attempts}; reenviando em {delay:.1f}s."
+            )
+            await asyncio.sleep(delay)
+            queue.put_nowait(_Batch(batch.indices, batch.attempt + 1))
+
+        async def process(batch: _Batch):
+            await self.rate_limiter.acquire()
+            try:
+                vectors = await self.embed([texts[i] for i in batch.indices])
+            except Exception as e:
+                if not _is_permanent_error(e):
+                    await retry(batch, e)
+                elif len(batch.indices) > 1:
+                    mid = len(batch.indices) // 2
+                    queue.put_nowait(_Batch(batch.indices[:mid], batch.attempt))
+                    queue.put_nowait(_Batch(batch.indices[mid:], batch.attempt))
+                else:
+                    logger.error(f"Erro não recuperável na geração de batch embeddings (bloqueio/argumento): {e}")
+                    progress.failed += 1
+                    await report()
+                return
+
+            missing = []
+            for pos, idx in enumerate(batch.indices):
+                values = vectors[pos] if pos < len(vectors) else None
+                if values:
+                    results[idx] = list(values)
+                    progress.completed += 1
+                else:
+                    missing.append(idx)
+            await report()
+            if missing:
+                await retry(_Batch(missing, batch.attempt), "resposta sem embeddings para parte dos itens")
+
+        async def worker():
+            while True:
+                batch = await queue.get()
+                try:
+                    await process(batch)
+                except Exception as e:
+                    logger.error(f"Embeddings em lote: Erro inesperado ao processar lote: {e}", exc_info=True)
+                    progress.failed += len(batch.indices)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.max_concurrency)]
+        try:
+            await queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        logger.info(
+            f"Embeddings em lote: {progress.completed} de {progress.total} texto(s) vetorizados"
+            + (f", {progress.failed} com falha." if progress.failed else ".")
+        )
+        return results
@@ -356,15 +356,16 @@ async def contabilizar_tokens_feedback(
 
     try:
         if tokens_para_deduzir > 0:
-            comp = await db.get(models.Company, company_id)
-            if comp:
-                await crud_user.decrement_company_tokens(
-                    db,
-                    db_company=comp,
-                    usage=tokens_para_deduzir,
-                    atendimento_id=atendimento_id,
-                    token_type="gemini_inference"
-                )
+            await crud_user.record_token_usage(
+                db,
+                company_id=company_id,
+                usage=tokens_para_deduzir,
+                atendimento_id=atendimento_id,
+                token_type="gemini_inference",
+                model=nome_modelo_limpo,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens
+            )
     except Exception as e:
         logger.error(f"Falha ao deduzir tokens de feedback da empresa {company_id}: {e}", exc_info=True)
 
@@ -6,6 +6,7 @@ import asyncio
 import pytz
 import re
 import os
+import time
 from typing import Optional, List, Dict, Any
 from collections.abc import Set
 from datetime import datetime, timezone
@@ -18,9 +19,18 @@ from app.core.config import settings
 from app.db import models
 from app.crud import crud_user, crud_atendimento
 from app.services.google_calendar_service import get_google_calendar_service
+from app.services.trace_service import get_trace_sink, describe_prompt
+from app.services.embedding_cache_service import get_embedding_cache
+from app.services.embedding_executor import EmbeddingBatchExecutor, ProgressCallback, get_rate_limiter
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_MODEL = "gemini-embedding-001"
+EMBEDDING_DIMENSIONS = 768
+# Espaços de embedding distintos por tipo de tarefa: o cache nunca mistura vetores de consulta e de documento
+EMBEDDING_QUERY_SPACE = f"{EMBEDDING_MODEL}:RETRIEVAL_QUERY:{EMBEDDING_DIMENSIONS}"
+EMBEDDING_DOCUMENT_SPACE = f"{EMBEDDING_MODEL}:RETRIEVAL_DOCUMENT:{EMBEDDING_DIMENSIONS}"
+
 class SetEncoder(json.JSONEncoder):
     """Codificador JSON para lidar com objetos 'set'."""
     def default(self, obj):
@@ -164,30 +174,9 @@ class GeminiService:
         gen_config = types.GenerateContentConfig(**config_args)
 
 
-        # --- DEBUG: PRINT PROMPT ---
-        try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            at_str = f" ATENDIMENTO {atendimento_id}" if atendimento_id else ""
-            debug_msg = f"\n{'='*20} PROMPT ENVIADO PARA IA{at_str} [{timestamp}] {'='*20}\n"
-            
-            if system_instruction:
-                debug_msg += f"--- SYSTEM INSTRUCTION ---\n{system_instruction}\n{'-'*30}\n"
-
-            if isinstance(prompt, str):
-                debug_msg += f"{prompt}\n"
-            elif isinstance(prompt, list):
-                for p in prompt:
-                    if isinstance(p, str):
-                        debug_msg += f"[TEXTO]: {p}\n"
-                    else:
-                        debug_msg += f"[MÍDIA/OBJETO]: {type(p)}\n"
-            debug_msg += f"{'='*60}\n"
-            
-            # Salva o prompt em arquivo (append/log)
-            with open("last_prompt.txt", "a", encoding="utf-8") as f:
-                f.write(debug_msg)
-        except Exception as e:
-            print(f"Erro ao printar/salvar prompt: {e}")
+        # Decide a amostragem antes de montar qualquer registro, para que chamadas não amostradas não paguem serialização
+        trace_sink = get_trace_sink()
+        trace_sampled = trace_sink.should_sample(company.id if company else None)
 
         max_attempts = 3
         
@@ -199,6 +188,7 @@ class GeminiService:
                 
                 # --- MUDANÇA PRINCIPAL: Chamada Assíncrona Nativa (.aio) ---
                 # Timeout de 300s via asyncio — acomoda modelos mais lentos/poderosos
+                started_at = time.perf_counter()
                 response = await asyncio.wait_for(
                     self.client.aio.models.generate_content(
                         model=model_name,
@@ -208,22 +198,13 @@ class GeminiService:
                     timeout=300.0
                 )
                 
-                # --- DEBUG: LOG RESPONSE ---
-                try:
-                    timestamp_resp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    resp_msg = f"\n{'='*20} RESPOSTA DA IA [{timestamp_resp}] {'='*20}\n"
-                    resp_msg += f"{response.text}\n"
-                    resp_msg += f"{'='*60}\n"
-                    
-                    with open("last_prompt.txt", "a", encoding="utf-8") as f:
-                        f.write(resp_msg)
-                except Exception as e:
-                    print(f"Erro ao salvar resposta no log: {e}")
+                latency_ms = round((time.perf_counter() - started_at) * 1000)
 
                 # --- LÓGICA DE TOKEN (ODÔMETRO) ---
                 # Extrai o uso real de tokens da resposta do Gemini, incluindo tokens de pensamento (thinking)
                 usage_metadata = response.usage_metadata
                 tokens_to_deduct = 0 # Inicializa com 0
+                input_tokens = output_tokens = 0
 
                 if usage_metadata:
                     input_tokens = usage_metadata.prompt_token_count or 0
@@ -252,21 +233,40 @@ class GeminiService:
                 else:
                     logger.warning(f"Não foi possível obter metadados de uso de tokens para a empresa {company.id}.")
 
+                if trace_sampled:
+                    trace_sink.emit({
+                        "kind": "gemini_generate",
+                        "company_id": company.id,
+                        "atendimento_id": atendimento_id,
+                        "model": model_name,
+                        "media_type": media_type,
+                        "attempt": attempt + 1,
+                        "latency_ms": latency_ms,
+                        "input_tokens": input_tokens,
+                        "output_tokens": output_tokens,
+                        "cost_units": tokens_to_deduct,
+                        "system_instruction": system_instruction,
+                        "prompt": describe_prompt(prompt),
+                        "response": response.text,
+                    })
+
                 try:
                     if tokens_to_deduct > 0:
                         logger.info(f"Sucesso na chamada à API Gemini para a empresa {company.id}. Deduzindo {tokens_to_deduct} tokens.")
-                        await crud_user.decrement_company_tokens(
+                        await crud_user.record_token_usage(
                             db,
-                            db_company=company,
+                            company_id=company.id,
                             usage=tokens_to_deduct,
                             atendimento_id=atendimento_id,
-                            token_type="gemini_inference"
+                            token_type="gemini_inference",
+                            model=model_name,
+                            input_tokens=input_tokens,
+                            output_tokens=output_tokens
                         )
                         if db.in_nested_transaction():
                             await db.flush()
                         else:
                             await db.commit()
-                            await db.refresh(company)
                 except Exception as token_err:
                     logger.error(f"Falha ao deduzir tokens da empresa: {token_err}", exc_info=True)
                     if db.in_nested_transaction():
@@ -469,18 +469,20 @@ class GeminiService:
             try:
                 if tokens_to_deduct > 0:
                     logger.info(f"Dedução TTS (Atend: {atendimento_id}): Consumo={tokens_to_deduct} tokens.")
-                    await crud_user.decrement_company_tokens(
+                    await crud_user.record_token_usage(
                         db,
-                        db_company=company,
+                        company_id=company.id,
                         usage=tokens_to_deduct,
                         atendimento_id=atendimento_id,
-                        token_type="gemini_tts"
+                        token_type="gemini_tts",
+                        model="gemini-3.1-flash-tts-preview",
+                        input_tokens=input_tokens,
+                        output_tokens=output_tokens
                     )
                     if db.in_nested_transaction():
                         await db.flush()
                     else:
                         await db.commit()
-                        await db.refresh(company)
             except Exception as token_err:
                 logger.error(f"Falha ao deduzir tokens de TTS da empresa: {token_err}", exc_info=True)
                 await db.rollback()
@@ -500,23 +502,32 @@ class GeminiService:
         """
         Gera embedding usando o modelo gemini-embedding-001.
         Força 768 dimensões para compatibilidade e eficiência.
+        Consulta antes o cache de embeddings (memória e banco), pois os mesmos termos se repetem entre conversas.
         """
+        embedding_cache = get_embedding_cache()
+        cached = await embedding_cache.get_many(EMBEDDING_QUERY_SPACE, [text])
+        if text in cached:
+            return cached[text]
+
         max_attempts = 3
         
         embed_config = types.EmbedContentConfig(
             task_type="RETRIEVAL_QUERY",
-            output_dimensionality=768
+            output_dimensionality=EMBEDDING_DIMENSIONS
         )
 
         for attempt in range(max_attempts):
             try:
+                await get_rate_limiter(self.api_key).acquire()
                 response = await self.client.aio.models.embed_content(
-                    model="gemini-embedding-001",
+                    model=EMBEDDING_MODEL,
                     contents=text,
                     config=embed_config
                 )
                 if response.embeddings:
-                    return response.embeddings[0].values
+                    values = response.embeddings[0].values
+                    await embedding_cache.put_many(EMBEDDING_QUERY_SPACE, {text: values})
+                    return values
                 return []
             except Exception as e:
                 error_str = str(e).lower()
@@ -529,55 +540,56 @@ class GeminiService:
                     return []
                 await asyncio.sleep(2)
 
-    async def generate_embeddings_batch(self, texts: List[str], batch_size: int = 100) -> List[List[float]]:
+    async def _embed_documents(self, batch: List[str]) -> List[List[float]]:
+        """Uma requisição de embeddings de documento (usada pelo executor de lotes)."""
+        response = await self.client.aio.models.embed_content(
+            model=EMBEDDING_MODEL,
+            contents=batch,
+            # Tipo de tarefa de documento (otimizado para RAG)
+            config=types.EmbedContentConfig(
+                task_type="RETRIEVAL_DOCUMENT",
+                output_dimensionality=EMBEDDING_DIMENSIONS
+            )
+        )
+        return [e.values for e in (response.embeddings or [])]
+
+    async def generate_embeddings_batch(
+        self,
+        texts: List[str],
+        batch_size: Optional[int] = None,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> List[List[float]]:
         """
         Gera embeddings em lote usando gemini-embedding-001 com 768 dimensões.
+        Apenas textos ausentes do cache (e sem repetição) são enviados à API; a ordem de 'texts' é preservada.
+        Os lotes são enviados em paralelo pelo EmbeddingBatchExecutor (limite de itens/tokens por lote,
+        cota por chave e novas tentativas apenas dos itens que falharam).
+
+        @param texts: Textos a vetorizar.
+        @param batch_size: Máximo de itens por requisição (padrão EMBEDDING_BATCH_MAX_ITEMS).
+        @param on_progress: Callback chamado com EmbeddingProgress a cada lote concluído.
+        @returns: Um embedding por texto (lista vazia para os que falharam).
         """
-        all_embeddings = []
-        
-        # Configuração com tipo de tarefa de documento (otimizado para RAG)
-        embed_config = types.EmbedContentConfig(
-            task_type="RETRIEVAL_DOCUMENT",
-            output_dimensionality=768
+        embedding_cache = get_embedding_cache()
+        cached = await embedding_cache.get_many(EMBEDDING_DOCUMENT_SPACE, texts)
+        missing_texts = list(dict.fromkeys(t for t in texts if t not in cached))
+        if len(missing_texts) < len(texts):
+            logger.info(f"Embeddings em lote: {len(texts) - len(missing_texts)} de {len(texts)} texto(s) reaproveitados do cache ou repetidos.")
+
+        executor = EmbeddingBatchExecutor(
+            embed=self._embed_documents,
+            rate_limiter=get_rate_limiter(self.api_key),
+            max_concurrency=settings.EMBEDDING_MAX_CONCURRENCY,
+            max_batch_items=batch_size or settings.EMBEDDING_BATCH_MAX_ITEMS,
+            max_batch_tokens=settings.EMBEDDING_BATCH_MAX_TOKENS,
+            max_attempts=settings.EMBEDDING_MAX_ATTEMPTS
         )
+        all_embeddings = await executor.run(missing_texts, on_progress=on_progress)
 
-        # O novo SDK aceita listas nativamente no parâmetro 'contents'.
-        # Mantemos o particionamento (batch) para evitar limites de payload muito grandes na API.
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            max_attempts = 3
-            success = False
-            batch_embeddings = []
-
-            for attempt in range(max_attempts):
-                try:
-                    response = await self.client.aio.models.embed_content(
-                        model="gemini-embedding-001",
-                        contents=batch,
-                        config=embed_config
-                    )
-                    if response.embeddings:
-                        batch_embeddings = [e.values for e in response.embeddings]
-                    else:
-                        logger.warning(f"Batch {i} retornou sem embeddings.")
-                        batch_embeddings = [[] for _ in batch]
-                    success = True
-                    break
-                except Exception as e:
-                    error_str = str(e).lower()
-                    if "blocked" in error_str or "invalid argument" in error_str:
-                        logger.error(f"Erro não recuperável na geração de batch embeddings (bloqueio/argumento): {e}")
-                        batch_embeddings = [[] for _ in batch]
-                        success = True
-                        break
-                    logger.error(f"Erro na geração de batch embeddings: {e}. Tentativa {attempt + 1}/{max_attempts}.")
-                    if attempt == max_attempts - 1:
-                        batch_embeddings = [[] for _ in batch]
-                    await asyncio.sleep(2)
-
-            all_embeddings.extend(batch_embeddings)
-        
-        return all_embeddings
+        generated = dict(zip(missing_texts, all_embeddings))
+        await embedding_cache.put_many(EMBEDDING_DOCUMENT_SPACE, generated)
+        generated.update(cached)
+        return [generated.get(t, []) for t in texts]
 
 
     async def _retrieve_rag_context(
@@ -613,6 +625,9 @@ class GeminiService:
             origins = [o for o in origins if o.strip().lower() in selected_set]
             
         final_vectors = []
+
+        from app.services.vector_index_service import apply_vector_search_settings
+        await apply_vector_search_settings(db)
         
         # Para cada origem encontrada (cada aba e o drive), busca os 'limit' mais relevantes com threshold de distância
         for origin in origins:
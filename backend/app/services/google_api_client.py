@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import random
+import socket
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Status HTTP considerados transitórios (vale a pena tentar de novo)
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Motivos de 403 que na prática são limite de cota, não falta de permissão
+RATE_LIMIT_REASONS = ("ratelimitexceeded", "userratelimitexceeded", "quotaexceeded")
+# Teto do intervalo entre tentativas
+MAX_BACKOFF_SECONDS = 30.0
+
+_thread_state = threading.local()
+
+
+def _parse_limits(raw: str) -> Dict[str, int]:
+    """Converte "sheets:4,drive:8" em {"sheets": 4, "drive": 8}, ignorando entradas inválidas."""
+    limits = {}
+    for part in (raw or "").split(","):
+        name, _, value = part.partition(":")
+        try:
+            limits[name.strip().lower()] = max(int(value), 1)
+        except ValueError:
+            continue
+    return limits
+
+
+def authorized_http(credentials):
+    """
+    Retorna um cliente HTTP autenticado exclusivo da thread corrente.
+
+    O httplib2 usado pelo googleapiclient não é thread-safe; como os objetos `service` são
+    compartilhados (singletons), cada thread do pool executa as requisições com a sua própria conexão.
+
+    @param credentials: Credenciais google-auth (service account ou OAuth do usuário).
+    @returns: google_auth_httplib2.AuthorizedHttp associado às credenciais nesta thread.
+    """
+    import httplib2
+    import google_auth_httplib2
+
+    cache = getattr(_thread_state, "http_by_credentials", None)
+    if cache is None:
+        cache = _thread_state.http_by_credentials = weakref.WeakKeyDictionary()
+    http = cache.get(credentials)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        cache[credentials] = http
+    return http
+
+
+def _execute_request(request) -> Any:
+    """Executa um HttpRequest do googleapiclient usando a conexão da thread corrente."""
+    credentials = getattr(getattr(request, "http", None), "credentials", None)
+    if credentials is None:
+        return request.execute()
+    return request.execute(http=authorized_http(credentials))
+
+
+def _is_idempotent(request, idempotent: Optional[bool]) -> bool:
+    """Só GETs são repetidos por padrão; escritas precisam de idempotent=True explícito (ex: values().update)."""
+    if idempotent is not None:
+        return idempotent
+    return (getattr(request, "method", None) or "").upper() == "GET"
+
+
+def _is_retryable(error: Exception, idempotent: bool) -> bool:
+    """
+    Indica se vale repetir a requisição.
+
+    Requisições idempotentes: erros transitórios, de cota e qualquer falha de rede. Escritas não idempotentes
+    (append, insert, copy, create...): só erros que garantem que nada foi aplicado (limite de taxa/cota e
+    falha ao conectar); um timeout depois do envio pode ter sido aplicado pelo servidor e não é repetido.
+
+    @param error: Exceção da execução.
+    @param idempotent: Se repetir a requisição não tem efeito adicional.
+    """
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        status = error.resp.status if error.resp is not None else None
+        if status == 429:
+            return True
+        if status == 403:
+            detalhe = str(error).replace(" ", "").lower()
+            return any(reason in detalhe for reason in RATE_LIMIT_REASONS)
+        return idempotent and status in RETRYABLE_STATUSES
+    # Conexão recusada ou DNS: a requisição não chegou ao servidor
+    if isinstance(error, (ConnectionRefusedError, socket.gaierror, httplib2.ServerNotFoundError)):
+        return True
+    # Demais falhas de rede (ConnectionError, TimeoutError e socket.timeout são OSError)
+    return idempotent and isinstance(error, OSError)
+
+
+class GoogleApiClient:
+    """
+    Adaptador assíncrono para as APIs do Google (Sheets, Drive, Calendar).
+
+    O googleapiclient é síncrono: cada `.execute()` é despachado para um pool de threads limitado,
+    com um semáforo por API (evita que uma sincronização grande de Drive esgote as threads da Agenda)
+    e novas tentativas com backoff exponencial + jitter para erros transitórios e de cota. Escritas não
+    idempotentes só são repetidas quando o erro garante que o servidor não as aplicou (ver `_is_retryable`).
+    """
+
+    def __init__(self, max_workers: int, limits: Dict[str, int], default_limit: int, max_retries: int, backoff_base: float):
+        self.max_retries = max(max_retries, 0)
+        self.backoff_base = backoff_base
+        self._limits = limits
+        self._default_limit = max(default_limit, 1)
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(max_workers, 1), thread_name_prefix="google-api")
+
+    def _semaphore(self, api: str) -> asyncio.Semaphore:
+        sem = self._semaphores.get(api)
+        if sem is None:
+            sem = self._semaphores[api] = asyncio.Semaphore(self._limits.get(api, self._default_limit))
+        return sem
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_base * (2 ** attempt), MAX_BACKOFF_SECONDS)
+        return delay + random.uniform(0, delay / 2)
+
+    async def execute(self, request, api: str, idempotent: Optional[bool] = None) -> Any:
+        """
+        Executa um HttpRequest do googleapiclient sem bloquear o event loop.
+
+        @param request: Requisição montada (ex: service.files().list(...)), ainda não executada.
+        @param api: Nome da API para o limite de concorrência ('sheets', 'drive', 'calendar').
+        @param idempotent: Se a requisição pode ser repetida após qualquer erro transitório (padrão: apenas GET).
+        @returns: Corpo da resposta já decodificado.
+        """
+        loop = asyncio.get_running_loop()
+        idempotent = _is_idempotent(request, idempotent)
+        attempt = 0
+        while True:
+            async with self._semaphore(api):
+                try:
+                    return await loop.run_in_executor(self._executor, _execute_request, request)
+                except Exception as e:
+                    if attempt >= self.max_retries or not _is_retryable(e, idempotent):
+                        raise
+                    delay = self._backoff(attempt)
+                    erro = e
+            # O backoff acontece fora do semáforo para não segurar a vaga de outras requisições
+            attempt += 1
+            logger.warning(f"Google API ({api}): Falha transitória ({erro}). Tentativa {attempt}/{self.max_retries} em {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+    def execute_blocking(self, request, api: str, idempotent: Optional[bool] = None) -> Any:
+        """
+        Versão síncrona de `execute`, para código que já roda fora do event loop (ex: rotina de backup).
+
+        @param request: Requisição montada, ainda não executada.
+        @param api: Nome da API (apenas para log).
+        @param idempotent: Se a requisição pode ser repetida após qualquer erro transitório (padrão: apenas GET).
+        @returns: Corpo da resposta já decodificado.
+        """
+        idempotent = _is_idempotent(request, idempotent)
+        attempt = 0
+        while True:
+            try:
+                return _execute_request(request)
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e, idempotent):
+                    raise
+                delay = self._backoff(attempt)
+                attempt += 1
+                logger.warning(f"Google API ({api}): Falha transitória ({e}). Tentativa {attempt}/{self.max_retries} em {delay:.1f}s...")
+                time.sleep(delay)
+
+    async def run(self, api: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Executa no pool uma função bloqueante arbitrária (ex: download em partes, fluxo OAuth),
+        respeitando o limite de concorrência da API. Não há novas tentativas automáticas.
+
+        @param api: Nome da API para o limite de concorrência.
+        @param func: Função síncrona a executar.
+        @returns: Retorno de func.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._semaphore(api):
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+
+_google_api_client_instance: Optional[GoogleApiClient] = None
+
+def get_google_api_client() -> GoogleApiClient:
+    global _google_api_client_instance
+    if _google_api_client_instance is None:
+        _google_api_client_instance = GoogleApiClient(
+            max_workers=settings.GOOGLE_API_MAX_WORKERS,
+            limits=_parse_limits(settings.GOOGLE_API_CONCURRENCY),
+            default_limit=settings.GOOGLE_API_DEFAULT_CONCURRENCY,
+            max_retries=settings.GOOGLE_API_MAX_RETRIES,
+            backoff_base=settings.GOOGLE_API_BACKOFF_BASE_SECONDS
+        )
+    return _google_api_client_instance
@@ -6,6 +6,7 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
 from app.core.config import settings
+from app.services.google_api_client import get_google_api_client
 from app.db import models
 
 logger = logging.getLogger(__name__)
@@ -70,9 +71,9 @@ class GoogleCalendarService:
             raise Exception("Configuração não autenticada com o Google Calendar.")
         return build('calendar', 'v3', credentials=credentials)
 
-    def get_upcoming_events(self, max_results: int = 50, time_min: Optional[str] = None, time_max: Optional[str] = None) -> List[Dict[str, Any]]:
+    async def get_upcoming_events(self, max_results: int = 50, time_min: Optional[str] = None, time_max: Optional[str] = None) -> List[Dict[str, Any]]:
         """Busca os próximos eventos agendados no calendário principal."""
-        service = self.get_service()
+        service = await get_google_api_client().run("calendar", self.get_service)
         t_min = time_min or datetime.now(timezone.utc).isoformat()
         
         list_kwargs = {
@@ -85,7 +86,7 @@ class GoogleCalendarService:
         if time_max:
             list_kwargs["timeMax"] = time_max
             
-        events_result = service.events().list(**list_kwargs).execute()
+        events_result = await get_google_api_client().execute(service.events().list(**list_kwargs), "calendar")
         return events_result.get('items', [])
 
 def get_google_calendar_service(config: models.Config) -> GoogleCalendarService:
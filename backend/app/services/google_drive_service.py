@@ -1,11 +1,29 @@
+import asyncio
 import logging
 import json
+from collections import deque
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from app.core.config import settings  # <--- Importando suas configurações
+from app.services.google_api_client import authorized_http, get_google_api_client
 
 logger = logging.getLogger(__name__)
 
+# Campos pedidos à Changes API: apenas o necessário para decidir se a mudança afeta a pasta sincronizada
+CHANGES_FIELDS = "nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, parents, trashed, modifiedTime, md5Checksum))"
+
+
+# Listagem da árvore: apenas os campos usados pela árvore/indexador (+ parents para atribuir o item à pasta certa)
+CRAWL_FIELDS = "nextPageToken, files(id, name, mimeType, webViewLink, modifiedTime, md5Checksum, parents)"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+class DriveChangesTokenExpired(Exception):
+    """Exceção levantada quando o page token da Changes API não é mais aceito (expirado/inválido)."""
+    pass
+
+
 class GoogleDriveService:
     def __init__(self):
         self.service = None
@@ -46,7 +64,29 @@ class GoogleDriveService:
         if 'folder' in mime_type: return 'Pasta'
         return 'Arquivo'
 
-    async def list_files_in_folder(self, root_folder_id: str):
+    def file_entry(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """Converte um item de files.list no formato de arquivo usado pela árvore e pelo indexador."""
+        return {
+            "nome": item['name'],
+            "id": item['id'],
+            "tipo": self._get_readable_type(item['mimeType']),
+            "mimeType": item.get('mimeType', ''),
+            "link": item.get('webViewLink', ''),
+            "modifiedTime": item.get('modifiedTime'),
+            "md5Checksum": item.get('md5Checksum')
+        }
+
+    def crawl(self, root_folder_id: str, max_files: Optional[int] = None) -> "DriveFolderCrawler":
+        """
+        Cria um crawler paralelo para a pasta informada (ver DriveFolderCrawler).
+
+        @param root_folder_id: ID da pasta raiz.
+        @param max_files: Limite de arquivos (None usa DRIVE_MAX_FILES; 0 = sem limite).
+        @returns: Crawler cujo método items() percorre a árvore.
+        """
+        return DriveFolderCrawler(self, root_folder_id, settings.DRIVE_MAX_FILES if max_files is None else max_files)
+
+    async def list_files_in_folder(self, root_folder_id: str, max_files: Optional[int] = None):
         """
         Lista arquivos recursivamente e retorna uma estrutura de árvore (Nested JSON).
         Formato:
@@ -60,114 +100,120 @@ class GoogleDriveService:
         """
         if not self.service:
             logger.error("Drive: Tentativa de uso sem serviço inicializado.")
-            return {"tree": {}, "count": 0}
+            return {"tree": {}, "count": 0, "folder_ids": [], "truncated": False}
+
+        crawler = self.crawl(root_folder_id, max_files)
+        root_structure = None
+        # MAPA DE REFERÊNCIA: id_da_pasta -> objeto_da_pasta (na memória)
+        folder_map: Dict[str, Dict[str, Any]] = {}
 
-        # 1. Tenta pegar o nome da pasta raiz para o objeto inicial
         try:
-            root_meta = self.service.files().get(fileId=root_folder_id, fields='name').execute()
-            root_name = root_meta.get('name', 'Raiz')
-        except Exception:
-            root_name = 'Pasta Principal'
+            async for parent_id, path, item in crawler.items():
+                if root_structure is None:
+                    root_structure = folder_map[root_folder_id] = {"nome": crawler.root_name, "arquivos": [], "subpastas": []}
+                parent_node = folder_map[parent_id]
+                if item['mimeType'] == FOLDER_MIME_TYPE:
+                    if item['id'] not in folder_map:
+                        folder_map[item['id']] = {"nome": item['name'], "arquivos": [], "subpastas": []}
+                        parent_node['subpastas'].append(folder_map[item['id']])
+                else:
+                    parent_node['arquivos'].append(self.file_entry(item))
+        except Exception as e:
+            logger.error(f"Drive: Erro ao listar arquivos recursivamente: {e}")
+            raise e
 
-        # Estrutura inicial da árvore
-        root_structure = {
-            "nome": root_name,
-            "arquivos": [],
-            "subpastas": []
+        if root_structure is None:
+            root_structure = {"nome": crawler.root_name, "arquivos": [], "subpastas": []}
+        logger.info(f"Drive: Varredura completa. {crawler.files_count} arquivos organizados em árvore.")
+        return {
+            "tree": root_structure,
+            "count": crawler.files_count,
+            "folder_ids": crawler.folder_ids,
+            "truncated": crawler.truncated
         }
 
-        # MAPA DE REFERÊNCIA: id_da_pasta -> objeto_da_pasta (na memória)
-        # Isso permite que a gente encontre e preencha a subpasta correta durante o loop
-        folder_map = {root_folder_id: root_structure}
+    async def get_start_page_token(self) -> str:
+        """
+        Obtém o page token atual da Changes API (ponto de partida para sincronizações incrementais).
 
-        # Fila de processamento (apenas IDs)
-        folders_to_scan = [root_folder_id]
-        scanned_folders = set()
-        
-        MAX_FILES_LIMIT = 500
-        total_files_count = 0
+        @returns: Token a ser persistido e usado na próxima consulta de mudanças.
+        """
+        if not self.service: raise Exception("Serviço do Google Drive não inicializado.")
+        response = await get_google_api_client().execute(self.service.changes().getStartPageToken(supportsAllDrives=True), "drive")
+        return response.get("startPageToken")
+
+    async def list_changes(self, page_token: str):
+        """
+        Lista todas as mudanças ocorridas desde o page token informado.
+
+        @param page_token: Token salvo na sincronização anterior.
+        @returns: Tupla (lista de mudanças, novo start page token).
+        @raises DriveChangesTokenExpired: Se o token não for mais válido (exige nova varredura completa).
+        """
+        from googleapiclient.errors import HttpError
 
+        if not self.service: raise Exception("Serviço do Google Drive não inicializado.")
+        changes = []
+        token = page_token
         try:
-            while folders_to_scan and total_files_count < MAX_FILES_LIMIT:
-                current_folder_id = folders_to_scan.pop(0)
-                
-                # Recupera a referência do objeto desta pasta no mapa
-                current_folder_node = folder_map.get(current_folder_id)
-
-                if current_folder_id in scanned_folders:
-                    continue
-                
-                scanned_folders.add(current_folder_id)
-                
-                # Loop de Paginação
-                page_token = None
-                while True:
-                    if total_files_count >= MAX_FILES_LIMIT: break
-
-                    query = f"'{current_folder_id}' in parents and trashed = false"
-                    
-                    results = self.service.files().list(
-                        q=query,
-                        pageSize=100,
-                        fields="nextPageToken, files(id, name, mimeType, webViewLink)",
-                        pageToken=page_token
-                    ).execute()
-                    
-                    items = results.get('files', [])
-                    
-                    for item in items:
-                        if item['mimeType'] == 'application/vnd.google-apps.folder':
-                            # É PASTA: 
-                            # 1. Cria o objeto da nova pasta
-                            new_folder_node = {
-                                "nome": item['name'],
-                                "arquivos": [],
-                                "subpastas": []
-                            }
-                            # 2. Adiciona este objeto na lista de subpastas da pasta PAI (current_folder_node)
-                            current_folder_node['subpastas'].append(new_folder_node)
-                            
-                            # 3. Registra no mapa para podermos preenchê-la quando chegar a vez dela na fila
-                            folder_map[item['id']] = new_folder_node
-                            folders_to_scan.append(item['id'])
-                        else:
-                            # É ARQUIVO: Adiciona na lista de arquivos da pasta atual
-                            current_folder_node['arquivos'].append({
-                                "nome": item['name'],
-                                "id": item['id'],
-                                "tipo": self._get_readable_type(item['mimeType']),
-                                "mimeType": item.get('mimeType', ''),
-                                "link": item.get('webViewLink', '')
-                            })
-                            total_files_count += 1
-                    
-                    page_token = results.get('nextPageToken')
-                    if not page_token:
-                        break
-            
-            logger.info(f"Drive: Varredura completa. {total_files_count} arquivos organizados em árvore.")
-            return {"tree": root_structure, "count": total_files_count}
+            while token:
+                response = await get_google_api_client().execute(
+                    self.service.changes().list(
+                        pageToken=token,
+                        pageSize=1000,
+                        spaces="drive",
+                        includeRemoved=True,
+                        includeItemsFromAllDrives=True,
+                        supportsAllDrives=True,
+                        fields=CHANGES_FIELDS
+                    ),
+                    "drive"
+                )
+                changes.extend(response.get("changes", []))
+                if response.get("newStartPageToken"):
+                    return changes, response["newStartPageToken"]
+                token = response.get("nextPageToken")
+        except HttpError as e:
+            if e.resp is not None and e.resp.status in (400, 404, 410):
+                raise DriveChangesTokenExpired(str(e)) from e
+            raise
+        return changes, page_token
 
-        except Exception as e:
-            logger.error(f"Drive: Erro ao listar arquivos recursivamente: {e}")
-            raise e
+    async def get_file_revision(self, file_id: str) -> Optional[str]:
+        """
+        Obtém a versão atual do arquivo (incrementada pelo Drive a cada alteração).
 
-    def download_file_bytes(self, file_id: str):
-        """Baixa o conteúdo do arquivo em memória (bytes)."""
+        @param file_id: ID do arquivo (ex: planilha).
+        @returns: Versão em string, ou None se não disponível.
+        """
+        if not self.service: raise Exception("Serviço do Google Drive não inicializado.")
+        response = await get_google_api_client().execute(
+            self.service.files().get(fileId=file_id, fields="version", supportsAllDrives=True),
+            "drive"
+        )
+        version = response.get("version")
+        return str(version) if version is not None else None
+
+    def _download_file_bytes_sync(self, file_id: str) -> bytes:
+        """Download em partes (bloqueante); executado no pool do cliente das APIs do Google."""
         from googleapiclient.http import MediaIoBaseDownload
         import io
 
+        request = self.service.files().get_media(fileId=file_id)
+        request.http = authorized_http(self.creds)
+        file_io = io.BytesIO()
+        downloader = MediaIoBaseDownload(file_io, request)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+        return file_io.getvalue()
+
+    async def download_file_bytes(self, file_id: str):
+        """Baixa o conteúdo do arquivo em memória (bytes)."""
         if not self.service: return None
         
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            file_io = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_io, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-            
-            return file_io.getvalue()
+            return await get_google_api_client().run("drive", self._download_file_bytes_sync, file_id)
         except Exception as e:
             logger.error(f"Drive: Erro no download: {e}")
             return None
@@ -177,13 +223,17 @@ class GoogleDriveService:
         if not self.service: raise Exception("Serviço do Google Drive não inicializado.")
         try:
             body = {'name': new_title}
-            new_file = self.service.files().copy(fileId=base_file_id, body=body, supportsAllDrives=True).execute()
+            new_file = await get_google_api_client().execute(
+                self.service.files().copy(fileId=base_file_id, body=body, supportsAllDrives=True), "drive"
+            )
             new_file_id = new_file.get('id')
             
             for email in emails:
                 if email and "@" in email:
                     perm = {'type': 'user', 'role': 'writer', 'emailAddress': email.strip()}
-                    self.service.permissions().create(fileId=new_file_id, body=perm, sendNotificationEmail=True).execute()
+                    await get_google_api_client().execute(
+                        self.service.permissions().create(fileId=new_file_id, body=perm, sendNotificationEmail=True), "drive"
+                    )
             return new_file_id
         except Exception as e:
             logger.error(f"Erro ao copiar arquivo {base_file_id}: {e}")
@@ -194,13 +244,15 @@ class GoogleDriveService:
         if not self.service: raise Exception("Serviço do Google Drive não inicializado.")
         try:
             file_metadata = {'name': folder_name, 'mimeType': 'application/vnd.google-apps.folder'}
-            folder = self.service.files().create(body=file_metadata, fields='id').execute()
+            folder = await get_google_api_client().execute(self.service.files().create(body=file_metadata, fields='id'), "drive")
             folder_id = folder.get('id')
             
             for email in emails:
                 if email and "@" in email:
                     perm = {'type': 'user', 'role': 'writer', 'emailAddress': email.strip()}
-                    self.service.permissions().create(fileId=folder_id, body=perm, sendNotificationEmail=True).execute()
+                    await get_google_api_client().execute(
+                        self.service.permissions().create(fileId=folder_id, body=perm, sendNotificationEmail=True), "drive"
+                    )
             return folder_id
         except Exception as e:
             logger.error(f"Erro ao criar pasta: {e}")
@@ -216,11 +268,14 @@ class GoogleDriveService:
                 'parents': [parent_folder_id]
             }
             media = MediaInMemoryUpload(file_content_bytes, mimetype=mime_type, resumable=True)
-            file = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
+            file = get_google_api_client().execute_blocking(
+                self.service.files().create(
+                    body=file_metadata,
+                    media_body=media,
+                    fields='id'
+                ),
+                "drive"
+            )
             return file.get('id')
         except Exception as e:
             logger.error(f"Erro ao fazer upload de arquivo para a pasta {parent_folder_id}: {e}")
@@ -251,17 +306,20 @@ class GoogleDriveService:
                     f"and trashed = false "
                     f"and createdTime < '{cutoff_str}'"
                 )
-                results = self.service.files().list(
-                    q=query,
-                    pageSize=100,
-                    fields="nextPageToken, files(id, name, createdTime)",
-                    pageToken=page_token
-                ).execute()
+                results = get_google_api_client().execute_blocking(
+                    self.service.files().list(
+                        q=query,
+                        pageSize=100,
+                        fields="nextPageToken, files(id, name, createdTime)",
+                        pageToken=page_token
+                    ),
+                    "drive"
+                )
 
                 items = results.get('files', [])
                 for item in items:
                     try:
-                        self.service.files().delete(fileId=item['id']).execute()
+                        get_google_api_client().execute_blocking(self.service.files().delete(fileId=item['id']), "drive")
                         logger.info(
                             f"Drive: Backup antigo excluído — '{item['name']}' "
                             f"(criado em {item.get('createdTime', 'desconhecido')})"
@@ -283,7 +341,7 @@ class GoogleDriveService:
 
         return deleted_count
 
-    def watch_file(self, file_id: str, channel_id: str, webhook_url: str, token: str = None):
+    async def watch_file(self, file_id: str, channel_id: str, webhook_url: str, token: str = None):
         """Registra um canal de watch (push notifications) para um arquivo ou pasta."""
         if not self.service:
             logger.error("Drive: Tentativa de watch sem serviço inicializado.")
@@ -297,12 +355,110 @@ class GoogleDriveService:
             if token:
                 body['token'] = token
             logger.info(f"Drive: Registrando watch para o arquivo/pasta {file_id} no canal {channel_id} (URL: {webhook_url})")
-            return self.service.files().watch(fileId=file_id, body=body).execute()
+            return await get_google_api_client().execute(self.service.files().watch(fileId=file_id, body=body), "drive")
         except Exception as e:
             logger.error(f"Drive: Erro ao registrar watch para {file_id}: {e}", exc_info=True)
             raise e
 
 
+class DriveFolderCrawler:
+    """
+    Varredura paralela de uma árvore de pastas do Drive.
+
+    Pastas pendentes são agrupadas em consultas "'a' in parents or 'b' in parents" (até
+    DRIVE_CRAWL_PARENTS_PER_QUERY por consulta) e até DRIVE_CRAWL_CONCURRENCY consultas rodam ao mesmo
+    tempo; subpastas entram na fila assim que descobertas, sem esperar o nível atual terminar.
+    Os itens são entregues conforme as páginas chegam, para o consumidor (árvore ou indexador)
+    processá-los sem esperar a varredura completa.
+    """
+
+    def __init__(self, drive_service: "GoogleDriveService", root_folder_id: str, max_files: int):
+        self.drive_service = drive_service
+        self.root_folder_id = root_folder_id
+        self.max_files = max_files
+        self.root_name = "Pasta Principal"
+        self.folder_ids: List[str] = [root_folder_id]
+        self.files_count = 0
+        self.truncated = False
+
+    async def _list_children(self, parent_ids: List[str]) -> List[Dict[str, Any]]:
+        """Lista (todas as páginas) os filhos diretos de um grupo de pastas."""
+        parents = " or ".join(f"'{pid}' in parents" for pid in parent_ids)
+        query = f"({parents}) and trashed = false"
+        items = []
+        page_token = None
+        while True:
+            results = await get_google_api_client().execute(
+                self.drive_service.service.files().list(
+                    q=query,
+                    pageSize=1000,
+                    fields=CRAWL_FIELDS,
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True
+                ),
+                "drive"
+            )
+            items.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return items
+
+    async def items(self) -> AsyncIterator[Tuple[str, List[str], Dict[str, Any]]]:
+        """
+        Percorre a árvore a partir da pasta raiz.
+
+        @returns: Iterador assíncrono de (id da pasta pai, caminho de nomes até a pasta pai, item bruto de files.list).
+                  Pastas também são entregues (mimeType de pasta), antes dos seus filhos.
+        """
+        try:
+            root_meta = await get_google_api_client().execute(
+                self.drive_service.service.files().get(fileId=self.root_folder_id, fields='name', supportsAllDrives=True), "drive"
+            )
+            self.root_name = root_meta.get('name', 'Raiz')
+        except Exception:
+            pass
+
+        paths: Dict[str, List[str]] = {self.root_folder_id: [self.root_name]}
+        pending = deque([self.root_folder_id])
+        running: Dict[asyncio.Task, List[str]] = {}
+        per_query = max(settings.DRIVE_CRAWL_PARENTS_PER_QUERY, 1)
+        concurrency = max(settings.DRIVE_CRAWL_CONCURRENCY, 1)
+
+        try:
+            while pending or running:
+                while pending and len(running) < concurrency:
+                    group = [pending.popleft() for _ in range(min(per_query, len(pending)))]
+                    running[asyncio.create_task(self._list_children(group))] = group
+
+                done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    group = running.pop(task)
+                    group_set = set(group)
+                    for item in task.result():
+                        # Um item pode estar em mais de uma pasta do grupo (atalhos/múltiplos pais)
+                        for parent_id in [p for p in item.get('parents', []) if p in group_set]:
+                            if item['mimeType'] == FOLDER_MIME_TYPE:
+                                if item['id'] in paths:
+                                    continue
+                                paths[item['id']] = paths[parent_id] + [item['name']]
+                                self.folder_ids.append(item['id'])
+                                pending.append(item['id'])
+                            else:
+                                if self.max_files and self.files_count >= self.max_files:
+                                    self.truncated = True
+                                    logger.warning(
+                                        f"Drive: Limite de {self.max_files} arquivos atingido na pasta {self.root_folder_id}. "
+                                        f"A listagem foi interrompida (ajuste DRIVE_MAX_FILES)."
+                                    )
+                                    return
+                                self.files_count += 1
+                            yield parent_id, paths[parent_id], item
+        finally:
+            for task in running:
+                task.cancel()
+
+
 _drive_service = None
 def get_drive_service():
     global _drive_service
@@ -2,15 +2,46 @@
 
 import logging
 import json
+import time
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Any
+from typing import Dict, List, Any, AsyncIterator, Tuple
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from app.core.config import settings  # <--- Importando suas configurações
+from app.services.google_api_client import get_google_api_client
 
 logger = logging.getLogger(__name__)
 
+# Fields masks: a API devolve apenas o que é usado
+METADATA_FIELDS = "sheets(properties(title))"
+VALUES_FIELDS = "valueRanges(values)"
+
+# Cache de metadados por planilha: spreadsheet_id -> (instante da leitura, títulos das abas)
+_metadata_cache: Dict[str, Tuple[float, List[str]]] = {}
+
+
+def extract_spreadsheet_id(spreadsheet_id_or_url: str) -> str:
+    """
+    Extrai o ID da planilha de uma URL do Google Sheets (entre /d/ e a próxima barra).
+
+    @param spreadsheet_id_or_url: ID ou URL completa.
+    @returns: ID da planilha (ou o valor original se não for uma URL reconhecida).
+    """
+    if "docs.google.com" not in spreadsheet_id_or_url:
+        return spreadsheet_id_or_url
+    start = spreadsheet_id_or_url.find("/d/") + 3
+    end = spreadsheet_id_or_url.find("/", start)
+    return spreadsheet_id_or_url[start:] if end == -1 else spreadsheet_id_or_url[start:end]
+
+
+def quote_sheet_range(title: str, cells: str = "") -> str:
+    """Monta um intervalo A1 com o nome da aba entre aspas (aspas simples internas são duplicadas)."""
+    quoted = "'" + title.replace("'", "''") + "'"
+    return f"{quoted}!{cells}" if cells else quoted
+
+
 class GoogleSheetsService:
     def __init__(self):
         self.scopes = ['https://www.googleapis.com/auth/spreadsheets']
@@ -39,7 +70,63 @@ class GoogleSheetsService:
             logger.error(f"Sheets: Erro crítico na inicialização: {e}", exc_info=True)
             self.service = None
 
-    async def get_sheet_as_json(self, spreadsheet_id_or_url: str) -> Dict[str, List[Dict[str, Any]]]:
+    async def get_sheet_titles(self, spreadsheet_id: str, refresh: bool = False) -> List[str]:
+        """
+        Retorna os nomes das abas, usando o cache de metadados quando ainda válido.
+
+        @param spreadsheet_id: ID da planilha.
+        @param refresh: Ignora o cache e consulta a API (ex: sincronização disparada por alteração na planilha).
+        @returns: Títulos das abas na ordem da planilha.
+        """
+        cached = _metadata_cache.get(spreadsheet_id)
+        if cached and not refresh and time.monotonic() - cached[0] < settings.SHEETS_METADATA_CACHE_TTL_SECONDS:
+            return cached[1]
+
+        sheet_metadata = await get_google_api_client().execute(
+            self.service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields=METADATA_FIELDS), "sheets"
+        )
+        titles = [s['properties']['title'] for s in sheet_metadata.get('sheets', [])]
+        _metadata_cache[spreadsheet_id] = (time.monotonic(), titles)
+        return titles
+
+    async def batch_get_values(self, spreadsheet_id: str, ranges: List[str]) -> List[List[List[Any]]]:
+        """
+        Lê vários intervalos em uma única chamada values:batchGet.
+
+        @param spreadsheet_id: ID da planilha.
+        @param ranges: Intervalos em notação A1 (ex: "'Aba'!A:B").
+        @returns: Lista de linhas de cada intervalo, na mesma ordem de `ranges`.
+        """
+        if not ranges:
+            return []
+        result = await get_google_api_client().execute(
+            self.service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges, fields=VALUES_FIELDS),
+            "sheets"
+        )
+        value_ranges = result.get('valueRanges', [])
+        return [(value_ranges[i].get('values', []) if i < len(value_ranges) else []) for i in range(len(ranges))]
+
+    async def _read_all_tabs(self, spreadsheet_id: str, refresh_metadata: bool = False) -> List[Tuple[str, List[List[Any]]]]:
+        """
+        Lê todas as abas em uma única ida à API (metadados em cache + batchGet).
+        Se uma aba do cache foi renomeada/excluída, o batchGet falha com 400: os metadados são
+        recarregados e a leitura é refeita uma vez.
+        """
+        titles = await self.get_sheet_titles(spreadsheet_id, refresh=refresh_metadata)
+        try:
+            values = await self.batch_get_values(spreadsheet_id, [quote_sheet_range(t) for t in titles])
+        except HttpError as e:
+            if refresh_metadata or e.resp is None or e.resp.status != 400:
+                raise
+            logger.info(f"Sheets: Metadados em cache desatualizados para a planilha {spreadsheet_id}. Recarregando abas...")
+            titles = await self.get_sheet_titles(spreadsheet_id, refresh=True)
+            values = await self.batch_get_values(spreadsheet_id, [quote_sheet_range(t) for t in titles])
+
+        if not titles:
+            raise Exception("Nenhuma aba encontrada na planilha.")
+        return list(zip(titles, values))
+
+    async def get_sheet_as_json(self, spreadsheet_id_or_url: str, refresh_metadata: bool = False) -> Dict[str, List[Dict[str, Any]]]:
         """
         Busca os dados da planilha usando a API do Google (privada).
         Aceita o ID da planilha ou tenta extrair o ID da URL.
@@ -47,47 +134,17 @@ class GoogleSheetsService:
         if not self.service:
             raise Exception("Serviço Google Sheets não está autenticado/inicializado.")
 
-        # Lógica simples para extrair ID se o usuário mandar a URL completa
-        spreadsheet_id = spreadsheet_id_or_url
-        if "docs.google.com" in spreadsheet_id_or_url:
-            # Tenta pegar o ID entre /d/ e /edit
-            try:
-                start = spreadsheet_id_or_url.find("/d/") + 3
-                end = spreadsheet_id_or_url.find("/", start)
-                if end == -1: # Caso não tenha barra final
-                    spreadsheet_id = spreadsheet_id_or_url[start:]
-                else:
-                    spreadsheet_id = spreadsheet_id_or_url[start:end]
-            except:
-                pass # Falha silenciosa, tenta usar o original
-
+        spreadsheet_id = extract_spreadsheet_id(spreadsheet_id_or_url)
         final_json_context = {}
 
         try:
-            # 1. Busca metadados para saber os nomes das abas
-            sheet_metadata = self.service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            sheets = sheet_metadata.get('sheets', [])
-
-            if not sheets:
-                raise Exception("Nenhuma aba encontrada na planilha.")
-
-            # 2. Itera sobre cada aba
-            for sheet in sheets:
-                title = sheet['properties']['title']
-                
-                # Pega todos os valores da aba
-                result = self.service.spreadsheets().values().get(
-                    spreadsheetId=spreadsheet_id, 
-                    range=title
-                ).execute()
-                
-                rows = result.get('values', [])
-
+            # 1. Todas as abas em uma única leitura
+            for title, rows in await self._read_all_tabs(spreadsheet_id, refresh_metadata):
                 # Se tiver menos de 2 linhas (só cabeçalho ou vazio), ignora
                 if len(rows) < 2:
                     continue
 
-                # 3. Usa Pandas para limpar e estruturar (mantendo sua lógica original)
+                # 2. Usa Pandas para limpar e estruturar (mantendo sua lógica original)
                 # A primeira linha (rows[0]) vira cabeçalho
                 headers = rows[0]
                 data = rows[1:]
@@ -121,24 +178,44 @@ class GoogleSheetsService:
                 raise Exception("Planilha não encontrada (404). Verifique o ID.")
             raise Exception(f"Erro ao ler planilha: {str(e)}")
 
-    async def process_sheet_for_knowledge_base(self, spreadsheet_id_or_url: str) -> List[Dict[str, Any]]:
+    async def iter_knowledge_rows(self, spreadsheet_id_or_url: str, refresh_metadata: bool = False) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
         """
-        Lê a planilha e formata os dados para a estrutura KnowledgeVector (category, raw_data, content).
-        Prepara a base para receber embeddings e ser salva no banco.
+        Percorre as linhas da planilha de conhecimento (RAG), já limpas, sem montar DataFrames intermediários.
+
+        @param spreadsheet_id_or_url: ID ou URL da planilha.
+        @param refresh_metadata: Recarrega os nomes das abas em vez de usar o cache.
+        @returns: Iterador assíncrono de (nome da aba, linha {coluna: valor}) apenas com células preenchidas.
         """
         if not self.service:
             raise Exception("Serviço Google Sheets não está autenticado/inicializado.")
 
-        # Lógica de extração do ID da planilha
-        spreadsheet_id = spreadsheet_id_or_url
-        if "docs.google.com" in spreadsheet_id_or_url:
-            try:
-                start = spreadsheet_id_or_url.find("/d/") + 3
-                end = spreadsheet_id_or_url.find("/", start)
-                spreadsheet_id = spreadsheet_id_or_url[start:] if end == -1 else spreadsheet_id_or_url[start:end]
-            except:
-                pass # Falha silenciosa, tenta usar o original
+        spreadsheet_id = extract_spreadsheet_id(spreadsheet_id_or_url)
+        try:
+            tabs = await self._read_all_tabs(spreadsheet_id, refresh_metadata)
+        except Exception as e:
+            logger.error(f"Sheets: Erro ao processar planilha ID {spreadsheet_id}: {e}", exc_info=True)
+            if "403" in str(e):
+                raise Exception("Erro de Permissão (403). Você compartilhou a planilha com o email da Service Account?")
+            if "404" in str(e):
+                raise Exception("Planilha não encontrada (404). Verifique o ID.")
+            raise Exception(f"Erro ao ler planilha: {str(e)}")
 
+        for title, rows in tabs:
+            # Se tiver menos de 2 linhas (só cabeçalho ou vazio), ignora
+            if len(rows) < 2:
+                continue
+            headers = [str(h).strip() for h in rows[0]]
+            for row in rows[1:]:
+                # Remove células vazias; valores além da última coluna com cabeçalho são ignorados
+                clean_row = {h: v for h, v in zip(headers, row) if v is not None and str(v).strip() != ""}
+                if clean_row:
+                    yield title, clean_row
+
+    async def process_sheet_for_knowledge_base(self, spreadsheet_id_or_url: str) -> List[Dict[str, Any]]:
+        """
+        Lê a planilha e formata os dados para a estrutura KnowledgeVector (category, raw_data, content).
+        Prepara a base para receber embeddings e ser salva no banco.
+        """
         # Função auxiliar para categorizar com base no nome da aba
         def get_category_from_title(title: str) -> str:
             title_lower = title.lower()
@@ -152,80 +229,23 @@ class GoogleSheetsService:
 
         knowledge_vectors_ready = []
 
-        try:
-            # 1. Busca metadados para saber os nomes das abas
-            sheet_metadata = self.service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            sheets = sheet_metadata.get('sheets', [])
-
-            if not sheets:
-                raise Exception("Nenhuma aba encontrada na planilha.")
-
-            # 2. Itera sobre cada aba
-            for sheet in sheets:
-                title = sheet['properties']['title']
-                category = title
-                
-                # Pega todos os valores da aba
-                result = self.service.spreadsheets().values().get(
-                    spreadsheetId=spreadsheet_id, 
-                    range=title
-                ).execute()
-                
-                rows = result.get('values', [])
+        async for title, clean_row in self.iter_knowledge_rows(spreadsheet_id_or_url):
+            # CRIAÇÃO DO CONTENT (A string que vai receber embedding e busca ILIKE)
+            # Junta "Chave: Valor" de todas as colunas preenchidas
+            content_parts = [f"{key}: {val}" for key, val in clean_row.items()]
+            content_str = " | ".join(content_parts)
 
-                # Se tiver menos de 2 linhas (só cabeçalho ou vazio), ignora
-                if len(rows) < 2:
-                    continue
+            knowledge_vectors_ready.append({
+                "category": title,
+                "origin": "sheet",
+                "raw_data": clean_row,    # O JSON limpo para a IA ler
+                "content": content_str    # A string para busca/embedding
+            })
 
-                # 3. Limpeza estrutural com Pandas
-                headers = rows[0]
-                data = rows[1:]
+        if not knowledge_vectors_ready:
+            raise Exception("Nenhum dado válido encontrado nas abas da planilha após a limpeza.")
 
-                df = pd.DataFrame(data, columns=headers)
-
-                # Remove linhas/colunas totalmente vazias
-                df.dropna(how='all', axis=0, inplace=True) 
-                df.dropna(how='all', axis=1, inplace=True) 
-
-                # Substitui strings vazias e NaN por None para o JSON ficar limpo
-                df = df.replace(r'^\s*$', None, regex=True)
-                df = df.replace({np.nan: None})
-
-                # Converte para lista de dicionários
-                records = df.to_dict(orient='records')
-
-                # 4. Formatação final para o banco de dados
-                for row in records:
-                    # Remove chaves (colunas) onde o valor é nulo para economizar espaço
-                    clean_row = {str(k).strip(): v for k, v in row.items() if v is not None and str(v).strip() != ""}
-                    
-                    if not clean_row:
-                        continue
-                        
-                    # CRIAÇÃO DO CONTENT (A string que vai receber embedding e busca ILIKE)
-                    # Junta "Chave: Valor" de todas as colunas preenchidas
-                    content_parts = [f"{key}: {val}" for key, val in clean_row.items()]
-                    content_str = " | ".join(content_parts)
-                    
-                    knowledge_vectors_ready.append({
-                        "category": category,
-                        "origin": "sheet",
-                        "raw_data": clean_row,    # O JSON limpo para a IA ler
-                        "content": content_str    # A string para busca/embedding
-                    })
-
-            if not knowledge_vectors_ready:
-                raise Exception("Nenhum dado válido encontrado nas abas da planilha após a limpeza.")
-
-            return knowledge_vectors_ready
-
-        except Exception as e:
-            logger.error(f"Sheets: Erro ao processar planilha ID {spreadsheet_id}: {e}", exc_info=True)
-            if "403" in str(e):
-                raise Exception("Erro de Permissão (403). Você compartilhou a planilha com o email da Service Account?")
-            if "404" in str(e):
-                raise Exception("Planilha não encontrada (404). Verifique o ID.")
-            raise Exception(f"Erro ao ler planilha: {str(e)}")
+        return knowledge_vectors_ready
 
     async def apply_feedback_to_sheet(self, spreadsheet_id_or_url: str, alteracoes: List[Dict[str, Any]]):
         """
@@ -234,19 +254,16 @@ class GoogleSheetsService:
         if not self.service:
             raise Exception("Serviço Google Sheets não está autenticado/inicializado.")
 
-        spreadsheet_id = spreadsheet_id_or_url
-        if "docs.google.com" in spreadsheet_id_or_url:
-            try:
-                start = spreadsheet_id_or_url.find("/d/") + 3
-                end = spreadsheet_id_or_url.find("/", start)
-                spreadsheet_id = spreadsheet_id_or_url[start:] if end == -1 else spreadsheet_id_or_url[start:end]
-            except: pass
+        spreadsheet_id = extract_spreadsheet_id(spreadsheet_id_or_url)
 
         try:
-            sheet_metadata = self.service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            sheets = {s['properties']['title'].lower(): s['properties']['title'] for s in sheet_metadata.get('sheets', [])}
+            # Metadados frescos aqui; a releitura da planilha logo após o feedback reaproveita o cache
+            titles = await self.get_sheet_titles(spreadsheet_id, refresh=True)
+            sheets = {t.lower(): t for t in titles}
             if not sheets: raise Exception("Nenhuma aba encontrada na planilha.")
             
+            # 1. Resolve a aba de destino de cada alteração
+            planejadas = []
             for alt in alteracoes:
                 # Remove hashtags enviadas pela IA e garante minúsculas
                 aba_req = alt.get("aba", "").lower().replace("#", "").strip()
@@ -263,7 +280,16 @@ class GoogleSheetsService:
                 if not aba:
                     fallback = next((v for k, v in sheets.items() if "persona" in k or "regra" in k or "fluxo" in k), None)
                     aba = fallback if fallback else list(sheets.values())[0]
+                planejadas.append((alt, aba))
+
+            # 2. Lê as colunas A:B de todas as abas com substituições em um único batchGet
+            abas_leitura = list(dict.fromkeys(
+                aba for alt, aba in planejadas if str(alt.get("acao", "adicionar")).strip().lower() == "substituir"
+            ))
+            valores = await self.batch_get_values(spreadsheet_id, [quote_sheet_range(a, "A:B") for a in abas_leitura])
+            rows_by_tab = dict(zip(abas_leitura, valores))
 
+            for alt, aba in planejadas:
                 col1 = alt.get("coluna_1", "Nova Regra")
                 novo = alt.get("valor_novo", "")
                 acao = str(alt.get("acao", "adicionar")).strip().lower()
@@ -271,8 +297,7 @@ class GoogleSheetsService:
                 row_to_update = -1
                 
                 if acao == "substituir":
-                    result = self.service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"'{aba}'!A:B").execute()
-                    rows = result.get('values', [])
+                    rows = rows_by_tab.get(aba, [])
                     for i, row in enumerate(rows):
                         if i == 0: continue # Pula cabeçalho
                         
@@ -299,17 +324,28 @@ class GoogleSheetsService:
                 
                 if row_to_update != -1:
                     # Atualiza a linha existente
-                    self.service.spreadsheets().values().update(
-                        spreadsheetId=spreadsheet_id, range=f"'{aba}'!A{row_to_update}:B{row_to_update}",
-                        valueInputOption="USER_ENTERED", body={"values": [[col1, novo]]}
-                    ).execute()
+                    await get_google_api_client().execute(
+                        self.service.spreadsheets().values().update(
+                            spreadsheetId=spreadsheet_id, range=quote_sheet_range(aba, f"A{row_to_update}:B{row_to_update}"),
+                            valueInputOption="USER_ENTERED", body={"values": [[col1, novo]]}
+                        ),
+                        "sheets",
+                        idempotent=True # Reescreve o mesmo intervalo com os mesmos valores
+                    )
+                    # Mantém a cópia local coerente para as próximas alterações da mesma aba
+                    rows_by_tab[aba][row_to_update - 1] = [col1, novo]
                 else:
                     # Adiciona nova linha (Adicionar ou se não encontrou o que substituir)
-                    self.service.spreadsheets().values().append(
-                        spreadsheetId=spreadsheet_id, range=f"'{aba}'!A:B",
-                        valueInputOption="USER_ENTERED", insertDataOption="INSERT_ROWS",
-                        body={"values": [[col1, novo]]}
-                    ).execute()
+                    await get_google_api_client().execute(
+                        self.service.spreadsheets().values().append(
+                            spreadsheetId=spreadsheet_id, range=quote_sheet_range(aba, "A:B"),
+                            valueInputOption="USER_ENTERED", insertDataOption="INSERT_ROWS",
+                            body={"values": [[col1, novo]]}
+                        ),
+                        "sheets"
+                    )
+                    if aba in rows_by_tab:
+                        rows_by_tab[aba].append([col1, novo])
 
             return True
         except Exception as e:
@@ -0,0 +1,181 @@
+import logging
+import re
+import time
+import urllib.parse
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_HOST = "graph.facebook.com"
+# Amostras mantidas por endpoint para os percentis de latência
+LATENCY_SAMPLE_SIZE = 512
+
+_VERSION_SEGMENT = re.compile(r"^v\d+(\.\d+)?$")
+_ID_SEGMENT = re.compile(r"^(\d+|upload:.+)$")
+
+
+def endpoint_label(method: str, url: httpx.URL) -> str:
+    """
+    Rótulo do endpoint usado nas métricas: versão da API removida e IDs trocados por {id}
+    (ex: "POST /{id}/messages"). Hosts fora da Graph API (CDN de mídia) são agrupados pelo host.
+
+    @param method: Método HTTP.
+    @param url: URL da requisição.
+    @returns: Rótulo estável e de baixa cardinalidade.
+    """
+    if url.host != GRAPH_API_HOST:
+        return f"{method} {url.host}"
+    segments = []
+    for segment in url.path.strip("/").split("/"):
+        segment = urllib.parse.unquote(segment)
+        if not segment or _VERSION_SEGMENT.match(segment):
+            continue
+        segments.append("{id}" if _ID_SEGMENT.match(segment) else segment)
+    return f"{method} /" + "/".join(segments)
+
+
+class _EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples: Deque[float] = deque(maxlen=LATENCY_SAMPLE_SIZE)
+
+    def percentile(self, fraction: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class GraphApiMetrics:
+    """
+    Latência por endpoint da Graph API, medida do envio até o recebimento dos cabeçalhos da resposta.
+    Conta como erro as respostas 4xx/5xx e as falhas de rede/timeout. Um resumo é logado a cada
+    GRAPH_API_METRICS_LOG_EVERY requisições.
+    """
+
+    def __init__(self, log_every: int):
+        self.log_every = max(log_every, 0)
+        self.endpoints: Dict[str, _EndpointStats] = {}
+        self._since_log = 0
+
+    def record(self, label: str, elapsed_ms: float, error: bool) -> None:
+        stats = self.endpoints.get(label)
+        if stats is None:
+            stats = self.endpoints[label] = _EndpointStats()
+        stats.count += 1
+        stats.errors += int(error)
+        stats.total_ms += elapsed_ms
+        stats.max_ms = max(stats.max_ms, elapsed_ms)
+        stats.samples.append(elapsed_ms)
+
+        self._since_log += 1
+        if self.log_every and self._since_log >= self.log_every:
+            self._since_log = 0
+            self.log_summary()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        @returns: Por endpoint: requisições, erros, média, p50, p95 e máximo (ms).
+        """
+        return {
+            label: {
+                "count": stats.count,
+                "errors": stats.errors,
+                "avg_ms": round(stats.total_ms / stats.count, 1) if stats.count else 0.0,
+                "p50_ms": round(stats.percentile(0.50), 1),
+                "p95_ms": round(stats.percentile(0.95), 1),
+                "max_ms": round(stats.max_ms, 1),
+            }
+            for label, stats in self.endpoints.items()
+        }
+
+    def log_summary(self) -> None:
+        for label, data in sorted(self.snapshot().items()):
+            logger.info(
+                f"Graph API [{label}]: {data['count']} req, {data['errors']} erro(s), "
+                f"média {data['avg_ms']}ms, p50 {data['p50_ms']}ms, p95 {data['p95_ms']}ms, máx {data['max_ms']}ms"
+            )
+
+
+class _TimedTransport(httpx.AsyncBaseTransport):
+    """Transporte que delega ao pool HTTP e registra a latência de cada requisição nas métricas."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, metrics: GraphApiMetrics):
+        self._transport = transport
+        self._metrics = metrics
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        label = endpoint_label(request.method, request.url)
+        start = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            self._metrics.record(label, (time.perf_counter() - start) * 1000, error=True)
+            raise
+        self._metrics.record(label, (time.perf_counter() - start) * 1000, error=response.status_code >= 400)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+_graph_api_metrics_instance: Optional[GraphApiMetrics] = None
+
+def get_graph_api_metrics() -> GraphApiMetrics:
+    global _graph_api_metrics_instance
+    if _graph_api_metrics_instance is None:
+        _graph_api_metrics_instance = GraphApiMetrics(log_every=settings.GRAPH_API_METRICS_LOG_EVERY)
+    return _graph_api_metrics_instance
+
+
+_graph_api_client_instance: Optional[httpx.AsyncClient] = None
+
+def get_graph_api_client() -> httpx.AsyncClient:
+    """
+    Cliente HTTP compartilhado pelas chamadas à API do WhatsApp (Graph API e CDN de mídia da Meta).
+
+    Uma única instância por processo mantém as conexões TLS abertas (HTTP/2 multiplexa as requisições
+    simultâneas numa mesma conexão). Timeouts específicos continuam sendo passados em cada chamada.
+    """
+    global _graph_api_client_instance
+    if _graph_api_client_instance is None or _graph_api_client_instance.is_closed:
+        http2 = settings.GRAPH_API_HTTP2 and _http2_available()
+        if settings.GRAPH_API_HTTP2 and not http2:
+            logger.warning("Graph API: Pacote 'h2' não instalado; usando HTTP/1.1.")
+        limits = httpx.Limits(
+            max_connections=settings.GRAPH_API_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.GRAPH_API_MAX_KEEPALIVE,
+            keepalive_expiry=settings.GRAPH_API_KEEPALIVE_EXPIRY_SECONDS
+        )
+        transport = _TimedTransport(httpx.AsyncHTTPTransport(http2=http2, limits=limits), get_graph_api_metrics())
+        _graph_api_client_instance = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(30.0, connect=settings.GRAPH_API_CONNECT_TIMEOUT_SECONDS)
+        )
+        logger.info(f"Graph API: Cliente HTTP compartilhado criado ({'HTTP/2' if http2 else 'HTTP/1.1'}).")
+    return _graph_api_client_instance
+
+
+async def close_graph_api_client():
+    """Fecha o pool de conexões da Graph API no encerramento do processo (e loga as métricas acumuladas)."""
+    global _graph_api_client_instance
+    if _graph_api_client_instance is not None:
+        await _graph_api_client_instance.aclose()
+        _graph_api_client_instance = None
+        get_graph_api_metrics().log_summary()
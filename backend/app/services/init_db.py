@@ -3,6 +3,7 @@ from sqlalchemy import text, inspect
 from sqlalchemy.schema import CreateColumn, AddConstraint
 from app.db.database import engine
 from app.db import models
+from app.services.vector_index_service import ensure_hnsw_indexes
 
 logger = logging.getLogger(__name__)
 
@@ -310,6 +311,89 @@ END $$;
                 logger.info("Higienização de 'thinking_level' e 'tts_voice' na tabela configs concluída.")
             except Exception as clean_err:
                 logger.warning(f"Aviso ao higienizar colunas da tabela configs: {clean_err}")
+
+            # --- ID DOS ITENS DE INTEGRAÇÃO EM COLUNA PRÓPRIA (antes só existia em raw_data) ---
+            # IDs acima de 255 caracteres viram 'sha256:<hex>', como em integration_service.integration_item_key
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(text("""
+                    UPDATE contextos SET integration_item_id = CASE
+                        WHEN length(raw_data->>'integration_item_id') > 255
+                        THEN 'sha256:' || encode(sha256(convert_to(raw_data->>'integration_item_id', 'UTF8')), 'hex')
+                        ELSE raw_data->>'integration_item_id' END
+                    WHERE integration_item_id IS NULL AND origin LIKE 'integration\\_%' AND raw_data ? 'integration_item_id'
+                    """))
+                    await conn.execute(text("""
+                    CREATE INDEX IF NOT EXISTS ix_contextos_integration_item
+                    ON contextos (config_id, origin, integration_item_id) WHERE integration_item_id IS NOT NULL
+                    """))
+            except Exception as integ_err:
+                logger.warning(f"Aviso ao preparar a coluna integration_item_id: {integ_err}")
+
+            # --- MIGRAÇÃO DE integrations.item_checksums (JSONB) PARA A TABELA integration_items ---
+            # Só copia integrações que ainda não têm nenhuma linha na tabela nova; chaves longas recebem o mesmo hash de integration_item_key
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(text("""
+                    INSERT INTO integration_items (integration_id, item_id, checksum, vector_id, updated_at)
+                    SELECT i.id, c.item_key, c.value,
+                           (SELECT max(k.id) FROM contextos k
+                            WHERE k.config_id = i.config_id AND k.origin = 'integration_' || i.id AND k.integration_item_id = c.item_key),
+                           COALESCE(i.last_sync_at, now())
+                    FROM integrations i
+                    CROSS JOIN LATERAL (
+                        SELECT CASE WHEN length(e.key) > 255
+                                    THEN 'sha256:' || encode(sha256(convert_to(e.key, 'UTF8')), 'hex')
+                                    ELSE e.key END AS item_key,
+                               e.value
+                        FROM jsonb_each_text(i.item_checksums) AS e(key, value)
+                    ) AS c
+                    WHERE jsonb_typeof(i.item_checksums) = 'object'
+                      AND NOT EXISTS (SELECT 1 FROM integration_items ii WHERE ii.integration_id = i.id)
+                    ON CONFLICT DO NOTHING
+                    """))
+                    # Uma vez copiado, o mapa legado é esvaziado para não ser reimportado em integrações que ficarem sem itens
+                    await conn.execute(text("UPDATE integrations SET item_checksums = NULL WHERE item_checksums IS NOT NULL"))
+            except Exception as items_err:
+                logger.warning(f"Aviso ao migrar checksums das integrações para integration_items: {items_err}")
+
+            # --- AGENDA DO POLLING DE INTEGRAÇÕES ---
+            # A coluna next_run_at é criada com DEFAULT now() (integrações existentes vencem imediatamente);
+            # o índice parcial precisa ser criado à parte em tabelas que já existiam
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(text("""
+                    CREATE INDEX IF NOT EXISTS ix_integrations_due
+                    ON integrations (next_run_at) WHERE enabled AND integration_type = 'polling'
+                    """))
+            except Exception as sched_err:
+                logger.warning(f"Aviso ao preparar a agenda das integrações: {sched_err}")
+
+            # --- CARGA INICIAL DOS AGREGADOS DIÁRIOS DE TOKENS ---
+            # Consumo anterior ao ledger só existe em atendimentos.token_usage; é lançado uma única vez
+            # (quando a tabela ainda está vazia) no dia de criação do atendimento, com tipo 'legacy'.
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(text("""
+                    INSERT INTO token_usage_daily (company_id, day, model, token_type, events, input_tokens, output_tokens, cost_units)
+                    SELECT company_id, DATE(timezone('America/Sao_Paulo', created_at)), '', 'legacy', COUNT(*), 0, 0, SUM(token_usage)
+                    FROM atendimentos
+                    WHERE company_id IS NOT NULL AND COALESCE(token_usage, 0) > 0
+                      AND NOT EXISTS (SELECT 1 FROM token_usage_daily)
+                    GROUP BY company_id, DATE(timezone('America/Sao_Paulo', created_at))
+                    """))
+            except Exception as backfill_err:
+                logger.warning(f"Aviso ao popular agregados diários de tokens: {backfill_err}")
         except Exception as e:
             logger.exception("ERRO CRÍTICO ao criar tabelas e colunas do banco de dados.") # Usa logger.exception para incluir traceback
-            raise
\ No newline at end of file
+            raise
+
+    # --- ÍNDICES VETORIAIS (HNSW) para as buscas por distância de cosseno ---
+    # Fora da transação de inicialização: CREATE INDEX CONCURRENTLY exige autocommit e não bloqueia
+    # inserções em contextos/mensagens enquanto o grafo é montado
+    try:
+        async with engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await ensure_hnsw_indexes(conn)
+    except Exception as e:
+        logger.warning(f"Aviso: Não foi possível preparar os índices vetoriais. Erro: {e}")
@@ -0,0 +1,284 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from collections import OrderedDict
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Dict, List, Optional, Tuple
+
+import httpcore
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# --- POLÍTICA DE SEGURANÇA CONTRA SSRF ---
+BLOCKED_IP_NETWORKS = [
+    ipaddress.ip_network("127.0.0.0/8"),
+    ipaddress.ip_network("10.0.0.0/8"),
+    ipaddress.ip_network("172.16.0.0/12"),
+    ipaddress.ip_network("192.168.0.0/16"),
+    ipaddress.ip_network("169.254.169.254/32"), # Metadata AWS/GCP
+    ipaddress.ip_network("0.0.0.0/32"),
+]
+
+BLOCKED_HOSTNAMES = ("localhost", "127.0.0.1", "::1", "0.0.0.0")
+
+
+def check_ip_allowed(ip_str: str) -> None:
+    """
+    Rejeita IPs de loopback, redes privadas, link-local, metadata de nuvem e faixas reservadas.
+
+    @param ip_str: Endereço IPv4 ou IPv6.
+    @raises ValueError: Se o endereço não for público.
+    """
+    ip_obj = ipaddress.ip_address(ip_str)
+    # IPv6 que embute um IPv4 (::ffff:10.0.0.1) é avaliado pelo IPv4
+    mapped = getattr(ip_obj, "ipv4_mapped", None)
+    if mapped is not None:
+        ip_obj = mapped
+
+    if ip_obj.is_loopback or ip_obj.is_private or ip_obj.is_link_local or ip_obj.is_unspecified or ip_obj.is_multicast or ip_obj.is_reserved:
+        raise ValueError(f"O endereço IP destina-se a uma rede privada ou reservada: {ip_str}")
+
+    for network in BLOCKED_IP_NETWORKS:
+        if ip_obj.version == network.version and ip_obj in network:
+            raise ValueError(f"Acesso ao IP {ip_str} bloqueado por segurança.")
+
+
+class DnsCache:
+    """
+    Resolução de nomes assíncrona (getaddrinfo no executor do loop) com cache por TTL.
+
+    Consultas simultâneas ao mesmo host compartilham uma única resolução. Só endereços públicos entram
+    no cache: se qualquer IP do nome for proibido, o host inteiro é rejeitado.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(max_entries, 1)
+        self._entries: "OrderedDict[str, Tuple[List[str], float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def _lookup(self, host: str) -> List[str]:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        ips: List[str] = []
+        for _family, _type, _proto, _canon, sockaddr in infos:
+            if sockaddr[0] not in ips:
+                ips.append(sockaddr[0])
+        return ips
+
+    async def resolve_public_ips(self, host: str) -> List[str]:
+        """
+        Resolve o host e valida todos os endereços retornados.
+
+        @param host: Hostname ou IP literal.
+        @returns: IPs públicos do host, na ordem do resolvedor.
+        @raises ValueError: Host local ou com algum IP proibido.
+        @raises socket.gaierror: Nome inexistente.
+        """
+        host = (host or "").strip("[]").lower()
+        if host in BLOCKED_HOSTNAMES:
+            raise ValueError("Acesso a endereços locais não é permitido.")
+
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            check_ip_allowed(host)
+            return [host]
+
+        cached = self._entries.get(host)
+        if cached is not None and cached[1] > time.monotonic():
+            self._entries.move_to_end(host)
+            return cached[0]
+
+        future = self._inflight.get(host)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(host))
+            self._inflight[host] = future
+            future.add_done_callback(lambda _f, h=host: self._inflight.pop(h, None))
+        ips = await asyncio.shield(future)
+
+        for ip in ips:
+            check_ip_allowed(ip)
+
+        self._entries[host] = (ips, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(host)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return ips
+
+
+class _PinnedNetworkBackend(httpcore.AsyncNetworkBackend):
+    """
+    Backend de rede do httpcore que conecta somente aos IPs validados pelo DnsCache.
+
+    A URL continua com o hostname (SNI, verificação do certificado e pool de conexões por host ficam
+    corretos), mas a conexão TCP vai para o IP que passou na checagem de SSRF. Isso fecha a janela de
+    DNS rebinding entre a validação e a conexão, e vale também para cada redirecionamento seguido.
+    """
+
+    def __init__(self, dns_cache: DnsCache):
+        self._dns_cache = dns_cache
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            ips = await self._dns_cache.resolve_public_ips(host)
+        except ValueError as e:
+            raise httpcore.ConnectError(str(e))
+        except socket.gaierror as e:
+            raise httpcore.ConnectError(f"Não foi possível resolver o host '{host}': {e}")
+
+        last_error: Optional[Exception] = None
+        for ip in ips:
+            try:
+                return await self._backend.connect_tcp(ip, port, timeout=timeout, local_address=local_address, socket_options=socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+        raise last_error or httpcore.ConnectError(f"Nenhum endereço disponível para '{host}'.")
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("Conexões por unix socket não são permitidas em integrações.")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+# Exceções do httpcore e equivalentes do httpx (as mais específicas primeiro), como no transporte padrão do httpx
+_HTTPCORE_EXCEPTIONS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+)
+
+
+def _to_httpx_error(error: Exception, request: httpx.Request) -> Exception:
+    for core_type, httpx_type in _HTTPCORE_EXCEPTIONS:
+        if isinstance(error, core_type):
+            return httpx_type(str(error), request=request)
+    return error
+
+
+class _PinnedResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream, request: httpx.Request):
+        self._stream = stream
+        self._request = request
+
+    async def __aiter__(self):
+        try:
+            async for part in self._stream:
+                yield part
+        except httpcore.TimeoutException as e:
+            raise _to_httpx_error(e, self._request) from e
+        except (httpcore.NetworkError, httpcore.ProtocolError) as e:
+            raise _to_httpx_error(e, self._request) from e
+
+    async def aclose(self) -> None:
+        if hasattr(self._stream, "aclose"):
+            await self._stream.aclose()
+
+
+class _PinnedTransport(httpx.AsyncBaseTransport):
+    """
+    Transporte do httpx sobre um pool do httpcore próprio, cujo backend de rede é o _PinnedNetworkBackend.
+    Usa apenas as APIs públicas das duas bibliotecas (Request/Response do httpcore convertidos para httpx).
+    """
+
+    def __init__(self, dns_cache: DnsCache, limits: httpx.Limits):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_PinnedNetworkBackend(dns_cache),
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        try:
+            core_response = await self._pool.handle_async_request(core_request)
+        except (httpcore.TimeoutException, httpcore.NetworkError, httpcore.ProtocolError, httpcore.UnsupportedProtocol) as e:
+            raise _to_httpx_error(e, request) from e
+
+        return httpx.Response(
+            status_code=core_response.status,
+            headers=core_response.headers,
+            stream=_PinnedResponseStream(core_response.stream, request),
+            extensions=core_response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._pool.aclose()
+
+
+_dns_cache_instance: Optional[DnsCache] = None
+
+def get_dns_cache() -> DnsCache:
+    global _dns_cache_instance
+    if _dns_cache_instance is None:
+        _dns_cache_instance = DnsCache(
+            ttl_seconds=settings.INTEGRATION_DNS_CACHE_TTL_SECONDS,
+            max_entries=settings.INTEGRATION_DNS_CACHE_MAX_ENTRIES
+        )
+    return _dns_cache_instance
+
+
+_integration_http_client_instance: Optional[httpx.AsyncClient] = None
+
+def get_integration_http_client() -> httpx.AsyncClient:
+    """
+    Cliente HTTP compartilhado pelas integrações (Polling e teste de endpoint), com pool de conexões
+    keep-alive e conexões fixadas nos IPs validados contra SSRF.
+
+    Cookies recebidos são descartados: o cliente é compartilhado entre empresas e um Set-Cookie de uma
+    integração nunca deve ser reenviado na requisição de outra para o mesmo domínio.
+    """
+    global _integration_http_client_instance
+    if _integration_http_client_instance is None or _integration_http_client_instance.is_closed:
+        limits = httpx.Limits(
+            max_connections=settings.INTEGRATION_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.INTEGRATION_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=30.0
+        )
+        _integration_http_client_instance = httpx.AsyncClient(
+            transport=_PinnedTransport(get_dns_cache(), limits),
+            timeout=30.0,
+            follow_redirects=True,
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+        )
+    return _integration_http_client_instance
+
+
+async def close_integration_http_client():
+    """Fecha o pool de conexões das integrações no encerramento do processo."""
+    global _integration_http_client_instance
+    if _integration_http_client_instance is not None:
+        await _integration_http_client_instance.aclose()
+        _integration_http_client_instance = None
@@ -1,37 +1,60 @@
 # app/services/integration_service.py
 
+import asyncio
 import logging
 import json
 import hashlib
 import hmac
+import tempfile
 import urllib.parse
 import socket
-import ipaddress
-from datetime import datetime, timezone
-from typing import List, Dict, Any, Optional, Tuple
+from datetime import datetime, timezone, timedelta
+from itertools import islice
+from typing import IO, AsyncIterator, Iterator, List, Dict, Any, Optional, Tuple
 
-import httpx
+import ijson
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete, or_
+from sqlalchemy import String, any_, delete, func, insert, literal, or_, select, update
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 
+from app.core.config import settings
 from app.db import models
+from app.db.database import SessionLocal
 from app.services.gemini_service import get_gemini_service
+from app.services.integration_http_client import get_dns_cache, get_integration_http_client
 
 logger = logging.getLogger(__name__)
 
+# Tamanho das colunas contextos.integration_item_id e integration_items.item_id
+ITEM_ID_MAX_LENGTH = 255
+# IDs maiores (ex: title_field com títulos longos) são gravados como "sha256:<hex>"
+LONG_ITEM_ID_PREFIX = "sha256:"
+# Campos da integração que definem a origem e o mapeamento dos itens
+SOURCE_FIELDS = frozenset({"url", "method", "headers", "body", "items_path", "title_field", "content_field", "category"})
+
+
+def integration_item_key(raw_id: str) -> str:
+    """
+    Chave do item gravada no banco: o próprio ID da origem ou, acima de ITEM_ID_MAX_LENGTH caracteres, seu hash.
+    A mesma regra é aplicada em SQL pela migração dos checksums legados (init_db).
+
+    @param raw_id: ID do item na origem.
+    @returns: Chave com no máximo ITEM_ID_MAX_LENGTH caracteres.
+    """
+    if len(raw_id) <= ITEM_ID_MAX_LENGTH:
+        return raw_id
+    return LONG_ITEM_ID_PREFIX + hashlib.sha256(raw_id.encode('utf-8')).hexdigest()
+
+class IntegrationBusyError(Exception):
+    """Exceção para sincronização pedida enquanto outra execução da mesma integração está em andamento."""
+    pass
+
+
 # --- POLÍTICA DE SEGURANÇA CONTRA SSRF ---
-BLOCKED_IP_NETWORKS = [
-    ipaddress.ip_network("127.0.0.0/8"),
-    ipaddress.ip_network("10.0.0.0/8"),
-    ipaddress.ip_network("172.16.0.0/12"),
-    ipaddress.ip_network("192.168.0.0/16"),
-    ipaddress.ip_network("169.254.169.254/32"), # Metadata AWS/GCP
-    ipaddress.ip_network("0.0.0.0/32"),
-]
-
-def validate_url_security(url: str) -> bool:
+async def validate_url_security(url: str) -> bool:
     """
     Valida se a URL é pública e segura, bloqueando SSRF (loopback, IPs privados, metadata).
+    A resolução DNS é assíncrona e cacheada; as conexões do cliente compartilhado usam os mesmos IPs validados.
     """
     if not url:
         raise ValueError("URL não pode estar vazia.")
@@ -44,21 +67,9 @@ def validate_url_security(url: str) -> bool:
     if not hostname:
         raise ValueError("URL inválida ou sem hostname.")
 
-    if hostname.lower() in ("localhost", "127.0.0.1", "::1", "0.0.0.0"):
-        raise ValueError("Acesso a endereços locais não é permitido.")
-
     try:
-        # Resolve o hostname para verificar o IP real
-        ip_str = socket.gethostbyname(hostname)
-        ip_obj = ipaddress.ip_address(ip_str)
-
-        if ip_obj.is_loopback or ip_obj.is_private or ip_obj.is_link_local:
-            raise ValueError(f"O endereço IP destina-se a uma rede privada ou reservada: {ip_str}")
-
-        for network in BLOCKED_IP_NETWORKS:
-            if ip_obj in network:
-                raise ValueError(f"Acesso ao IP {ip_str} bloqueado por segurança.")
-                
+        # Resolve o hostname para verificar os IPs reais
+        await get_dns_cache().resolve_public_ips(hostname)
     except socket.gaierror:
         # Não foi possível resolver DNS, deixa a biblioteca HTTP tratar a falha de conexão se necessário
         pass
@@ -75,40 +86,6 @@ def verify_webhook_token_secure(provided_token: str, expected_token: str) -> boo
 
 # --- ENGINE GENÉRICA DE INTEGRAÇÕES ---
 
-class BaseIntegrationHandler:
-    """Interface base para manipuladores de integração."""
-    
-    @staticmethod
-    def extract_items(payload_json: Any, items_path: str = "") -> List[Dict[str, Any]]:
-        """Extrai uma lista de dicionários a partir do payload JSON e do caminho indicado."""
-        if payload_json is None:
-            return []
-            
-        target = payload_json
-        
-        # Se um caminho como "data.products" foi definido
-        if items_path and items_path.strip():
-            parts = items_path.strip().split(".")
-            for part in parts:
-                if isinstance(target, dict) and part in target:
-                    target = target[part]
-                elif isinstance(target, list) and part.isdigit():
-                    idx = int(part)
-                    if 0 <= idx < len(target):
-                        target = target[idx]
-                    else:
-                        return []
-                else:
-                    return []
-
-        if isinstance(target, list):
-            # Garante que os itens são dicionários
-            return [item if isinstance(item, dict) else {"value": item} for item in target]
-        elif isinstance(target, dict):
-            # Se for um dicionário único, trata como uma lista de 1 elemento
-            return [target]
-        return []
-
 def get_field_values_from_json(obj: Any, field_path: str) -> List[Tuple[str, Any]]:
     """
     Busca valores de um campo ou caminho (ex: "nome_razao", "cliente.nome_razao", "itens.descricao")
@@ -210,7 +187,7 @@ class BaseIntegrationHandler:
     def format_item(item: Dict[str, Any], title_field: Optional[str] = None, content_field: Optional[str] = None) -> Tuple[str, str, Dict[str, Any]]:
         """
         Formata o item para indexação RAG, filtrando e mantendo apenas os campos do JSON selecionados.
-        Retorna (item_id, text_content, filtered_raw_data).
+        Retorna (item_id, text_content, filtered_raw_data); IDs longos são convertidos por integration_item_key.
         """
         raw_id = None
         if title_field and title_field in item:
@@ -261,7 +238,7 @@ class BaseIntegrationHandler:
         if not raw_id:
             raw_id = hashlib.md5(text_content.encode('utf-8')).hexdigest()[:12]
 
-        return raw_id, text_content, filtered_item if filtered_item else item
+        return integration_item_key(raw_id), text_content, filtered_item if filtered_item else item
 
     @staticmethod
     def compute_checksum(item: Dict[str, Any]) -> str:
@@ -269,6 +246,36 @@ class BaseIntegrationHandler:
         serialized = json.dumps(item, sort_keys=True, ensure_ascii=False)
         return hashlib.md5(serialized.encode('utf-8')).hexdigest()
 
+def stream_prefix(items_path: Optional[str]) -> Optional[str]:
+    """
+    Converte o items_path ("data.products") no prefixo ijson dos elementos da lista ("data.products.item").
+
+    @param items_path: Caminho configurado na integração (vazio = lista na raiz).
+    @returns: Prefixo ijson, ou None se o caminho usa índices numéricos (não expressáveis em streaming).
+    """
+    parts = [p for p in (items_path or "").strip().split(".") if p]
+    if any(p.isdigit() for p in parts):
+        return None
+    return ".".join(parts + ["item"])
+
+def build_payload_sample(items_path: Optional[str], sample: List[Dict[str, Any]]) -> Any:
+    """
+    Monta um payload reduzido com a mesma estrutura do original até items_path, para que o mapeamento
+    visual de campos continue funcionando sem guardar o documento inteiro.
+    """
+    payload: Any = sample
+    for part in reversed([p for p in (items_path or "").strip().split(".") if p]):
+        payload = {part: payload}
+    return payload
+
+def _next_items(items: Iterator[Any], size: int) -> List[Any]:
+    return list(islice(items, size))
+
+async def _iter_chunks(items: List[Dict[str, Any]]) -> AsyncIterator[List[Dict[str, Any]]]:
+    chunk_size = max(settings.INTEGRATION_STREAM_CHUNK_ITEMS, 1)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
 class IntegrationRegistry:
     """Registro estensível de handlers de integrações."""
     _handlers: Dict[str, type] = {}
@@ -287,18 +294,20 @@ IntegrationRegistry.register("webhook", BaseIntegrationHandler)
 class IntegrationService:
 
     @staticmethod
-    async def execute_http_request(url: str, method: str, headers: Dict[str, Any], body: Any = None, params: Dict[str, Any] = None) -> Any:
+    async def _prepare_http_request(url: str, method: str, headers: Dict[str, Any], body: Any = None, params: Dict[str, Any] = None, extra_headers: Optional[Dict[str, str]] = None) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
         """
-        Executa qualquer tipo de requisição HTTP (GET, POST) com Headers, Query Params e Body,
+        Valida a URL e monta método, Headers e argumentos (Query Params e Body) da requisição,
         aceitando payloads em JSON, Form ou texto puro.
         """
         if not url:
             raise ValueError("URL do endpoint não foi informada.")
 
-        validate_url_security(url)
+        await validate_url_security(url)
 
         cleaned_headers = {str(k): str(v) for k, v in headers.items()} if isinstance(headers, dict) else {}
         cleaned_headers.setdefault("User-Agent", "AtendAI-Integration-Worker/1.0")
+        if extra_headers:
+            cleaned_headers.update(extra_headers)
 
         cleaned_params = {str(k): str(v) for k, v in params.items()} if isinstance(params, dict) else None
 
@@ -319,20 +328,108 @@ class IntegrationService:
                     if "Content-Type" not in cleaned_headers:
                         cleaned_headers["Content-Type"] = "application/json"
 
-        async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-            resp = await client.request(http_method, url, headers=cleaned_headers, **kwargs)
+        return http_method, cleaned_headers, kwargs
+
+    @staticmethod
+    def _decode_body(raw: bytes) -> Any:
+        """Decodifica o corpo como JSON; texto puro vira um item único."""
+        try:
+            return json.loads(raw)
+        except Exception:
+            raw_text = raw.decode("utf-8", errors="replace").strip()
+            return {
+                "response_text": raw_text,
+                "items": [{"id": "1", "content": raw_text}]
+            }
+
+    @staticmethod
+    async def execute_http_request(url: str, method: str, headers: Dict[str, Any], body: Any = None, params: Dict[str, Any] = None) -> Any:
+        """
+        Executa qualquer tipo de requisição HTTP (GET, POST) com Headers, Query Params e Body,
+        aceitando payloads em JSON, Form ou texto puro.
+        """
+        http_method, cleaned_headers, kwargs = await IntegrationService._prepare_http_request(url, method, headers, body, params)
+
+        resp = await get_integration_http_client().request(http_method, url, headers=cleaned_headers, **kwargs)
+
+        if resp.status_code >= 400:
+            raise ValueError(f"Endpoint respondeu com erro HTTP {resp.status_code}: {resp.text[:300]}")
+        return IntegrationService._decode_body(resp.content)
 
+    @staticmethod
+    async def fetch_if_changed(integration: models.Integration) -> Optional[Tuple[IO[bytes], str]]:
+        """
+        Baixa o payload do Polling em streaming para um arquivo temporário (em memória até
+        INTEGRATION_STREAM_SPOOL_BYTES, depois em disco), calculando o MD5 dos bytes no caminho.
+
+        Usa requisição condicional (If-None-Match / If-Modified-Since) quando a última resposta trouxe
+        ETag/Last-Modified. Os validadores recebidos ficam no objeto da integração e são persistidos
+        junto com o processamento do payload.
+
+        @param integration: Integração Polling.
+        @returns: (arquivo posicionado no início, MD5 hexadecimal do corpo), ou None se o endpoint respondeu 304.
+        """
+        method = (integration.method or "GET").upper()
+        conditional: Dict[str, str] = {}
+        # Validadores só fazem sentido em leituras; POST com corpo pode ter semântica diferente a cada chamada
+        if method == "GET":
+            if integration.http_etag:
+                conditional["If-None-Match"] = integration.http_etag
+            if integration.http_last_modified:
+                conditional["If-Modified-Since"] = integration.http_last_modified
+
+        http_method, cleaned_headers, kwargs = await IntegrationService._prepare_http_request(
+            integration.url, method, integration.headers or {}, integration.body, extra_headers=conditional
+        )
+
+        client = get_integration_http_client()
+        async with client.stream(http_method, integration.url, headers=cleaned_headers, **kwargs) as resp:
             if resp.status_code >= 400:
+                await resp.aread()
                 raise ValueError(f"Endpoint respondeu com erro HTTP {resp.status_code}: {resp.text[:300]}")
+            if resp.status_code == 304:
+                return None
 
+            spool = tempfile.SpooledTemporaryFile(max_size=settings.INTEGRATION_STREAM_SPOOL_BYTES)
+            hasher = hashlib.md5()
+            size = 0
             try:
-                return resp.json()
-            except Exception:
-                raw_text = resp.text.strip()
-                return {
-                    "response_text": raw_text,
-                    "items": [{"id": "1", "content": raw_text}]
-                }
+                async for chunk in resp.aiter_bytes():
+                    size += len(chunk)
+                    if size > settings.INTEGRATION_MAX_PAYLOAD_BYTES:
+                        raise ValueError(f"Payload excede o limite de {settings.INTEGRATION_MAX_PAYLOAD_BYTES} bytes.")
+                    spool.write(chunk)
+                    hasher.update(chunk)
+            except BaseException:
+                spool.close()
+                raise
+
+        if method == "GET":
+            integration.http_etag = resp.headers.get("etag")
+            integration.http_last_modified = resp.headers.get("last-modified")
+        spool.seek(0)
+        return spool, hasher.hexdigest()
+
+    @staticmethod
+    def _mapping_signature(integration: models.Integration) -> List[str]:
+        # Alterar items_path ou os campos selecionados precisa reprocessar os itens mesmo com o payload idêntico
+        return [integration.items_path or "", integration.title_field or "", integration.content_field or "", integration.category or ""]
+
+    @staticmethod
+    def compute_payload_hash(integration: models.Integration, payload_json: Any) -> str:
+        """
+        Hash MD5 do payload inteiro somado ao mapeamento da integração.
+        """
+        serialized = json.dumps([IntegrationService._mapping_signature(integration), payload_json], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.md5(serialized.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def compute_stream_hash(integration: models.Integration, body_md5: str) -> str:
+        """
+        Equivalente de `compute_payload_hash` para payloads processados em streaming (hash dos bytes brutos).
+        """
+        serialized = json.dumps([IntegrationService._mapping_signature(integration), body_md5], ensure_ascii=False)
+        return hashlib.md5(serialized.encode('utf-8')).hexdigest()
 
     @staticmethod
     async def test_endpoint(payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -351,11 +448,93 @@ class IntegrationService:
             "data": res_json
         }
 
+    @staticmethod
+    async def update_integration(db: AsyncSession, integration: models.Integration, update_data: Dict[str, Any]) -> models.Integration:
+        """
+        Aplica a atualização parcial de uma integração, invalida o cache da origem e reagenda o próximo polling.
+
+        @param db: Sessão do banco de dados (o commit é feito aqui).
+        @param integration: Integração a atualizar.
+        @param update_data: Campos enviados pelo cliente (exclude_unset).
+        @returns: Integração atualizada.
+        """
+        for key, value in update_data.items():
+            setattr(integration, key, value)
+
+        # Mudanças na origem ou no mapeamento invalidam os validadores HTTP e o hash do último payload
+        if update_data.keys() & SOURCE_FIELDS:
+            integration.http_etag = None
+            integration.http_last_modified = None
+            integration.payload_hash = None
+
+        db.add(integration)
+        await db.commit()
+
+        # Novo intervalo passa a valer já para a próxima execução agendada; com uma execução em andamento,
+        # next_run_at é o lease dela e o reagendamento fica para o fim da execução
+        if update_data.get("sync_interval_minutes"):
+            integ = models.Integration
+            base = integration.last_sync_at or datetime.now(timezone.utc)
+            await db.execute(
+                update(integ)
+                .where(integ.id == integration.id, or_(integ.leased_until.is_(None), integ.leased_until <= func.now()))
+                .values(next_run_at=base + timedelta(minutes=integration.sync_interval_minutes))
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        await db.refresh(integration)
+        return integration
+
+    @staticmethod
+    async def run_manual_sync(db: AsyncSession, integration: models.Integration) -> int:
+        """
+        Sincronização disparada pelo usuário. Reivindica o mesmo lease do agendador antes de executar, para que
+        o worker não rode a mesma integração em paralelo, e reagenda o próximo polling ao final.
+
+        @param db: Sessão do banco de dados.
+        @param integration: Integração a sincronizar.
+        @returns: Quantidade de vetores atualizados.
+        """
+        integ = models.Integration
+        now = datetime.now(timezone.utc)
+        lease_until = now + timedelta(minutes=max(settings.INTEGRATION_SYNC_LEASE_MINUTES, 1))
+        claimed = await db.execute(
+            update(integ)
+            .where(integ.id == integration.id, or_(integ.leased_until.is_(None), integ.leased_until <= func.now()))
+            .values(next_run_at=lease_until, leased_until=lease_until)
+            .returning(integ.id)
+            .execution_options(synchronize_session=False)
+        )
+        leased = claimed.scalar_one_or_none() is not None
+        await db.commit()
+        if not leased:
+            raise IntegrationBusyError("Já existe uma sincronização em andamento para esta integração. Tente novamente em instantes.")
+
+        try:
+            return await IntegrationService.run_integration_sync(db, integration)
+        finally:
+            # Sessão nova: a da execução pode ter ficado em estado inválido após um erro de banco
+            try:
+                async with SessionLocal() as db_lease:
+                    await db_lease.execute(
+                        update(integ)
+                        .where(integ.id == integration.id)
+                        .values(
+                            next_run_at=datetime.now(timezone.utc) + timedelta(minutes=integration.sync_interval_minutes or 5),
+                            leased_until=None
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db_lease.commit()
+            except Exception as e:
+                logger.error(f"Erro ao liberar o lease da integração (ID: {integration.id}); ele expira em {lease_until}: {e}", exc_info=True)
+
     @staticmethod
     async def run_integration_sync(db: AsyncSession, integration: models.Integration) -> int:
         """
         Executa a sincronização de uma integração por Polling (busca dados na URL) ou re-processamento.
         Atualiza o banco de dados vetorial de forma incremental.
+        Payloads acima de INTEGRATION_STREAM_MIN_BYTES são lidos em streaming (ver `process_streamed_payload`).
         """
         if not integration.enabled:
             logger.info(f"Integração '{integration.name}' (ID: {integration.id}) está desativada. Ignorando...")
@@ -363,13 +542,11 @@ class IntegrationService:
 
         url = integration.url
         method = integration.method or "GET"
-        headers = integration.headers or {}
-        body = integration.body
 
         logger.info(f"Iniciando sincronização Polling para a integração '{integration.name}' (ID: {integration.id}) [{method} {url}]")
 
         try:
-            res_json = await IntegrationService.execute_http_request(url, method, headers, body)
+            fetched = await IntegrationService.fetch_if_changed(integration)
         except Exception as e:
             error_msg = str(e)
             integration.last_status = "error"
@@ -379,7 +556,29 @@ class IntegrationService:
             await db.commit()
             raise ValueError(error_msg)
 
-        return await IntegrationService.process_payload_for_integration(db, integration, res_json)
+        if fetched is None:
+            logger.info(f"Integração '{integration.name}' (ID: {integration.id}): endpoint respondeu 304 (sem alterações).")
+            IntegrationService._mark_success(integration)
+            db.add(integration)
+            await db.commit()
+            return 0
+
+        spool, body_md5 = fetched
+        try:
+            size = spool.seek(0, 2)
+            spool.seek(0)
+            if size >= settings.INTEGRATION_STREAM_MIN_BYTES and stream_prefix(integration.items_path) is not None:
+                return await IntegrationService.process_streamed_payload(db, integration, spool, body_md5)
+            res_json = IntegrationService._decode_body(spool.read())
+            return await IntegrationService.process_payload_for_integration(db, integration, res_json)
+        finally:
+            spool.close()
+
+    @staticmethod
+    def _mark_success(integration: models.Integration) -> None:
+        integration.last_status = "success"
+        integration.last_error = None
+        integration.last_sync_at = datetime.now(timezone.utc)
 
     @staticmethod
     async def process_payload_for_integration(db: AsyncSession, integration: models.Integration, payload_json: Any) -> int:
@@ -387,94 +586,243 @@ class IntegrationService:
         Processa um payload JSON (seja de Polling ou Webhook) e realiza o upsert incremental no PGVector.
         """
         handler = IntegrationRegistry.get_handler(integration.integration_type)
+
+        # Payload idêntico ao último processado por completo: nada a fazer além de registrar o ciclo
+        payload_hash = IntegrationService.compute_payload_hash(integration, payload_json)
+        if payload_hash == integration.payload_hash:
+            logger.info(f"Payload sem alterações para a integração '{integration.name}' (ID: {integration.id}). Itens não reprocessados.")
+            IntegrationService._mark_success(integration)
+            db.add(integration)
+            await db.commit()
+            return 0
+
         integration.last_payload = payload_json
+        integration.payload_hash = payload_hash
         items = handler.extract_items(payload_json, integration.items_path or "")
 
         if not items:
             logger.info(f"Nenhum item encontrado no payload para a integração '{integration.name}' (ID: {integration.id}).")
-            integration.last_status = "success"
-            integration.last_error = None
-            integration.last_sync_at = datetime.now(timezone.utc)
+            IntegrationService._mark_success(integration)
             db.add(integration)
             await db.commit()
             return 0
 
-        existing_checksums: Dict[str, str] = integration.item_checksums or {}
-        new_checksums: Dict[str, str] = {}
+        processed_count = await IntegrationService._apply_item_chunks(db, integration, handler, _iter_chunks(items))
+        await db.commit()
+        logger.info(f"Sincronização concluída com sucesso para a integração '{integration.name}'. Itens atualizados/adicionados: {processed_count}")
+        return processed_count
 
-        items_to_embed = []
-        origin_tag = f"integration_{integration.id}"
+    @staticmethod
+    async def process_coalesced_payloads(db: AsyncSession, integration: models.Integration, payloads: List[Any]) -> int:
+        """
+        Processa numa única execução vários payloads recebidos pelo webhook da mesma integração (em ordem de
+        chegada): os itens são concatenados e, se um item aparecer em mais de um push, prevalece o mais recente.
 
-        for item in items:
-            item_id, content_text, clean_raw = handler.format_item(item, integration.title_field, integration.content_field)
-            checksum = handler.compute_checksum(clean_raw)
-            new_checksums[item_id] = checksum
+        @param payloads: Payloads JSON na ordem em que foram recebidos.
+        @returns: Quantidade de vetores gravados.
+        """
+        if len(payloads) == 1:
+            return await IntegrationService.process_payload_for_integration(db, integration, payloads[0])
 
-            # Verifica se o item mudou em relação ao salvo anteriormente
-            if existing_checksums.get(item_id) != checksum:
-                items_to_embed.append({
-                    "item_id": item_id,
-                    "content": content_text,
-                    "raw_data": clean_raw,
-                    "category": integration.category or "integração"
-                })
+        handler = IntegrationRegistry.get_handler(integration.integration_type)
+        items: List[Dict[str, Any]] = []
+        for payload_json in payloads:
+            items.extend(handler.extract_items(payload_json, integration.items_path or ""))
+
+        # O hash do último payload já reflete o estado aplicado: um push idêntico em seguida não precisa ser reprocessado
+        integration.last_payload = payloads[-1]
+        integration.payload_hash = IntegrationService.compute_payload_hash(integration, payloads[-1])
+
+        if not items:
+            logger.info(f"Nenhum item encontrado nos {len(payloads)} payloads da integração '{integration.name}' (ID: {integration.id}).")
+            IntegrationService._mark_success(integration)
+            db.add(integration)
+            await db.commit()
+            return 0
+
+        processed_count = await IntegrationService._apply_item_chunks(db, integration, handler, _iter_chunks(items))
+        await db.commit()
+        logger.info(
+            f"{len(payloads)} pushes do webhook processados juntos para a integração '{integration.name}'. "
+            f"Itens atualizados/adicionados: {processed_count}"
+        )
+        return processed_count
+
+    @staticmethod
+    async def process_streamed_payload(db: AsyncSession, integration: models.Integration, spool: IO[bytes], body_md5: str) -> int:
+        """
+        Processa um payload grande sem materializá-lo: os itens em `items_path` são lidos incrementalmente
+        do arquivo temporário (ijson, em thread) e processados em blocos de INTEGRATION_STREAM_CHUNK_ITEMS.
+        Apenas uma amostra limitada (INTEGRATION_PAYLOAD_SAMPLE_ITEMS itens, na mesma estrutura) vai para last_payload.
+
+        Se o caminho não apontar para uma lista (ex: dicionário único ou lista aninhada reconhecida pelo handler),
+        recai no processamento em memória para manter a mesma semântica de `extract_items`.
+        """
+        handler = IntegrationRegistry.get_handler(integration.integration_type)
 
+        payload_hash = IntegrationService.compute_stream_hash(integration, body_md5)
+        if payload_hash == integration.payload_hash:
+            logger.info(f"Payload sem alterações para a integração '{integration.name}' (ID: {integration.id}). Itens não reprocessados.")
+            IntegrationService._mark_success(integration)
+            db.add(integration)
+            await db.commit()
+            return 0
+
+        chunk_size = max(settings.INTEGRATION_STREAM_CHUNK_ITEMS, 1)
+        items_iter = ijson.items(spool, stream_prefix(integration.items_path), use_float=True)
+        try:
+            first = await asyncio.to_thread(_next_items, items_iter, chunk_size)
+        except (ijson.JSONError, ValueError):
+            first = []
+
+        if not first:
+            spool.seek(0)
+            payload_json = await asyncio.to_thread(lambda: IntegrationService._decode_body(spool.read()))
+            return await IntegrationService.process_payload_for_integration(db, integration, payload_json)
+
+        integration.payload_hash = payload_hash
+        sample: List[Dict[str, Any]] = []
+        sample_size = settings.INTEGRATION_PAYLOAD_SAMPLE_ITEMS
+        total = 0
+
+        async def chunks():
+            nonlocal total
+            batch = first
+            while batch:
+                normalized = [item if isinstance(item, dict) else {"value": item} for item in batch]
+                if len(sample) < sample_size:
+                    sample.extend(normalized[:sample_size - len(sample)])
+                total += len(normalized)
+                yield normalized
+                batch = await asyncio.to_thread(_next_items, items_iter, chunk_size)
+
+        processed_count = await IntegrationService._apply_item_chunks(db, integration, handler, chunks())
+
+        integration.last_payload = build_payload_sample(integration.items_path, sample)
+        await db.commit()
+        logger.info(
+            f"Sincronização em streaming concluída para a integração '{integration.name}' ({total} itens lidos). "
+            f"Itens atualizados/adicionados: {processed_count}"
+        )
+        return processed_count
+
+    @staticmethod
+    async def _apply_item_chunks(db: AsyncSession, integration: models.Integration, handler: type, chunks: AsyncIterator[List[Dict[str, Any]]]) -> int:
+        """
+        Diferença incremental por checksum, bloco a bloco, contra a tabela integration_items: busca apenas os
+        checksums dos itens do bloco, vetoriza os novos/modificados, troca seus vetores com um DELETE e um INSERT
+        em lote e grava em integration_items somente as linhas alteradas. Ao final (Polling), remove em SQL os
+        itens que sumiram da origem. Tudo na transação corrente; o commit fica com o chamador.
+
+        @returns: Quantidade de vetores gravados.
+        """
+        origin_tag = f"integration_{integration.id}"
+        kv = models.KnowledgeVector
+        ii = models.IntegrationItem
+        gemini_service = get_gemini_service()
+        seen_ids: set = set()
         processed_count = 0
+        failed_count = 0
+
+        async def delete_vectors(item_ids: List[str]):
+            await db.execute(
+                delete(kv).where(
+                    kv.config_id == integration.config_id,
+                    kv.origin == origin_tag,
+                    kv.integration_item_id == any_(literal(item_ids, ARRAY(String)))
+                ).execution_options(synchronize_session=False)
+            )
+
+        async for chunk in chunks:
+            # Por item_id: se o payload repetir um ID, prevalece a última ocorrência
+            chunk_items: Dict[str, Tuple[str, str, Dict[str, Any]]] = {}
+            for item in chunk:
+                item_id, content_text, clean_raw = handler.format_item(item, integration.title_field, integration.content_field)
+                chunk_items[item_id] = (handler.compute_checksum(clean_raw), content_text, clean_raw)
+            seen_ids.update(chunk_items.keys())
+
+            result = await db.execute(
+                select(ii.item_id, ii.checksum).where(
+                    ii.integration_id == integration.id,
+                    ii.item_id == any_(literal(list(chunk_items.keys()), ARRAY(String)))
+                )
+            )
+            stored_checksums = dict(result.all())
 
-        # Se houver itens novos ou modificados, gera embeddings e atualiza no banco
-        if items_to_embed:
-            logger.info(f"Processando {len(items_to_embed)} itens novos/modificados para a integração '{integration.name}'...")
-            gemini_service = get_gemini_service()
-            
-            texts_to_embed = [item["content"] for item in items_to_embed]
-            embeddings = await gemini_service.generate_embeddings_batch(texts_to_embed)
-
-            for item_data, embedding in zip(items_to_embed, embeddings):
-                if embedding:
-                    item_id = item_data["item_id"]
-                    
-                    # Remove versão anterior se existir
-                    stmt_del = delete(models.KnowledgeVector).where(
-                        models.KnowledgeVector.config_id == integration.config_id,
-                        models.KnowledgeVector.origin == origin_tag,
-                        models.KnowledgeVector.raw_data.op("->>")("integration_item_id") == item_id
-                    )
-                    await db.execute(stmt_del)
-
-                    raw_data_saved = dict(item_data["raw_data"])
-                    raw_data_saved["integration_item_id"] = item_id
-                    raw_data_saved["integration_id"] = integration.id
-
-                    kv = models.KnowledgeVector(
-                        config_id=integration.config_id,
-                        content=item_data["content"],
-                        origin=origin_tag,
-                        category=item_data["category"],
-                        raw_data=raw_data_saved,
-                        embedding=embedding
-                    )
-                    db.add(kv)
-                    processed_count += 1
+            # Verifica se o item mudou em relação ao salvo anteriormente
+            changed = [
+                (item_id, checksum, content_text, clean_raw)
+                for item_id, (checksum, content_text, clean_raw) in chunk_items.items()
+                if stored_checksums.get(item_id) != checksum
+            ]
+            if not changed:
+                continue
+
+            logger.info(f"Processando {len(changed)} itens novos/modificados para a integração '{integration.name}'...")
+            embeddings = await gemini_service.generate_embeddings_batch([content_text for _, _, content_text, _ in changed])
+
+            new_vectors: List[Dict[str, Any]] = []
+            new_checksums: Dict[str, str] = {}
+            for (item_id, checksum, content_text, clean_raw), embedding in zip(changed, embeddings):
+                if not embedding:
+                    # Sem linha nova em integration_items: o item é tentado de novo na próxima sincronização
+                    failed_count += 1
+                    continue
+
+                raw_data_saved = dict(clean_raw)
+                raw_data_saved["integration_item_id"] = item_id
+                raw_data_saved["integration_id"] = integration.id
+
+                new_vectors.append({
+                    "config_id": integration.config_id,
+                    "content": content_text,
+                    "origin": origin_tag,
+                    "category": integration.category or "integração",
+                    "raw_data": raw_data_saved,
+                    "embedding": embedding,
+                    "integration_item_id": item_id
+                })
+                new_checksums[item_id] = checksum
+
+            if not new_vectors:
+                continue
+
+            # Troca set-based na mesma transação: DELETE com = ANY(:ids), INSERT em lote com RETURNING e upsert
+            # apenas das linhas alteradas em integration_items
+            await delete_vectors(list(new_checksums.keys()))
+            inserted = await db.execute(insert(kv).returning(kv.id, kv.integration_item_id), new_vectors)
+            vector_ids = {item_id: vector_id for vector_id, item_id in inserted.all()}
+
+            upsert = pg_insert(ii).values([
+                {"integration_id": integration.id, "item_id": item_id, "checksum": checksum, "vector_id": vector_ids.get(item_id)}
+                for item_id, checksum in new_checksums.items()
+            ])
+            await db.execute(upsert.on_conflict_do_update(
+                index_elements=[ii.integration_id, ii.item_id],
+                set_={"checksum": upsert.excluded.checksum, "vector_id": upsert.excluded.vector_id, "updated_at": func.now()}
+            ))
+            processed_count += len(new_vectors)
 
         # Limpa itens que foram removidos da origem (caso seja Polling completo)
-        removed_ids = set(existing_checksums.keys()) - set(new_checksums.keys())
-        if removed_ids and integration.integration_type == "polling":
-            logger.info(f"Removendo {len(removed_ids)} itens obsoletos do banco vetorial para a integração '{integration.name}'...")
-            for old_id in removed_ids:
-                stmt_del = delete(models.KnowledgeVector).where(
-                    models.KnowledgeVector.config_id == integration.config_id,
-                    models.KnowledgeVector.origin == origin_tag,
-                    models.KnowledgeVector.raw_data.op("->>")("integration_item_id") == old_id
-                )
-                await db.execute(stmt_del)
+        if seen_ids and integration.integration_type == "polling":
+            result = await db.execute(
+                delete(ii).where(
+                    ii.integration_id == integration.id,
+                    ~(ii.item_id == any_(literal(list(seen_ids), ARRAY(String))))
+                ).returning(ii.item_id).execution_options(synchronize_session=False)
+            )
+            removed_ids = list(result.scalars().all())
+            if removed_ids:
+                logger.info(f"Removendo {len(removed_ids)} itens obsoletos do banco vetorial para a integração '{integration.name}'...")
+                await delete_vectors(removed_ids)
+
+        if failed_count:
+            # Estado incompleto: o próximo ciclo precisa baixar e reprocessar o payload mesmo que não mude
+            integration.payload_hash = None
+            integration.http_etag = None
+            integration.http_last_modified = None
 
         # Atualiza metadata da integração
-        integration.item_checksums = new_checksums
-        integration.last_status = "success"
-        integration.last_error = None
-        integration.last_sync_at = datetime.now(timezone.utc)
+        IntegrationService._mark_success(integration)
         db.add(integration)
-
-        await db.commit()
-        logger.info(f"Sincronização concluída com sucesso para a integração '{integration.name}'. Itens atualizados/adicionados: {processed_count}")
         return processed_count
@@ -0,0 +1,517 @@
+import asyncio
+import json
+import logging
+import random
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.core.config import settings
+from app.db import models
+from app.db.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATUSES = ("queued", "sending")
+
+
+@dataclass(frozen=True)
+class PacingPolicy:
+    """
+    Política de cadência usada para simular digitação/gravação humana antes de cada balão.
+    Os intervalos em segundos por caractere são sorteados a cada mensagem.
+    """
+    text_secs_per_char: Tuple[float, float] = (0.10, 0.20)
+    text_min_delay: float = 2.5
+    text_max_delay: float = 15.0
+    audio_secs_per_char: Tuple[float, float] = (0.08, 0.15)
+    audio_min_delay: float = 2.0
+    audio_max_delay: float = 12.0
+    media_delay: float = 1.0
+
+    def delay_for(self, message: "OutboundMessage") -> float:
+        """
+        Calcula o atraso antes do envio de uma mensagem.
+
+        @param message: Mensagem a ser enviada.
+        @returns: Segundos de espera simulando digitação/gravação.
+        """
+        if message.kind == "text":
+            secs = len(message.text or "") * random.uniform(*self.text_secs_per_char)
+            return min(max(secs, self.text_min_delay), self.text_max_delay)
+        if message.kind == "audio":
+            secs = len(message.text or "") * random.uniform(*self.audio_secs_per_char)
+            return min(max(secs, self.audio_min_delay), self.audio_max_delay)
+        return self.media_delay
+
+
+@dataclass
+class OutboundMessage:
+    """Mensagem enfileirada para entrega ao cliente por uma conversa (atendimento)."""
+    kind: str  # 'text', 'audio' ou 'drive'
+    company: models.Company
+    atendimento_id: int
+    number: str
+    text: Optional[str] = None
+    # --- Campos para arquivos do Drive ---
+    drive_file_id: Optional[str] = None
+    filename: Optional[str] = None
+    media_type: Optional[str] = None
+    mimetype: Optional[str] = None
+    caption: Optional[str] = None
+
+
+async def _append_history(atendimento_id: int, entry: Dict) -> None:
+    """Registra no histórico (conversa) a mensagem efetivamente entregue, em transação curta."""
+    async with SessionLocal() as db_write:
+        async with db_write.begin():
+            at = await db_write.get(models.Atendimento, atendimento_id, with_for_update=True)
+            if at:
+                historico_db = json.loads(at.conversa or "[]")
+                historico_db.append(entry)
+                at.conversa = json.dumps(historico_db, ensure_ascii=False)
+                db_write.add(at)
+
+
+class OutboundDeliveryService:
+    """
+    Pipeline de entrega de mensagens da IA desacoplado da execução do agente.
+
+    As ferramentas apenas gravam os balões na fila durável (tabela outbound_deliveries); uma task por
+    conversa consome a fila em ordem, aplica a cadência de digitação, envia pelo WhatsApp e persiste no
+    histórico. Assim a rodada do agente termina sem esperar pelos atrasos de humanização.
+
+    - Entregas pendentes sobrevivem a reinícios: o worker do agente retoma a fila a cada ciclo (resume_pending).
+    - O índice único parcial garante uma única entrega em envio por conversa, também entre processos.
+    - Falhas são reenviadas com backoff até OUTBOUND_DELIVERY_MAX_ATTEMPTS; esgotadas as tentativas, a
+      entrega e as seguintes da conversa ficam 'failed' e o atendimento vai para 'Falha no Envio'.
+    - Uma mensagem aceita pela Meta nunca é reenviada: o envio grava sent_entry na linha antes do histórico.
+      Só um processo que morra entre a resposta da Meta e essa gravação pode causar reenvio.
+    """
+
+    def __init__(self, policy: Optional[PacingPolicy] = None):
+        self.policy = policy or PacingPolicy()
+        self._tasks: Dict[int, asyncio.Task] = {}
+        # Conversas que receberam mensagens enquanto a task de envio verificava a fila
+        self._rechecks: Set[int] = set()
+        self._closing = False
+        self.last_purge_at: Optional[datetime] = None
+
+    async def enqueue(self, message: OutboundMessage) -> None:
+        """
+        Grava a mensagem na fila da conversa e garante que exista uma task de envio ativa neste processo.
+
+        @param message: Mensagem a ser entregue.
+        """
+        async with SessionLocal() as db:
+            db.add(models.OutboundDelivery(
+                atendimento_id=message.atendimento_id,
+                company_id=message.company.id,
+                kind=message.kind,
+                number=message.number,
+                text=message.text,
+                drive_file_id=message.drive_file_id,
+                filename=message.filename,
+                media_type=message.media_type,
+                mimetype=message.mimetype,
+                caption=message.caption,
+                not_before=datetime.now(timezone.utc)
+            ))
+            await db.commit()
+        self._ensure_sender(message.atendimento_id)
+
+    def _ensure_sender(self, atendimento_id: int) -> None:
+        if self._closing:
+            return
+        task = self._tasks.get(atendimento_id)
+        if task is not None and not task.done():
+            self._rechecks.add(atendimento_id)
+            return
+        task = asyncio.create_task(self._sender_loop(atendimento_id))
+        self._tasks[atendimento_id] = task
+        task.add_done_callback(lambda done, key=atendimento_id: self._on_sender_done(key, done))
+
+    def _on_sender_done(self, atendimento_id: int, task: asyncio.Task) -> None:
+        if self._tasks.get(atendimento_id) is task:
+            self._tasks.pop(atendimento_id, None)
+
+    async def pending_atendimento_ids(self, atendimento_ids: Iterable[int]) -> Set[int]:
+        """
+        Filtra as conversas que ainda têm mensagens aguardando entrega (ou em envio), em qualquer processo.
+
+        @param atendimento_ids: IDs dos atendimentos a verificar.
+        @returns: IDs que ainda possuem entregas pendentes.
+        """
+        ids = list(atendimento_ids)
+        if not ids:
+            return set()
+        delivery = models.OutboundDelivery
+        async with SessionLocal() as db:
+            result = await db.execute(
+                select(delivery.atendimento_id)
+                .where(delivery.atendimento_id.in_(ids), delivery.status.in_(PENDING_STATUSES))
+                .distinct()
+            )
+        return set(result.scalars().all())
+
+    async def resume_pending(self) -> None:
+        """
+        Retoma a fila durável: devolve à fila entregas presas em 'sending' por um processo que morreu e inicia
+        tasks de envio para conversas com mensagens na fila sem task ativa. Também remove falhas antigas.
+        """
+        delivery = models.OutboundDelivery
+        now = datetime.now(timezone.utc)
+        async with SessionLocal() as db:
+            stale = await db.execute(
+                update(delivery)
+                .where(
+                    delivery.status == "sending",
+                    delivery.claimed_at < now - timedelta(seconds=settings.OUTBOUND_DELIVERY_STALE_SECONDS)
+                )
+                .values(status="queued", claimed_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            pending = await db.execute(
+                select(delivery.atendimento_id)
+                .where(delivery.status == "queued", delivery.not_before <= now)
+                .distinct()
+            )
+            atendimento_ids = pending.scalars().all()
+            await db.commit()
+        if stale.rowcount:
+            logger.warning(f"Entrega: {stale.rowcount} mensagem(ns) interrompida(s) durante o envio voltaram para a fila.")
+
+        for atendimento_id in atendimento_ids:
+            if atendimento_id not in self._tasks:
+                self._ensure_sender(atendimento_id)
+
+        try:
+            await self.purge_failed()
+        except Exception as e:
+            logger.warning(f"Entrega: Falha ao remover entregas antigas com falha: {e}")
+
+    async def purge_failed(self) -> None:
+        """Remove, no máximo uma vez por hora, entregas com falha há mais de OUTBOUND_DELIVERY_RETENTION_DAYS."""
+        now = datetime.now(timezone.utc)
+        if self.last_purge_at and now - self.last_purge_at < timedelta(hours=1):
+            return
+        self.last_purge_at = now
+        delivery = models.OutboundDelivery
+        async with SessionLocal() as db:
+            result = await db.execute(
+                delete(delivery).where(
+                    delivery.status == "failed",
+                    delivery.created_at < now - timedelta(days=settings.OUTBOUND_DELIVERY_RETENTION_DAYS)
+                )
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.info(f"Entrega: {result.rowcount} entrega(s) antiga(s) com falha removida(s).")
+
+    async def shutdown(self, timeout: float) -> None:
+        """
+        Drena as filas no encerramento do processo: aguarda as tasks de envio terminarem por até `timeout`
+        segundos e interrompe as restantes. Mensagens não enviadas continuam na fila durável.
+
+        @param timeout: Tempo máximo de espera em segundos.
+        """
+        self._closing = True
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        logger.info(f"Entrega: Aguardando {len(tasks)} conversa(s) com mensagens em entrega (até {timeout:.0f}s)...")
+        _, still_running = await asyncio.wait(tasks, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        await asyncio.gather(*still_running, return_exceptions=True)
+        if still_running:
+            logger.warning(f"Entrega: {len(still_running)} conversa(s) interrompida(s); as mensagens restantes serão entregues no próximo início.")
+
+    async def _claim_next(self, atendimento_id: int) -> Tuple[Optional[models.OutboundDelivery], Optional[float]]:
+        """
+        Reivindica a próxima mensagem da conversa, respeitando a ordem de id.
+
+        @returns: (entrega marcada como 'sending', None); (None, segundos) se a próxima ainda aguarda o backoff;
+                  (None, None) se a fila está vazia ou outro processo está enviando a conversa.
+        """
+        delivery = models.OutboundDelivery
+        now = datetime.now(timezone.utc)
+        try:
+            async with SessionLocal() as db:
+                async with db.begin():
+                    head = (await db.execute(
+                        select(delivery)
+                        .where(delivery.atendimento_id == atendimento_id, delivery.status.in_(PENDING_STATUSES))
+                        .order_by(delivery.id)
+                        .limit(1)
+                    )).scalar_one_or_none()
+                    if head is None or head.status == "sending":
+                        return None, None
+                    wait = (head.not_before - now).total_seconds()
+                    if wait > 0:
+                        return None, wait
+                    claimed = await db.execute(
+                        update(delivery)
+                        .where(delivery.id == head.id, delivery.status == "queued")
+                        .values(status="sending", claimed_at=now)
+                        .execution_options(synchronize_session=False)
+                    )
+                    if not claimed.rowcount:
+                        return None, None
+        except IntegrityError:
+            # Outro processo começou a enviar esta conversa (uq_outbound_deliveries_sending)
+            return None, None
+        return head, None
+
+    async def _sender_loop(self, atendimento_id: int) -> None:
+        while True:
+            try:
+                delivery, wait = await self._claim_next(atendimento_id)
+            except Exception as e:
+                # A fila é retomada pelo próximo ciclo do worker (resume_pending)
+                logger.error(f"Entrega (Atend: {atendimento_id}): Falha ao ler a fila: {e}", exc_info=True)
+                return
+
+            if delivery is None:
+                if wait is not None:
+                    await asyncio.sleep(wait)
+                    continue
+                # Sem await entre a checagem e o retorno: nenhum enqueue pode se intercalar aqui
+                if atendimento_id in self._rechecks:
+                    self._rechecks.discard(atendimento_id)
+                    continue
+                return
+
+            try:
+                await self._process(delivery)
+            except Exception as e:
+                # A entrega fica em 'sending' e volta para a fila após OUTBOUND_DELIVERY_STALE_SECONDS
+                logger.error(f"Entrega (Atend: {atendimento_id}): Falha ao registrar o resultado do envio: {e}", exc_info=True)
+                return
+
+    async def _process(self, delivery: models.OutboundDelivery) -> None:
+        """
+        Envia uma entrega reivindicada e grava o histórico, em duas etapas independentes:
+
+        1. Envio: só ocorre se a entrega ainda não tem sent_entry. Assim que a Meta aceita a mensagem, a entrada
+           do histórico (com o ID da mensagem) é gravada na linha; falhas aqui passam por _record_failure.
+        2. Histórico: falhas apenas devolvem a entrega à fila com sent_entry preenchido, e a nova tentativa
+           grava o histórico sem chamar o WhatsApp de novo.
+        """
+        atendimento_id = delivery.atendimento_id
+        entry = delivery.sent_entry
+        if entry is None:
+            try:
+                entry = await self._send(delivery)
+            except asyncio.CancelledError:
+                # Encerramento do processo: a mensagem volta para a fila e é entregue no próximo início
+                await self._release(delivery.id)
+                raise
+            except Exception as e:
+                await self._record_failure(delivery, e)
+                return
+            # Protegido do cancelamento: sem esta gravação, a retomada reenviaria a mensagem
+            try:
+                await asyncio.shield(self._update(delivery.id, sent_entry=entry, audio_data=None))
+            except Exception as e:
+                # Segue para o histórico: gravado e removida a linha, a mensagem também não é reenviada
+                logger.error(f"Entrega (Atend: {atendimento_id}): Não foi possível registrar o envio na fila: {e}", exc_info=True)
+
+        try:
+            await _append_history(atendimento_id, entry)
+        except asyncio.CancelledError:
+            await self._release(delivery.id)
+            raise
+        except Exception as e:
+            retry_in = settings.OUTBOUND_DELIVERY_RETRY_SECONDS
+            logger.error(f"Entrega (Atend: {atendimento_id}): Mensagem enviada, mas o histórico não foi gravado; nova gravação em {retry_in:.0f}s: {e}", exc_info=True)
+            await self._update(
+                delivery.id, status="queued", claimed_at=None,
+                not_before=datetime.now(timezone.utc) + timedelta(seconds=retry_in)
+            )
+            return
+
+        async with SessionLocal() as db:
+            await db.execute(delete(models.OutboundDelivery).where(models.OutboundDelivery.id == delivery.id))
+            await db.commit()
+
+    async def _update(self, delivery_id: int, **values) -> None:
+        async with SessionLocal() as db:
+            await db.execute(
+                update(models.OutboundDelivery)
+                .where(models.OutboundDelivery.id == delivery_id)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+    async def _release(self, delivery_id: int) -> None:
+        try:
+            async with SessionLocal() as db:
+                await db.execute(
+                    update(models.OutboundDelivery)
+                    .where(models.OutboundDelivery.id == delivery_id, models.OutboundDelivery.status == "sending")
+                    .values(status="queued", claimed_at=None)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+        except Exception as e:
+            logger.warning(f"Entrega {delivery_id}: Não foi possível devolvê-la à fila; ela será retomada após OUTBOUND_DELIVERY_STALE_SECONDS: {e}")
+
+    async def _record_failure(self, delivery: models.OutboundDelivery, error: Exception) -> None:
+        """
+        Agenda uma nova tentativa com backoff ou, esgotadas as tentativas, marca a entrega (e as seguintes
+        da conversa, para não entregar balões fora de contexto) como 'failed' e o atendimento como 'Falha no Envio'.
+        """
+        atendimento_id = delivery.atendimento_id
+        attempts = delivery.attempts + 1
+        now = datetime.now(timezone.utc)
+        outbound = models.OutboundDelivery
+        async with SessionLocal() as db:
+            async with db.begin():
+                if attempts < settings.OUTBOUND_DELIVERY_MAX_ATTEMPTS:
+                    retry_in = settings.OUTBOUND_DELIVERY_RETRY_SECONDS * (2 ** (attempts - 1))
+                    logger.warning(f"Entrega (Atend: {atendimento_id}): Falha ao entregar '{delivery.kind}' (tentativa {attempts}); nova tentativa em {retry_in:.0f}s: {error}")
+                    await db.execute(
+                        update(outbound)
+                        .where(outbound.id == delivery.id)
+                        .values(status="queued", attempts=attempts, error=str(error), claimed_at=None, not_before=now + timedelta(seconds=retry_in))
+                        .execution_options(synchronize_session=False)
+                    )
+                    return
+
+                logger.error(f"Entrega (Atend: {atendimento_id}): Falha definitiva ao entregar '{delivery.kind}' após {attempts} tentativa(s): {error}", exc_info=error)
+                await db.execute(
+                    update(outbound)
+                    .where(outbound.id == delivery.id)
+                    .values(status="failed", attempts=attempts, error=str(error))
+                    .execution_options(synchronize_session=False)
+                )
+                await db.execute(
+                    update(outbound)
+                    .where(outbound.atendimento_id == atendimento_id, outbound.status == "queued")
+                    .values(status="failed", error="Cancelada: uma mensagem anterior da conversa não pôde ser entregue.")
+                    .execution_options(synchronize_session=False)
+                )
+                at = await db.get(models.Atendimento, atendimento_id, with_for_update=True)
+                if at:
+                    at.status = "Falha no Envio"
+                    at.updated_at = now
+                    db.add(at)
+
+    async def _send(self, delivery: models.OutboundDelivery) -> Dict:
+        """
+        Aplica a cadência e envia a mensagem pelo WhatsApp.
+
+        @param delivery: Entrega reivindicada (ainda sem sent_entry).
+        @returns: Entrada do histórico da mensagem enviada.
+        """
+        from app.services.whatsapp_service import get_whatsapp_service
+        whatsapp_service = get_whatsapp_service()
+
+        async with SessionLocal() as db:
+            company = await db.get(models.Company, delivery.company_id)
+        if company is None:
+            raise ValueError(f"Empresa {delivery.company_id} não encontrada.")
+        message = OutboundMessage(
+            kind=delivery.kind,
+            company=company,
+            atendimento_id=delivery.atendimento_id,
+            number=delivery.number,
+            text=delivery.text,
+            drive_file_id=delivery.drive_file_id,
+            filename=delivery.filename,
+            media_type=delivery.media_type,
+            mimetype=delivery.mimetype,
+            caption=delivery.caption
+        )
+        delay = self.policy.delay_for(message)
+        logger.info(f"Entrega (Atend: {message.atendimento_id}): Simulando digitação/gravação por {delay:.1f}s antes de enviar '{message.kind}'.")
+        await asyncio.sleep(delay)
+        now_ts = int(datetime.now().timestamp())
+
+        if message.kind == "text":
+            sent_info = await whatsapp_service.send_text_message(
+                company=message.company,
+                number=message.number,
+                text=message.text
+            )
+            return {
+                "id": (sent_info or {}).get("id") or f"ai_{now_ts}_{random.randint(100, 999)}",
+                "role": "assistant",
+                "content": message.text,
+                "timestamp": now_ts,
+                "is_ai": True
+            }
+
+        if message.kind == "audio":
+            audio_bytes = delivery.audio_data
+            if audio_bytes is None:
+                from app.services.gemini_service import get_gemini_service
+                async with SessionLocal() as db_tts:
+                    audio_bytes = await get_gemini_service().generate_tts(
+                        text=message.text,
+                        db=db_tts,
+                        company=message.company,
+                        atendimento_id=message.atendimento_id
+                    )
+                # O áudio fica na linha: novas tentativas de envio não geram (nem cobram) o TTS de novo
+                await self._update(delivery.id, audio_data=audio_bytes)
+            sent_info = await whatsapp_service.send_media_message(
+                company=message.company,
+                number=message.number,
+                media_type="audio",
+                file_bytes=audio_bytes,
+                filename="audio.wav",
+                mimetype="audio/wav"
+            )
+            return {
+                "id": sent_info.get("id") or f"audio_{now_ts}_{random.randint(100, 999)}",
+                "role": "assistant",
+                "content": message.text,
+                "timestamp": now_ts,
+                "type": "audio",
+                "media_id": sent_info.get("media_id") or None,
+                "filename": "audio.wav",
+                "is_ai": True
+            }
+
+        if message.kind == "drive":
+            from app.services.google_drive_service import get_drive_service
+            file_bytes = await get_drive_service().download_file_bytes(message.drive_file_id)
+            if not file_bytes:
+                raise ValueError(f"Não foi possível obter os bytes do arquivo '{message.drive_file_id}' no Google Drive.")
+            sent_info = await whatsapp_service.send_media_message(
+                company=message.company,
+                number=message.number,
+                media_type=message.media_type,
+                file_bytes=file_bytes,
+                filename=message.filename,
+                mimetype=message.mimetype,
+                caption=message.caption
+            )
+            return {
+                "id": sent_info.get("id") or f"media_{now_ts}",
+                "role": "assistant",
+                "content": f"[Arquivo Enviado: {message.filename}]",
+                "timestamp": now_ts,
+                "type": message.media_type,
+                "media_id": sent_info.get("media_id") or message.drive_file_id,
+                "filename": message.filename,
+                "caption": message.caption or None,
+                "is_ai": True
+            }
+
+        raise ValueError(f"Tipo de mensagem de saída desconhecido: '{message.kind}'")
+
+
+_outbound_delivery_service_instance: Optional[OutboundDeliveryService] = None
+
+def get_outbound_delivery_service() -> OutboundDeliveryService:
+    global _outbound_delivery_service_instance
+    if _outbound_delivery_service_instance is None:
+        _outbound_delivery_service_instance = OutboundDeliveryService()
+    return _outbound_delivery_service_instance
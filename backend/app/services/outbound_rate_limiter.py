@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import random
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.core.config import settings
+from app.db import models
+from app.db.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Classes de prioridade dos envios, da maior para a menor
+PRIORITY_INTERACTIVE = "interactive" # Respostas a conversas em andamento (IA e atendente)
+PRIORITY_AUTOMATED = "automated"     # Follow-ups automáticos
+PRIORITY_BULK = "bulk"               # Disparos em massa
+
+# Espera mínima/máxima entre tentativas de obter saldo
+MIN_WAIT_SECONDS = 0.05
+MAX_WAIT_SECONDS = 5.0
+
+
+def priority_reserve(priority: str) -> float:
+    """
+    Fração da capacidade do número que a classe NÃO pode consumir (fica para as classes acima).
+
+    @param priority: Classe de prioridade do envio.
+    @returns: Fração entre 0 e 1.
+    """
+    if priority == PRIORITY_BULK:
+        return settings.OUTBOUND_RESERVE_BULK
+    if priority == PRIORITY_AUTOMATED:
+        return settings.OUTBOUND_RESERVE_AUTOMATED
+    return 0.0
+
+
+class OutboundRateLimiter:
+    """
+    Limitador de envios por número do WhatsApp com token buckets guardados no Postgres, para que API e
+    workers (agente, follow-up, disparos) respeitem o mesmo orçamento.
+
+    - Bucket do número: capacidade e recarga pelo throughput do número na Meta.
+    - Bucket do par (número, destinatário): cadência do pair rate limit, com rajada limitada.
+    - Prioridade: cada classe só consome enquanto o saldo do número ficar acima da sua reserva. Disparos
+      em massa esgotam apenas a parte não reservada; respostas interativas sempre encontram saldo.
+
+    Cada tentativa é um único upsert atômico (recarga + consumo), sem locks entre processos. Se o banco
+    falhar, o envio segue sem limite (o limitador nunca bloqueia o atendimento).
+    """
+
+    def __init__(self):
+        self.last_gc_at: Optional[datetime] = None
+
+    async def _try_take(self, key: str, capacity: float, rate: float, reserve: float) -> Optional[float]:
+        """
+        Tenta consumir 1 token do bucket.
+
+        @returns: None se consumiu; senão, segundos estimados até haver saldo.
+        """
+        bucket = models.OutboundRateBucket
+        elapsed = func.extract("epoch", func.now() - bucket.updated_at)
+        refilled = func.least(capacity, bucket.tokens + elapsed * rate)
+
+        stmt = pg_insert(bucket).values(bucket_key=key, tokens=capacity - 1, updated_at=func.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[bucket.bucket_key],
+            set_={"tokens": refilled - 1, "updated_at": func.now()},
+            where=refilled >= 1 + reserve
+        ).returning(bucket.tokens)
+
+        async with SessionLocal() as db:
+            taken = (await db.execute(stmt)).first()
+            if taken is not None:
+                await db.commit()
+                return None
+            available = (await db.execute(select(refilled).where(bucket.bucket_key == key))).scalar_one_or_none()
+            await db.commit()
+        return max((1 + reserve - (available or 0.0)) / rate, MIN_WAIT_SECONDS)
+
+    async def _acquire_bucket(self, key: str, capacity: float, rate: float, reserve: float) -> None:
+        while True:
+            wait = await self._try_take(key, capacity, rate, reserve)
+            if wait is None:
+                return
+            # Jitter para que processos concorrentes não tentem todos no mesmo instante
+            await asyncio.sleep(min(wait, MAX_WAIT_SECONDS) * random.uniform(1.0, 1.2))
+
+    async def acquire(self, phone_number_id: str, recipient: str, priority: str = PRIORITY_INTERACTIVE, messages_per_second: Optional[float] = None) -> None:
+        """
+        Aguarda até o envio caber nos limites do par e do número.
+
+        @param phone_number_id: wbp_phone_number_id remetente.
+        @param recipient: Número de destino (normalizado).
+        @param priority: 'interactive', 'automated' ou 'bulk'.
+        @param messages_per_second: Throughput do número (padrão: OUTBOUND_PHONE_MESSAGES_PER_SECOND).
+        """
+        if not settings.OUTBOUND_RATE_LIMIT_ENABLED or not phone_number_id:
+            return
+
+        phone_rate = max(float(messages_per_second or settings.OUTBOUND_PHONE_MESSAGES_PER_SECOND), 0.1)
+        pair_rate = max(settings.OUTBOUND_PAIR_MESSAGES_PER_MINUTE, 0.1) / 60.0
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            # O par primeiro: esperar por ele não desperdiça saldo do número
+            if recipient:
+                await self._acquire_bucket(
+                    f"pair:{phone_number_id}:{recipient}", max(float(settings.OUTBOUND_PAIR_BURST), 1.0), pair_rate, 0.0
+                )
+            # Capacidade de 1 segundo de throughput; a reserva sempre deixa ao menos 1 token para a classe
+            phone_capacity = max(phone_rate, 1.0)
+            reserve = min(priority_reserve(priority) * phone_capacity, phone_capacity - 1)
+            await self._acquire_bucket(f"phone:{phone_number_id}", phone_capacity, phone_rate, reserve)
+        except Exception as e:
+            logger.warning(f"Limite de envio: Falha ao consultar os buckets ({phone_number_id}); enviando sem limite: {e}")
+            return
+
+        waited = loop.time() - start
+        if waited >= 1.0:
+            logger.info(f"Limite de envio: Envio '{priority}' de {phone_number_id} para {recipient} aguardou {waited:.1f}s.")
+
+        try:
+            await self.collect_garbage()
+        except Exception as e:
+            logger.warning(f"Limite de envio: Falha ao remover buckets ociosos: {e}")
+
+    async def collect_garbage(self) -> None:
+        """Remove, no máximo uma vez por hora por processo, buckets sem uso há OUTBOUND_BUCKET_IDLE_HOURS."""
+        now = datetime.now(timezone.utc)
+        if self.last_gc_at and now - self.last_gc_at < timedelta(hours=1):
+            return
+        self.last_gc_at = now
+        bucket = models.OutboundRateBucket
+        async with SessionLocal() as db:
+            result = await db.execute(
+                delete(bucket).where(bucket.updated_at < now - timedelta(hours=settings.OUTBOUND_BUCKET_IDLE_HOURS))
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.info(f"Limite de envio: {result.rowcount} bucket(s) ocioso(s) removido(s).")
+
+
+_outbound_rate_limiter_instance: Optional[OutboundRateLimiter] = None
+
+def get_outbound_rate_limiter() -> OutboundRateLimiter:
+    global _outbound_rate_limiter_instance
+    if _outbound_rate_limiter_instance is None:
+        _outbound_rate_limiter_instance = OutboundRateLimiter()
+    return _outbound_rate_limiter_instance
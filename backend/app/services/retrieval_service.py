@@ -0,0 +1,186 @@
+import logging
+from dataclasses import dataclass
+from typing import List, Optional
+
+from sqlalchemy import Float, case, cast, func, literal, null, or_, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import models
+from app.services.vector_index_service import apply_vector_search_settings
+
+logger = logging.getLogger(__name__)
+
+# Constante de suavização do Reciprocal Rank Fusion (valor usual da literatura)
+RRF_K = 60
+# Distância de cosseno máxima aceita para candidatos vetoriais
+MAX_COSINE_DISTANCE = 0.65
+# Candidatos considerados por ramo (lexical / vetorial) antes da fusão
+CANDIDATES_PER_BRANCH = 20
+
+
+@dataclass
+class HybridSearchHit:
+    """Registro retornado pela busca híbrida, com os sinais usados na fusão (para diagnóstico)."""
+    vector: models.KnowledgeVector
+    score: float
+    lex_rank: Optional[int]
+    vec_rank: Optional[int]
+    distance: Optional[float]
+    in_category: bool
+
+
+def extrair_termos(termo_busca: str) -> List[str]:
+    """
+    Divide o termo de busca em palavras para o ramo lexical (sem stopwords hardcoded).
+
+    @param termo_busca: Texto informado pela IA.
+    @returns: Lista de termos com mais de um caractere.
+    """
+    limpo = termo_busca.replace("?", "").replace("!", "").replace(",", "").replace(".", "")
+    return [t for t in limpo.split() if len(t) > 1]
+
+
+async def hybrid_search_knowledge(
+    db: AsyncSession,
+    config_id: int,
+    termo_busca: str,
+    query_embedding: Optional[List[float]],
+    categoria: Optional[str] = None,
+    limit: int = 3,
+    lexical_weight: float = 1.0,
+    vector_weight: float = 1.0
+) -> List[HybridSearchHit]:
+    """
+    Busca híbrida na base de conhecimento de uma persona em uma única instrução SQL.
+
+    Candidatos lexicais (todas as palavras via ILIKE) e vetoriais (distância de cosseno, dentro e fora
+    da categoria) são unidos e fundidos por Reciprocal Rank Fusion. O filtro de categoria é "suave":
+    se existir algum candidato na categoria, apenas eles são retornados; caso contrário, a base inteira.
+
+    @param db: Sessão do banco de dados.
+    @param config_id: Persona (Config) dona da base.
+    @param termo_busca: Texto da busca.
+    @param query_embedding: Embedding do termo (None desativa o ramo vetorial).
+    @param categoria: Categoria preferencial (comparação case-insensitive).
+    @param limit: Quantidade máxima de registros retornados.
+    @param lexical_weight: Peso do ramo lexical na fusão.
+    @param vector_weight: Peso do ramo vetorial na fusão.
+    @returns: Lista de HybridSearchHit ordenada pelo score de fusão.
+    """
+    kv = models.KnowledgeVector
+    categoria = categoria.strip() if categoria and categoria.strip() else None
+    in_cat_expr = kv.category.ilike(categoria) if categoria else literal(True)
+    termos = extrair_termos(termo_busca)
+
+    ramos = []
+
+    if termos:
+        # Ramo lexical: exige todas as palavras; prioriza a categoria e textos mais curtos (mais específicos)
+        lex_order = (in_cat_expr.desc(), func.length(kv.content), kv.id)
+        lex = (
+            select(kv.id.label("id"), func.row_number().over(order_by=lex_order).label("rnk"))
+            .where(kv.config_id == config_id, *[kv.content.ilike(f"%{t}%") for t in termos])
+            .order_by(*lex_order)
+            .limit(CANDIDATES_PER_BRANCH)
+            .subquery("lex")
+        )
+        ramos.append(select(lex.c.id, literal("lex").label("source"), lex.c.rnk, cast(null(), Float).label("distance")))
+
+    if query_embedding:
+        distancia = kv.embedding.cosine_distance(query_embedding)
+        filtros_vetoriais = [("vec_all", [])]
+        if categoria:
+            filtros_vetoriais.append(("vec_cat", [kv.category.ilike(categoria)]))
+        for nome, filtros in filtros_vetoriais:
+            vec = (
+                select(kv.id.label("id"), func.row_number().over(order_by=distancia).label("rnk"), distancia.label("distance"))
+                .where(kv.config_id == config_id, kv.embedding.isnot(None), distancia < MAX_COSINE_DISTANCE, *filtros)
+                .order_by(distancia)
+                .limit(CANDIDATES_PER_BRANCH)
+                .subquery(nome)
+            )
+            ramos.append(select(vec.c.id, literal("vec").label("source"), vec.c.rnk, vec.c.distance))
+
+    if not ramos:
+        return []
+
+    candidatos = union_all(*ramos).subquery("candidatos")
+    lex_rank = func.min(candidatos.c.rnk).filter(candidatos.c.source == "lex")
+    vec_rank = func.min(candidatos.c.rnk).filter(candidatos.c.source == "vec")
+    fundidos = (
+        select(
+            candidatos.c.id,
+            lex_rank.label("lex_rank"),
+            vec_rank.label("vec_rank"),
+            func.min(candidatos.c.distance).label("distance"),
+            (
+                func.coalesce(lexical_weight / (RRF_K + lex_rank), 0.0)
+                + func.coalesce(vector_weight / (RRF_K + vec_rank), 0.0)
+            ).label("score")
+        )
+        .group_by(candidatos.c.id)
+        .subquery("fundidos")
+    )
+
+    in_category = case((in_cat_expr, True), else_=False)
+    ranqueados = (
+        select(
+            kv.id.label("id"),
+            fundidos.c.score,
+            fundidos.c.lex_rank,
+            fundidos.c.vec_rank,
+            fundidos.c.distance,
+            in_category.label("in_category"),
+            func.bool_or(in_category).over().label("any_in_category")
+        )
+        .join(fundidos, fundidos.c.id == kv.id)
+        .subquery("ranqueados")
+    )
+
+    stmt = (
+        select(
+            kv,
+            ranqueados.c.score,
+            ranqueados.c.lex_rank,
+            ranqueados.c.vec_rank,
+            ranqueados.c.distance,
+            ranqueados.c.in_category,
+            func.count().over().label("total_candidates")
+        )
+        .join(ranqueados, ranqueados.c.id == kv.id)
+        .where(or_(ranqueados.c.in_category, ranqueados.c.any_in_category.is_(False)))
+        .order_by(ranqueados.c.score.desc(), kv.id)
+        .limit(limit)
+    )
+
+    if query_embedding:
+        await apply_vector_search_settings(db)
+    rows = (await db.execute(stmt)).all()
+    hits = [
+        HybridSearchHit(
+            vector=row[0],
+            score=float(row.score or 0.0),
+            lex_rank=row.lex_rank,
+            vec_rank=row.vec_rank,
+            distance=float(row.distance) if row.distance is not None else None,
+            in_category=bool(row.in_category)
+        )
+        for row in rows
+    ]
+
+    # Diagnóstico a partir do próprio resultado (sem consultas extras)
+    total_candidatos = rows[0].total_candidates if rows else 0
+    usou_fallback = bool(categoria and hits and not any(h.in_category for h in hits))
+    logger.info(
+        f"[Busca Híbrida] config_id={config_id} termo='{termo_busca}' categoria='{categoria}' | "
+        f"termos_lexicais={len(termos)} vetorial={'sim' if query_embedding else 'não'} | "
+        f"candidatos_filtrados={total_candidatos} retornados={len(hits)}"
+        + (" | fallback sem categoria" if usou_fallback else "")
+    )
+    for idx, h in enumerate(hits, 1):
+        dist_str = f"{h.distance:.4f}" if h.distance is not None else "-"
+        logger.info(
+            f"  {idx}. ID: {h.vector.id} | RRF: {h.score:.5f} | Rank lexical: {h.lex_rank or '-'} | "
+            f"Rank vetorial: {h.vec_rank or '-'} | Distância: {dist_str} | Conteúdo preliminar: {(h.vector.content or '')[:80]}..."
+        )
+    return hits
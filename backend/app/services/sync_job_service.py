@@ -0,0 +1,176 @@
+import logging
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+
+from sqlalchemy import case, func, or_, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db import models
+from app.db.database import SessionLocal
+from app.services.embedding_executor import EmbeddingProgress
+
+logger = logging.getLogger(__name__)
+
+SYNC_KINDS = ("system", "rag", "drive")
+FINISHED_STATUSES = ("done", "error", "cancelled")
+
+
+class SyncJobNotFoundError(Exception):
+    """Exceção para job de sincronização inexistente ou de outra empresa."""
+    pass
+
+
+async def enqueue_sync_job(
+    db: AsyncSession,
+    config_id: int,
+    company_id: int,
+    kind: str,
+    resource_id: str,
+    force_full: bool = False,
+    trigger: str = "manual",
+    commit: bool = True
+) -> models.SyncJob:
+    """
+    Enfileira uma sincronização para o worker. Se já houver um job na fila para a mesma config e tipo,
+    o pedido é absorvido por ele (no máximo um na fila e um em execução por config/tipo).
+
+    Pedidos manuais ficam disponíveis imediatamente. Notificações do Drive chegam em rajadas enquanto o
+    usuário edita: cada uma adia o job para SYNC_JOB_DEBOUNCE_SECONDS depois dela, limitado a
+    SYNC_JOB_DEBOUNCE_MAX_SECONDS desde a criação do job, e a rajada inteira vira uma única sincronização.
+
+    @param db: Sessão do banco de dados.
+    @param config_id: ID da configuração.
+    @param company_id: ID da empresa.
+    @param kind: 'system', 'rag' ou 'drive'.
+    @param resource_id: ID da planilha ou pasta.
+    @param force_full: Drive: força a varredura completa (prevalece se qualquer pedido absorvido pedir).
+    @param trigger: 'manual' ou 'webhook' (pedido manual prevalece; ele re-registra o watch ao final).
+    @param commit: False quando o pedido faz parte de uma operação maior do chamador: o job só é gravado na
+                   transação da sessão (flush) e fica visível ao worker quando o chamador fizer o commit.
+    @returns: Job na fila (novo ou já existente).
+    """
+    if kind not in SYNC_KINDS:
+        raise ValueError(f"Tipo de sincronização inválido: {kind}")
+
+    delay = 0.0 if trigger == "manual" else settings.SYNC_JOB_DEBOUNCE_SECONDS
+    job = models.SyncJob
+    stmt = pg_insert(job).values(
+        config_id=config_id,
+        company_id=company_id,
+        kind=kind,
+        resource_id=resource_id,
+        force_full=force_full,
+        trigger=trigger,
+        status="queued",
+        run_after=datetime.now(timezone.utc) + timedelta(seconds=delay)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[job.config_id, job.kind],
+        index_where=text("status = 'queued'"),
+        set_={
+            "resource_id": stmt.excluded.resource_id,
+            "force_full": or_(job.force_full, stmt.excluded.force_full),
+            "trigger": case((job.trigger == "manual", "manual"), else_=stmt.excluded.trigger),
+            "run_after": case(
+                (stmt.excluded.trigger == "manual", stmt.excluded.run_after),
+                (job.trigger == "manual", job.run_after),
+                else_=func.least(
+                    stmt.excluded.run_after,
+                    job.created_at + timedelta(seconds=settings.SYNC_JOB_DEBOUNCE_MAX_SECONDS)
+                )
+            ),
+        }
+    ).returning(job.id)
+    job_id = (await db.execute(stmt)).scalar_one()
+    if commit:
+        await db.commit()
+    else:
+        await db.flush()
+
+    queued = await db.get(models.SyncJob, job_id, populate_existing=True)
+    logger.info(f"Sync job {job_id} na fila (Config: {config_id}, Tipo: {kind}, Origem: {trigger}).")
+    return queued
+
+
+async def get_sync_job(db: AsyncSession, job_id: int, company_id: int) -> models.SyncJob:
+    """
+    @param job_id: ID do job.
+    @param company_id: Empresa do usuário (jobs de outras empresas não são visíveis).
+    @returns: Job encontrado.
+    """
+    job = await db.get(models.SyncJob, job_id)
+    if not job or job.company_id != company_id:
+        raise SyncJobNotFoundError("Job de sincronização não encontrado.")
+    return job
+
+
+async def cancel_sync_job(db: AsyncSession, job_id: int, company_id: int) -> models.SyncJob:
+    """
+    Cancela um job: na fila é cancelado na hora; em execução, o worker interrompe no próximo ciclo.
+
+    @returns: Job atualizado.
+    """
+    job = await get_sync_job(db, job_id, company_id)
+    if job.status == "queued":
+        job.status = "cancelled"
+        job.finished_at = datetime.now(timezone.utc)
+    elif job.status == "running":
+        job.cancel_requested = True
+    db.add(job)
+    await db.commit()
+    return job
+
+
+async def get_last_synced_revision(db: AsyncSession, config_id: int, kind: str, resource_id: str) -> Optional[str]:
+    """
+    Versão do arquivo registrada na última sincronização concluída da config/tipo para o mesmo recurso.
+
+    @returns: Versão, ou None se não houver execução anterior com versão conhecida.
+    """
+    job = models.SyncJob
+    result = await db.execute(
+        select(job.source_revision)
+        .where(
+            job.config_id == config_id,
+            job.kind == kind,
+            job.resource_id == resource_id,
+            job.status == "done",
+            job.source_revision.is_not(None)
+        )
+        .order_by(job.finished_at.desc())
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
+class SyncJobProgressReporter:
+    """
+    Callback de progresso da vetorização que grava o andamento no job, no máximo a cada
+    SYNC_JOB_PROGRESS_INTERVAL_SECONDS (e sempre ao concluir), sem segurar a sessão da sincronização.
+    """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self._last_write = 0.0
+
+    async def __call__(self, progress: EmbeddingProgress) -> None:
+        now = time.monotonic()
+        if progress.pending and now - self._last_write < settings.SYNC_JOB_PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last_write = now
+        async with SessionLocal() as db:
+            await db.execute(
+                update(models.SyncJob)
+                .where(models.SyncJob.id == self.job_id)
+                .values(
+                    progress_total=progress.total,
+                    progress_completed=progress.completed,
+                    progress_failed=progress.failed,
+                    heartbeat_at=datetime.now(timezone.utc)
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from typing import Optional
+
+from app.core.config import settings
+from app.crud import crud_user
+from app.db.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+async def flush_token_ledger() -> int:
+    """
+    Aplica ao saldo todos os eventos pendentes do ledger, em lotes de TOKEN_LEDGER_BATCH_SIZE.
+
+    @returns: Total de eventos aplicados nesta execução.
+    """
+    total = 0
+    while True:
+        async with SessionLocal() as db:
+            async with db.begin():
+                applied = await crud_user.apply_pending_token_usage(db, batch_size=settings.TOKEN_LEDGER_BATCH_SIZE)
+        total += applied
+        if applied < settings.TOKEN_LEDGER_BATCH_SIZE:
+            return total
+
+
+async def token_ledger_aggregator_loop():
+    """
+    Loop que, a cada TOKEN_LEDGER_FLUSH_INTERVAL_SECONDS, consolida o ledger de tokens
+    em Company.tokens e Atendimento.token_usage.
+    """
+    logger.info("Ledger: Iniciando loop do agregador de tokens...")
+    while True:
+        try:
+            await asyncio.sleep(settings.TOKEN_LEDGER_FLUSH_INTERVAL_SECONDS)
+            await flush_token_ledger()
+        except asyncio.CancelledError:
+            logger.info("Ledger: Loop do agregador de tokens cancelado.")
+            break
+        except Exception as e:
+            logger.error(f"Ledger: Erro ao agregar o ledger de tokens: {e}", exc_info=True)
+
+aggregator_task: Optional[asyncio.Task] = None
+
+def start_token_ledger_aggregator():
+    """
+    Inicia o agregador do ledger de tokens como uma tarefa de segundo plano assíncrona.
+    """
+    global aggregator_task
+    logger.info("Ledger: Iniciando agregador de tokens...")
+    aggregator_task = asyncio.create_task(token_ledger_aggregator_loop())
+
+async def stop_token_ledger_aggregator():
+    """Cancela o agregador e aplica os eventos restantes antes do encerramento do processo."""
+    global aggregator_task
+    if aggregator_task is not None:
+        aggregator_task.cancel()
+        try:
+            await aggregator_task
+        except asyncio.CancelledError:
+            pass
+        aggregator_task = None
+    try:
+        await flush_token_ledger()
+    except Exception as e:
+        logger.error(f"Ledger: Falha na agregação final do ledger de tokens: {e}", exc_info=True)
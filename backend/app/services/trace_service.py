@@ -0,0 +1,238 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueListener, RotatingFileHandler
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_company_rates(raw: str) -> Dict[int, float]:
+    """
+    Converte a string de configuração "company_id:taxa,..." em um dicionário.
+
+    @param raw: Valor de LLM_TRACE_COMPANY_SAMPLE_RATES (ex: "12:1.0,15:0").
+    @returns: Mapeamento company_id -> taxa de amostragem (0.0 a 1.0).
+    """
+    rates: Dict[int, float] = {}
+    for item in (raw or "").split(","):
+        if ":" not in item:
+            continue
+        company_str, rate_str = item.split(":", 1)
+        try:
+            rates[int(company_str.strip())] = min(max(float(rate_str.strip()), 0.0), 1.0)
+        except ValueError:
+            logger.warning(f"Trace: Entrada inválida em LLM_TRACE_COMPANY_SAMPLE_RATES ignorada: '{item}'")
+    return rates
+
+
+def _process_label() -> str:
+    """
+    Identifica o processo atual (api, worker_agent, worker_followup...) para o nome do arquivo de traces.
+
+    @returns: LLM_TRACE_PROCESS_NAME, ou o módulo executado (`python -m app.worker_agent` -> 'worker_agent'),
+              com o nome do subprocesso quando não for o principal (workers/reload do uvicorn).
+    """
+    label = settings.LLM_TRACE_PROCESS_NAME
+    if not label:
+        spec = getattr(sys.modules.get("__main__"), "__spec__", None)
+        name = spec.name if spec is not None and spec.name else os.path.splitext(os.path.basename(sys.argv[0] or ""))[0]
+        name = re.sub(r"\.__main__$", "", name or "")
+        label = name.rsplit(".", 1)[-1]
+        process_name = multiprocessing.current_process().name
+        if process_name != "MainProcess":
+            label = f"{label}-{process_name}"
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", label).strip("_") or "app"
+
+
+def process_trace_path(path: str) -> str:
+    """
+    Caminho do arquivo de traces deste processo. API e workers compartilham o diretório (volume .:/app);
+    cada processo grava e rotaciona o próprio arquivo, sem renomear o arquivo em uso por outro.
+
+    @param path: LLM_TRACE_FILE (ex: 'llm_traces.jsonl').
+    @returns: Caminho com o rótulo do processo (ex: 'llm_traces.worker_agent.jsonl').
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.{_process_label()}{ext or '.jsonl'}"
+
+
+def _truncate(value: Any, max_chars: int) -> Any:
+    """Trunca strings longas (inclusive aninhadas) para manter cada linha do JSONL com tamanho previsível."""
+    if isinstance(value, str) and len(value) > max_chars:
+        return value[:max_chars] + f"... [truncado {len(value) - max_chars} chars]"
+    if isinstance(value, list):
+        return [_truncate(v, max_chars) for v in value]
+    if isinstance(value, dict):
+        return {k: _truncate(v, max_chars) for k, v in value.items()}
+    return value
+
+
+class _JsonlFormatter(logging.Formatter):
+    """Serializa o dicionário do registro como uma linha JSON (executa na thread do listener)."""
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, default=str)
+
+
+class LLMTraceSink:
+    """
+    Coletor assíncrono de traces de chamadas LLM.
+
+    O hot path apenas decide a amostragem e enfileira um dicionário (put_nowait);
+    a serialização e a escrita em disco com rotação acontecem em uma thread
+    dedicada (QueueListener), de modo que o event loop nunca aguarda I/O de arquivo.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int,
+        backup_count: int,
+        queue_size: int,
+        default_rate: float,
+        company_rates: Dict[int, float],
+        max_field_chars: int,
+        enabled: bool = True
+    ):
+        self.enabled = enabled
+        self.default_rate = min(max(default_rate, 0.0), 1.0)
+        self.company_rates = company_rates
+        self.max_field_chars = max_field_chars
+        self.dropped = 0
+        self._queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=queue_size)
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._listener: Optional[QueueListener] = None
+
+    def _ensure_started(self) -> None:
+        # O arquivo só é aberto na primeira escrita amostrada, evitando criar arquivos vazios em workers sem tráfego
+        if self._listener is not None:
+            return
+        handler = RotatingFileHandler(
+            self._path,
+            maxBytes=self._max_bytes,
+            backupCount=self._backup_count,
+            encoding="utf-8",
+            delay=True
+        )
+        handler.setFormatter(_JsonlFormatter())
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+
+    def should_sample(self, company_id: Optional[int]) -> bool:
+        """
+        Decide se a chamada atual deve ser registrada.
+
+        @param company_id: Empresa dona da chamada (usa a taxa específica quando configurada).
+        @returns: True se o trace deve ser montado e enfileirado.
+        """
+        if not self.enabled:
+            return False
+        rate = self.company_rates.get(company_id, self.default_rate) if company_id is not None else self.default_rate
+        return rate > 0 and (rate >= 1.0 or random.random() < rate)
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        """
+        Enfileira um registro de trace sem bloquear. Se a fila estiver cheia o registro é descartado.
+
+        @param record: Dicionário com os campos do trace (modelo, tokens, latência, etc).
+        """
+        if not self.enabled:
+            return
+        payload = {"ts": datetime.now(timezone.utc).isoformat()}
+        payload.update({k: _truncate(v, self.max_field_chars) for k, v in record.items()})
+        try:
+            self._ensure_started()
+            self._queue.put_nowait(logging.makeLogRecord({"msg": payload}))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"Trace: Fila de traces cheia. {self.dropped} registro(s) descartado(s) até agora.")
+        except Exception as e:
+            logger.error(f"Trace: Falha ao enfileirar registro de trace: {e}")
+
+    def stop(self) -> None:
+        """Esvazia a fila pendente e encerra a thread de escrita (chamado no shutdown)."""
+        if self._listener is not None:
+            try:
+                self._listener.stop()
+            except queue.Full:
+                logger.warning("Trace: Fila cheia no encerramento; registros pendentes podem ter sido perdidos.")
+            self._listener = None
+
+
+def describe_prompt(prompt: Any) -> Any:
+    """
+    Converte o prompt enviado ao Gemini em algo serializável, substituindo mídias pelo seu tipo.
+
+    @param prompt: String ou lista de partes (texto/mídia).
+    @returns: Estrutura serializável em JSON.
+    """
+    if isinstance(prompt, str):
+        return prompt
+    if isinstance(prompt, list):
+        return [p if isinstance(p, str) else f"[MÍDIA/OBJETO: {type(p).__name__}]" for p in prompt]
+    return f"[{type(prompt).__name__}]"
+
+
+def summarize_agent_messages(messages: List[Any]) -> Dict[str, Any]:
+    """
+    Extrai o prompt de sistema, as chamadas de ferramenta e o fluxo da rodada a partir das mensagens do PydanticAI.
+
+    @param messages: Resultado de AgentRunResult.all_messages().
+    @returns: Dicionário com 'system_prompt', 'tool_calls' e 'messages' (partes simplificadas).
+    """
+    from pydantic_core import to_jsonable_python
+
+    system_prompt = None
+    tool_calls: List[Dict[str, Any]] = []
+    flow: List[Dict[str, Any]] = []
+
+    for msg in messages:
+        msg_dict = to_jsonable_python(msg)
+        for p in msg_dict.get("parts", []):
+            part_kind = p.get("part_kind")
+            content = p.get("content")
+            if part_kind == "system-prompt":
+                system_prompt = content
+            elif part_kind == "tool-call":
+                tool_calls.append({"tool_name": p.get("tool_name"), "args": p.get("args")})
+                flow.append({"kind": part_kind, "tool_name": p.get("tool_name"), "args": p.get("args")})
+            elif part_kind == "tool-return":
+                flow.append({"kind": part_kind, "tool_name": p.get("tool_name"), "content": content})
+            elif content is not None:
+                flow.append({"kind": part_kind, "content": content})
+
+    return {"system_prompt": system_prompt, "tool_calls": tool_calls, "messages": flow}
+
+
+_trace_sink_instance: Optional[LLMTraceSink] = None
+
+def get_trace_sink() -> LLMTraceSink:
+    global _trace_sink_instance
+    if _trace_sink_instance is None:
+        _trace_sink_instance = LLMTraceSink(
+            path=process_trace_path(settings.LLM_TRACE_FILE),
+            max_bytes=settings.LLM_TRACE_MAX_BYTES,
+            backup_count=settings.LLM_TRACE_BACKUP_COUNT,
+            queue_size=settings.LLM_TRACE_QUEUE_SIZE,
+            default_rate=settings.LLM_TRACE_SAMPLE_RATE,
+            company_rates=_parse_company_rates(settings.LLM_TRACE_COMPANY_SAMPLE_RATES),
+            max_field_chars=settings.LLM_TRACE_MAX_FIELD_CHARS,
+            enabled=settings.LLM_TRACE_ENABLED
+        )
+    return _trace_sink_instance
+
+def stop_trace_sink():
+    """Descarrega os traces pendentes no encerramento do processo."""
+    if _trace_sink_instance is not None:
+        _trace_sink_instance.stop()
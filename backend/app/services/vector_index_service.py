@@ -0,0 +1,125 @@
+import logging
+import re
+from typing import Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Índices HNSW gerenciados: (nome do índice, tabela, coluna de embedding)
+HNSW_INDEXES = [
+    ("ix_contextos_embedding_hnsw", "contextos", "embedding"),
+    ("ix_mensagens_embedding_hnsw", "mensagens", "embedding"),
+]
+
+# Busca iterativa (filtros seletivos sem perda de recall) só existe a partir do pgvector 0.8.0
+ITERATIVE_SCAN_MIN_VERSION = (0, 8, 0)
+
+_pgvector_version: Optional[Tuple[int, ...]] = None
+
+
+def _parse_version(raw: str) -> Tuple[int, ...]:
+    return tuple(int(p) for p in re.findall(r"\d+", raw or "")[:3])
+
+
+def _index_params_match(indexdef: str, m: int, ef_construction: int) -> bool:
+    """Confere se a definição existente do índice usa os parâmetros configurados."""
+    normalizado = indexdef.replace("'", "").replace(" ", "").lower()
+    return f"m={m}" in normalizado and f"ef_construction={ef_construction}" in normalizado
+
+
+async def _get_index_state(conn: AsyncConnection, index_name: str) -> Tuple[Optional[str], bool]:
+    """Retorna (definição, válido) do índice; definição None se ele não existir."""
+    result = await conn.execute(
+        text(
+            "SELECT pg_get_indexdef(i.indexrelid), i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = 'public' AND c.relname = :name"
+        ),
+        {"name": index_name}
+    )
+    row = result.first()
+    return (row[0], bool(row[1])) if row else (None, False)
+
+
+async def ensure_hnsw_indexes(conn: AsyncConnection) -> None:
+    """
+    Cria (ou recria, se m/ef_construction mudaram) os índices HNSW de distância de cosseno
+    das tabelas de embeddings, com CREATE INDEX CONCURRENTLY para não bloquear escritas durante a montagem do grafo.
+
+    A recriação monta o índice novo com nome temporário e só então troca pelo antigo, de modo que as
+    buscas nunca ficam sem índice. Índices inválidos deixados por uma construção concorrente interrompida
+    são descartados e refeitos.
+
+    @param conn: Conexão em modo AUTOCOMMIT (CONCURRENTLY não roda dentro de transação).
+    """
+    m = settings.VECTOR_HNSW_M
+    ef_construction = settings.VECTOR_HNSW_EF_CONSTRUCTION
+
+    for index_name, table, column in HNSW_INDEXES:
+        tmp_name = f"{index_name}_new"
+        try:
+            indexdef, valid = await _get_index_state(conn, index_name)
+            if indexdef and valid and _index_params_match(indexdef, m, ef_construction):
+                continue
+
+            # Sobra de uma recriação interrompida: sempre inválida ou incompleta, nunca usada pelas buscas
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {tmp_name}"))
+
+            if indexdef and valid:
+                logger.info(f"Índice vetorial '{index_name}' com parâmetros desatualizados. Recriando (m={m}, ef_construction={ef_construction})...")
+                build_name = tmp_name
+            else:
+                if indexdef:
+                    logger.info(f"Índice vetorial '{index_name}' inválido (construção interrompida). Removendo...")
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+                logger.info(f"Criando índice vetorial HNSW '{index_name}' em {table}.{column} (m={m}, ef_construction={ef_construction})...")
+                build_name = index_name
+
+            await conn.execute(text(
+                f"CREATE INDEX CONCURRENTLY {build_name} ON {table} USING hnsw ({column} vector_cosine_ops) "
+                f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+            ))
+
+            if build_name == tmp_name:
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+                await conn.execute(text(f"ALTER INDEX {tmp_name} RENAME TO {index_name}"))
+        except Exception as e:
+            logger.warning(f"Aviso: Não foi possível criar o índice vetorial '{index_name}': {e}")
+
+
+async def get_pgvector_version(db: AsyncSession) -> Tuple[int, ...]:
+    """
+    Retorna (e memoriza por processo) a versão instalada da extensão pgvector.
+
+    @param db: Sessão do banco de dados.
+    @returns: Tupla (major, minor, patch); vazia se a extensão não estiver instalada.
+    """
+    global _pgvector_version
+    if _pgvector_version is None:
+        result = await db.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'"))
+        _pgvector_version = _parse_version(result.scalar() or "")
+    return _pgvector_version
+
+
+async def apply_vector_search_settings(db: AsyncSession, ef_search: Optional[int] = None) -> None:
+    """
+    Ajusta, apenas para a transação corrente (SET LOCAL), os parâmetros da busca HNSW.
+
+    ef_search controla o equilíbrio recall x latência. Com filtros seletivos (config_id/company_id),
+    a busca iterativa continua percorrendo o grafo até preencher o LIMIT, em vez de devolver menos linhas.
+
+    @param db: Sessão que executará a consulta vetorial em seguida.
+    @param ef_search: Sobrescreve VECTOR_HNSW_EF_SEARCH para esta consulta.
+    """
+    ef = int(ef_search or settings.VECTOR_HNSW_EF_SEARCH)
+    version = await get_pgvector_version(db)
+    if not version:
+        return
+    await db.execute(text(f"SET LOCAL hnsw.ef_search = {ef}"))
+    iterative = settings.VECTOR_HNSW_ITERATIVE_SCAN.strip().lower()
+    if iterative in ("strict_order", "relaxed_order") and version >= ITERATIVE_SCAN_MIN_VERSION:
+        await db.execute(text(f"SET LOCAL hnsw.iterative_scan = {iterative}"))
@@ -9,6 +9,8 @@ import tempfile
 import asyncio
 from app.core.config import settings
 from app.services.security import decrypt_token
+from app.services.graph_api_client import get_graph_api_client
+from app.services.outbound_rate_limiter import PRIORITY_INTERACTIVE, get_outbound_rate_limiter
 from app.db import models, schemas
 import subprocess
 import mimetypes
@@ -97,15 +99,15 @@ class WhatsAppService:
         url = f"{self.wbp_graph_url_base}/{self.wbp_api_version}/{media_id}"
         headers = {"Authorization": f"Bearer {access_token}"}
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, headers=headers)
-                response.raise_for_status()
-                media_info = response.json()
-                media_url = media_info.get('url')
-                if not media_url:
-                    logger.error(f"WBP: API não retornou 'url' para media ID {media_id}. Resposta: {media_info}")
-                    return None
-                return media_url
+            client = get_graph_api_client()
+            response = await client.get(url, headers=headers)
+            response.raise_for_status()
+            media_info = response.json()
+            media_url = media_info.get('url')
+            if not media_url:
+                logger.error(f"WBP: API não retornou 'url' para media ID {media_id}. Resposta: {media_info}")
+                return None
+            return media_url
         except httpx.HTTPStatusError as e:
             error_body = e.response.text if e.response else "N/A"
             logger.error(f"WBP: Erro HTTP {e.response.status_code} ao obter URL da mídia {media_id}: {error_body}")
@@ -121,11 +123,11 @@ class WhatsAppService:
             return None
         headers = {"Authorization": f"Bearer {access_token}"}
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.get(media_url, headers=headers, follow_redirects=True)
-                response.raise_for_status()
-                logger.info(f"WBP: Mídia baixada ({len(response.content)} bytes).")
-                return response.content
+            client = get_graph_api_client()
+            response = await client.get(media_url, headers=headers, timeout=60.0, follow_redirects=True)
+            response.raise_for_status()
+            logger.info(f"WBP: Mídia baixada ({len(response.content)} bytes).")
+            return response.content
         except httpx.HTTPStatusError as e:
             error_body = e.response.text if e.response else "N/A"
             logger.error(f"WBP: Erro HTTP {e.response.status_code} ao baixar mídia: {error_body}")
@@ -156,15 +158,15 @@ class WhatsAppService:
         last_exception = None
         for attempt in range(max_retries):
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(url, headers=headers, json=payload, timeout=30.0)
-                    if response.status_code == 400:
-                         logger.error(f"WBP: Erro 400 Bad Request ao enviar para {clean_to_number}. Payload: {json.dumps(payload)}. Resposta API: {response.text}")
-                    response.raise_for_status()
-                    response_data = response.json()
-                    message_id = response_data.get("messages", [{}])[0].get("id")
-                    logger.info(f"WBP: Mensagem enviada para {clean_to_number} (ID: {message_id}, Tentativa {attempt + 1}).")
-                    return {"id": message_id}
+                client = get_graph_api_client()
+                response = await client.post(url, headers=headers, json=payload, timeout=30.0)
+                if response.status_code == 400:
+                     logger.error(f"WBP: Erro 400 Bad Request ao enviar para {clean_to_number}. Payload: {json.dumps(payload)}. Resposta API: {response.text}")
+                response.raise_for_status()
+                response_data = response.json()
+                message_id = response_data.get("messages", [{}])[0].get("id")
+                logger.info(f"WBP: Mensagem enviada para {clean_to_number} (ID: {message_id}, Tentativa {attempt + 1}).")
+                return {"id": message_id}
             except (httpx.RequestError, httpx.HTTPStatusError) as e:
                 last_exception = e
                 error_detail = "Erro de conexão/requisição"
@@ -416,21 +418,21 @@ class WhatsAppService:
         logger.info(f"WBP: Iniciando upload de mídia ({final_filename}, {final_mimetype}, {len(final_file_bytes)} bytes)...")
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=headers, files=files, timeout=120.0)
-                if response.status_code != 200:
-                    logger.error(f"WBP: Resposta de erro do upload (Status {response.status_code}): {response.text}")
-                response.raise_for_status()
-                response_data = response.json()
-                media_id = response_data.get("id")
-                
-                if not media_id:
-                    logger.error(f"WBP: Upload falhou. Sem ID. Resp: {response_data}")
-                    return None
-                    
-                logger.info(f"WBP: Upload sucesso. Media ID: {media_id}")
-                return media_id
+            client = get_graph_api_client()
+            response = await client.post(url, headers=headers, files=files, timeout=120.0)
+            if response.status_code != 200:
+                logger.error(f"WBP: Resposta de erro do upload (Status {response.status_code}): {response.text}")
+            response.raise_for_status()
+            response_data = response.json()
+            media_id = response_data.get("id")
+            
+            if not media_id:
+                logger.error(f"WBP: Upload falhou. Sem ID. Resp: {response_data}")
+                return None
                 
+            logger.info(f"WBP: Upload sucesso. Media ID: {media_id}")
+            return media_id
+            
         except httpx.HTTPStatusError as http_err:
             logger.error(f"WBP: Erro HTTP no upload. Status: {http_err.response.status_code} | Corpo: {http_err.response.text}", exc_info=True)
             return None
@@ -487,15 +489,15 @@ class WhatsAppService:
         logger.debug(f"WBP Send Media Payload to {clean_to_number}: {json.dumps(payload)}")
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=headers, json=payload, timeout=30.0)
-                response.raise_for_status()
-                response_data = response.json()
-                message_id = response_data.get("messages", [{}])[0].get("id")
-                
-                logger.info(f"WBP: Mídia ({media_type}) enviada para {clean_to_number} (ID: {message_id}).")
-                return {"id": message_id, "media_id": media_id}
-                
+            client = get_graph_api_client()
+            response = await client.post(url, headers=headers, json=payload, timeout=30.0)
+            response.raise_for_status()
+            response_data = response.json()
+            message_id = response_data.get("messages", [{}])[0].get("id")
+            
+            logger.info(f"WBP: Mídia ({media_type}) enviada para {clean_to_number} (ID: {message_id}).")
+            return {"id": message_id, "media_id": media_id}
+            
         except (httpx.RequestError, httpx.HTTPStatusError) as e:
             error_detail = str(e)
             if isinstance(e, httpx.HTTPStatusError) and e.response:
@@ -543,13 +545,13 @@ class WhatsAppService:
         logger.debug(f"WBP Send Template Payload to {clean_to_number}: {json.dumps(payload)}")
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=headers, json=payload, timeout=30.0)
-                response.raise_for_status()
-                response_data = response.json()
-                message_id = response_data.get("messages", [{}])[0].get("id")
-                logger.info(f"WBP: Mensagem de template '{template_name}' enviada para {clean_to_number} (ID: {message_id}).")
-                return {"id": message_id}
+            client = get_graph_api_client()
+            response = await client.post(url, headers=headers, json=payload, timeout=30.0)
+            response.raise_for_status()
+            response_data = response.json()
+            message_id = response_data.get("messages", [{}])[0].get("id")
+            logger.info(f"WBP: Mensagem de template '{template_name}' enviada para {clean_to_number} (ID: {message_id}).")
+            return {"id": message_id}
         except httpx.HTTPStatusError as e:
             error_body = e.response.text if e.response else "N/A"
             logger.error(f"WBP: Erro HTTP {e.response.status_code} ao enviar template '{template_name}' para {clean_to_number}: {error_body}")
@@ -558,13 +560,29 @@ class WhatsAppService:
             logger.error(f"WBP: Erro inesperado ao enviar template para {clean_to_number}: {e}", exc_info=True)
             raise MessageSendError(f"WBP: Erro inesperado no envio de template: {e}") from e
 
-    async def send_text_message(self, company: models.Company, number: str, text: str) -> Dict[str, Any]:
+    async def _acquire_send_slot(self, company: models.Company, number: str, priority: str) -> None:
+        """
+        Aguarda o limite de envios do número da empresa (throughput e pair rate limit), compartilhado entre processos.
+
+        @param company: Empresa remetente.
+        @param number: Destinatário.
+        @param priority: Classe do envio ('interactive', 'automated' ou 'bulk').
+        """
+        await get_outbound_rate_limiter().acquire(
+            company.wbp_phone_number_id,
+            self._normalize_number(number),
+            priority=priority,
+            messages_per_second=company.wbp_messages_per_second
+        )
+
+    async def send_text_message(self, company: models.Company, number: str, text: str, priority: str = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
         if not company or not number or not text:
              raise ValueError("Company, number, and text are required for sending messages.")
         try:
             if not company.wbp_phone_number_id:
                 raise ValueError(f"Empresa {company.id} configurada, mas 'wbp_phone_number_id' não definido.")
             
+            await self._acquire_send_slot(company, number, priority)
             return await self.send_text_message_official(company.wbp_phone_number_id, settings.WBP_ACCESS_TOKEN, number, text)
 
         except MessageSendError as e:
@@ -584,7 +602,8 @@ class WhatsAppService:
         file_bytes: bytes, 
         filename: str, 
         mimetype: Optional[str] = None,
-        caption: Optional[str] = None
+        caption: Optional[str] = None,
+        priority: str = PRIORITY_INTERACTIVE
     ) -> Dict[str, Any]:
         """
         Função centralizada para enviar MÍDIA.
@@ -631,6 +650,7 @@ class WhatsAppService:
             if not company.wbp_phone_number_id:
                 raise ValueError(f"Empresa {company.id} configurada, mas 'wbp_phone_number_id' não definido.")
             
+            await self._acquire_send_slot(company, number, priority)
             return await self.send_media_message_official(
                 company.wbp_phone_number_id, settings.WBP_ACCESS_TOKEN, number, media_type, 
                 file_bytes, filename, mimetype, caption
@@ -653,7 +673,8 @@ class WhatsAppService:
         language_code: str,
         components: Optional[List[Dict[str, Any]]],
         db: Optional[Any] = None,
-        atendimento_id: Optional[int] = None
+        atendimento_id: Optional[int] = None,
+        priority: str = PRIORITY_INTERACTIVE
     ) -> Dict[str, Any]:
         """Adapter para enviar mensagem de template, tratando a autenticação da empresa."""
         if not all([company, number, template_name, language_code]):
@@ -663,6 +684,7 @@ class WhatsAppService:
             if not company.wbp_phone_number_id:
                 raise ValueError(f"Empresa {company.id} não tem 'wbp_phone_number_id' configurado.")
 
+            await self._acquire_send_slot(company, number, priority)
             result = await self.send_template_message_official(
                 company.wbp_phone_number_id, settings.WBP_ACCESS_TOKEN, number, template_name, language_code, components
             )
@@ -672,15 +694,14 @@ class WhatsAppService:
                 try:
                     from app.crud import crud_user
                     logger.info(f"Deduzindo 50000 tokens de template da empresa {company.id}...")
-                    await crud_user.decrement_company_tokens(
+                    await crud_user.record_token_usage(
                         db=db,
-                        db_company=company,
+                        company_id=company.id,
                         usage=50000,
                         atendimento_id=atendimento_id,
                         token_type="whatsapp_template"
                     )
                     await db.commit()
-                    await db.refresh(company)
                 except Exception as token_err:
                     logger.error(f"Falha ao deduzir tokens de template da empresa {company.id}: {token_err}", exc_info=True)
                     await db.rollback()
@@ -708,14 +729,14 @@ class WhatsAppService:
         logger.info(f"WBP: Buscando templates para a conta {business_account_id}...")
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, headers=headers, params=params, timeout=30.0)
-                response.raise_for_status()
-                response_data = response.json()
-
-                all_templates = response_data.get("data", [])
-                logger.info(f"WBP: Encontrados {len(all_templates)} templates no total (todos os status).")
-                return all_templates
+            client = get_graph_api_client()
+            response = await client.get(url, headers=headers, params=params, timeout=30.0)
+            response.raise_for_status()
+            response_data = response.json()
+
+            all_templates = response_data.get("data", [])
+            logger.info(f"WBP: Encontrados {len(all_templates)} templates no total (todos os status).")
+            return all_templates
         except httpx.HTTPStatusError as e:
             error_body = e.response.text if e.response else "N/A"
             logger.error(f"WBP: Erro HTTP {e.response.status_code} ao buscar templates: {error_body}")
@@ -733,10 +754,10 @@ class WhatsAppService:
         headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=headers, json=payload, timeout=30.0)
-                response.raise_for_status()
-                return response.json()
+            client = get_graph_api_client()
+            response = await client.post(url, headers=headers, json=payload, timeout=30.0)
+            response.raise_for_status()
+            return response.json()
         except httpx.HTTPStatusError as e:
             error_body = e.response.text if e.response else "N/A"
             logger.error(f"WBP: Erro HTTP {e.response.status_code} ao criar template: {error_body}")
@@ -764,10 +785,10 @@ class WhatsAppService:
             params["hsm_id"] = template_id  # Algumas versões da API aceitam hsm_id para maior precisão
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(url, headers=headers, params=params, timeout=30.0)
-                response.raise_for_status()
-                return True
+            client = get_graph_api_client()
+            response = await client.delete(url, headers=headers, params=params, timeout=30.0)
+            response.raise_for_status()
+            return True
         except httpx.HTTPStatusError as e:
             error_body = e.response.text if e.response else "N/A"
             logger.error(f"WBP: Erro HTTP {e.response.status_code} ao excluir template {template_name}: {error_body}")
@@ -784,10 +805,10 @@ class WhatsAppService:
             "access_token": access_token
         }
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, params=params, timeout=10.0)
-                if response.status_code == 200:
-                    return response.json().get("data", {}).get("app_id")
+            client = get_graph_api_client()
+            response = await client.get(url, params=params, timeout=10.0)
+            if response.status_code == 200:
+                return response.json().get("data", {}).get("app_id")
         except Exception as e:
             logger.error(f"Erro ao buscar app_id: {e}")
         return None
@@ -811,33 +832,33 @@ class WhatsAppService:
             "file_type": mimetype
         }
         
-        async with httpx.AsyncClient() as client:
-            session_resp = await client.post(session_url, headers=headers, params=params, timeout=30.0)
-            if session_resp.status_code != 200:
-                logger.error(f"WBP: Erro ao criar sessão de upload. Resposta: {session_resp.text}")
-                raise Exception(f"Falha ao criar sessão de upload na Meta. Verifique as permissões.")
-                
-            upload_id = session_resp.json().get("id")
-            if not upload_id:
-                raise Exception("Upload ID não foi retornado pela Meta.")
+        client = get_graph_api_client()
+        session_resp = await client.post(session_url, headers=headers, params=params, timeout=30.0)
+        if session_resp.status_code != 200:
+            logger.error(f"WBP: Erro ao criar sessão de upload. Resposta: {session_resp.text}")
+            raise Exception(f"Falha ao criar sessão de upload na Meta. Verifique as permissões.")
             
-            # 2. Faz o upload do conteúdo
-            upload_url = f"{self.wbp_graph_url_base}/{self.wbp_api_version}/{upload_id}"
-            headers_upload = {
-                "Authorization": f"OAuth {access_token}",
-                "file_offset": "0"
-            }
-            
-            upload_resp = await client.post(upload_url, headers=headers_upload, content=file_bytes, timeout=60.0)
-            if upload_resp.status_code != 200:
-                logger.error(f"WBP: Erro no upload do arquivo (exemplo). Resposta: {upload_resp.text}")
-                raise Exception(f"Falha ao enviar arquivo de exemplo para a Meta.")
-                
-            handle = upload_resp.json().get("h")
-            if not handle:
-                raise Exception("A API da Meta não retornou um handle válido para o arquivo.")
+        upload_id = session_resp.json().get("id")
+        if not upload_id:
+            raise Exception("Upload ID não foi retornado pela Meta.")
+        
+        # 2. Faz o upload do conteúdo
+        upload_url = f"{self.wbp_graph_url_base}/{self.wbp_api_version}/{upload_id}"
+        headers_upload = {
+            "Authorization": f"OAuth {access_token}",
+            "file_offset": "0"
+        }
+        
+        upload_resp = await client.post(upload_url, headers=headers_upload, content=file_bytes, timeout=60.0)
+        if upload_resp.status_code != 200:
+            logger.error(f"WBP: Erro no upload do arquivo (exemplo). Resposta: {upload_resp.text}")
+            raise Exception(f"Falha ao enviar arquivo de exemplo para a Meta.")
             
-            return handle
+        handle = upload_resp.json().get("h")
+        if not handle:
+            raise Exception("A API da Meta não retornou um handle válido para o arquivo.")
+        
+        return handle
 
     async def get_whatsapp_templates(
         self,
@@ -955,35 +976,35 @@ class WhatsAppService:
             raise ValueError("URL da mídia não encontrada na Meta.")
 
         logger.info(f"Baixando mídia {media_id} diretamente da Meta...")
-        async with httpx.AsyncClient(timeout=60.0, follow_redirects=True) as client:
-            headers = {"Authorization": f"Bearer {decrypted_token}"}
-            media_response = await client.get(media_url, headers=headers)
+        client = get_graph_api_client()
+        headers = {"Authorization": f"Bearer {decrypted_token}"}
+        media_response = await client.get(media_url, headers=headers, timeout=60.0, follow_redirects=True)
 
-            content_type = media_response.headers.get('content-type', '').lower()
-            if media_response.status_code != 200 or 'text/html' in content_type:
-                response_body_text = "[Corpo indisponível]"
-                try:
-                    response_body_text = (await media_response.aread(1024)).decode('utf-8', errors='ignore')
-                except Exception:
-                    pass
-                logger.error(f"Erro ao baixar mídia {media_id}: Meta retornou status {media_response.status_code} / tipo {content_type}. Corpo: {response_body_text}")
-                media_response.raise_for_status()
-                raise ValueError("Falha ao baixar mídia da Meta: Resposta inesperada.")
-
-            media_bytes = media_response.content
-            
-            # Recupera o nome original do arquivo gravado no histórico da conversa
-            filename = "download"
+        content_type = media_response.headers.get('content-type', '').lower()
+        if media_response.status_code != 200 or 'text/html' in content_type:
+            response_body_text = "[Corpo indisponível]"
             try:
-                conversa_list = json.loads(db_atendimento.conversa or "[]")
-                for msg in conversa_list:
-                    if msg.get("media_id") == media_id:
-                        filename = msg.get("filename") or "download"
-                        break
-            except Exception as e:
-                logger.warning(f"Erro ao buscar filename para media {media_id}: {e}")
+                response_body_text = (await media_response.aread(1024)).decode('utf-8', errors='ignore')
+            except Exception:
+                pass
+            logger.error(f"Erro ao baixar mídia {media_id}: Meta retornou status {media_response.status_code} / tipo {content_type}. Corpo: {response_body_text}")
+            media_response.raise_for_status()
+            raise ValueError("Falha ao baixar mídia da Meta: Resposta inesperada.")
+
+        media_bytes = media_response.content
+        
+        # Recupera o nome original do arquivo gravado no histórico da conversa
+        filename = "download"
+        try:
+            conversa_list = json.loads(db_atendimento.conversa or "[]")
+            for msg in conversa_list:
+                if msg.get("media_id") == media_id:
+                    filename = msg.get("filename") or "download"
+                    break
+        except Exception as e:
+            logger.warning(f"Erro ao buscar filename para media {media_id}: {e}")
 
-            return media_bytes, content_type, filename
+        return media_bytes, content_type, filename
 
     async def send_template_message_with_history(
         self,
@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text
+
+from app.db.database import SessionLocal
+from app.services.vector_index_service import apply_vector_search_settings
+
+# Tabelas comparadas: (tabela, coluna de filtro do tenant)
+TABLES = {
+    "contextos": "config_id",
+    "mensagens": "company_id",
+}
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    idx = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[idx]
+
+
+async def _top_k(filter_col: str, table: str, tenant_id: int, embedding: str, k: int, exact: bool, ef_search: int) -> Tuple[List[int], float]:
+    """Executa uma busca top-k em transação própria, forçando varredura exata ou permitindo o índice HNSW."""
+    async with SessionLocal() as db:
+        async with db.begin():
+            if exact:
+                # Sem índice: o planner é obrigado a calcular a distância de todas as linhas do tenant
+                await db.execute(text("SET LOCAL enable_indexscan = off"))
+                await db.execute(text("SET LOCAL enable_bitmapscan = off"))
+            else:
+                await apply_vector_search_settings(db, ef_search=ef_search)
+            started = time.perf_counter()
+            result = await db.execute(
+                text(
+                    f"SELECT id FROM {table} WHERE {filter_col} = :tenant AND embedding IS NOT NULL "
+                    f"ORDER BY embedding <=> CAST(:emb AS vector) LIMIT :k"
+                ),
+                {"tenant": tenant_id, "emb": embedding, "k": k}
+            )
+            ids = [row[0] for row in result.all()]
+            return ids, (time.perf_counter() - started) * 1000
+
+
+async def benchmark_table(table: str, samples: int, k: int, ef_search: int) -> Dict[str, float]:
+    """
+    Compara recall@k e latência da busca HNSW contra a busca exata usando embeddings já armazenados como consultas.
+
+    @param table: 'contextos' ou 'mensagens'.
+    @param samples: Quantidade de consultas sorteadas.
+    @param k: Tamanho do top-k comparado.
+    @param ef_search: ef_search usado nas consultas aproximadas.
+    @returns: Métricas agregadas (recall médio, p50/p95 de cada modo).
+    """
+    filter_col = TABLES[table]
+    async with SessionLocal() as db:
+        result = await db.execute(
+            text(
+                f"SELECT {filter_col}, embedding::text FROM {table} "
+                f"WHERE embedding IS NOT NULL ORDER BY random() LIMIT :n"
+            ),
+            {"n": samples}
+        )
+        queries = result.all()
+        total_rows = (await db.execute(text(f"SELECT count(*) FROM {table}"))).scalar() or 0
+
+    recalls, exact_ms, ann_ms = [], [], []
+    for tenant_id, embedding in queries:
+        exact_ids, t_exact = await _top_k(filter_col, table, tenant_id, embedding, k, exact=True, ef_search=ef_search)
+        ann_ids, t_ann = await _top_k(filter_col, table, tenant_id, embedding, k, exact=False, ef_search=ef_search)
+        if exact_ids:
+            recalls.append(len(set(exact_ids) & set(ann_ids)) / len(exact_ids))
+        exact_ms.append(t_exact)
+        ann_ms.append(t_ann)
+
+    return {
+        "rows": total_rows,
+        "queries": len(queries),
+        "recall": statistics.mean(recalls) if recalls else 0.0,
+        "exact_p50": _percentile(exact_ms, 50),
+        "exact_p95": _percentile(exact_ms, 95),
+        "ann_p50": _percentile(ann_ms, 50),
+        "ann_p95": _percentile(ann_ms, 95),
+    }
+
+
+async def main():
+    """
+    Benchmark de recall e latência dos índices HNSW sobre os dados reais do banco.
+    Uso: python -m app.utils.benchmark_vector_search --samples 50 --k 5 --ef-search 40,100,200
+    """
+    parser = argparse.ArgumentParser(description="Compara busca vetorial HNSW x exata (recall@k e latência).")
+    parser.add_argument("--tables", default="contextos,mensagens")
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--ef-search", default="40,100,200", help="Valores de ef_search separados por vírgula")
+    args = parser.parse_args()
+
+    for table in [t.strip() for t in args.tables.split(",") if t.strip() in TABLES]:
+        for ef in [int(v) for v in args.ef_search.split(",") if v.strip()]:
+            m = await benchmark_table(table, args.samples, args.k, ef)
+            print(
+                f"{table:<10} linhas={m['rows']:<8} consultas={m['queries']:<4} ef_search={ef:<4} "
+                f"recall@{args.k}={m['recall']:.3f} | exata p50={m['exact_p50']:.1f}ms p95={m['exact_p95']:.1f}ms | "
+                f"hnsw p50={m['ann_p50']:.1f}ms p95={m['ann_p95']:.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
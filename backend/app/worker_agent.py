@@ -2,7 +2,11 @@ import asyncio
 import logging
 import random
 import sys
+from app.core.config import settings
 from app.services.agent_processor import run_agent_cycle
+from app.services.outbound_delivery_service import get_outbound_delivery_service
+from app.services.trace_service import stop_trace_sink
+from app.services.graph_api_client import get_graph_api_client, close_graph_api_client
 
 # Configuração básica do logging
 logging.basicConfig(level=logging.INFO,
@@ -35,11 +39,19 @@ async def main():
     Função principal do worker de agente.
     """
     logger.info("--- INICIANDO SERVIÇO DE WORKER (AGENTE IA) ---")
-    await agent_db_poller()
+    get_graph_api_client()
+    try:
+        await agent_db_poller()
+    finally:
+        # Termina as entregas em andamento antes de fechar o cliente HTTP; o restante fica na fila durável
+        await get_outbound_delivery_service().shutdown(settings.OUTBOUND_DELIVERY_DRAIN_SECONDS)
+        await close_graph_api_client()
 
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        logger.info("Worker-Agent: Recebido sinal de parada. Desligando...")
\ No newline at end of file
+        logger.info("Worker-Agent: Recebido sinal de parada. Desligando...")
+    finally:
+        stop_trace_sink()
\ No newline at end of file
@@ -10,6 +10,8 @@ from sqlalchemy import select
 from app.db.database import SessionLocal
 from app.db import models
 from app.services.whatsapp_service import get_whatsapp_service
+from app.services.outbound_rate_limiter import PRIORITY_BULK
+from app.services.graph_api_client import get_graph_api_client, close_graph_api_client
 from app.core.config import settings
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', stream=sys.stdout)
@@ -73,7 +75,8 @@ async def process_bulk_queue():
                     language_code="pt_BR", # Pode ser parametrizado se necessário
                     components=components_to_send,
                     db=db,
-                    atendimento_id=at.id
+                    atendimento_id=at.id,
+                    priority=PRIORITY_BULK
                 )
                 
                 # --- LOG CONVERSA: Salva a mensagem no histórico ---
@@ -166,13 +169,17 @@ async def process_bulk_queue():
 
 async def main():
     logger.info("--- INICIANDO WORKER DE DISPAROS (BULK SENDER) ---")
-    while True:
-        try:
-            await process_bulk_queue()
-            await asyncio.sleep(15) # Verifica a fila a cada 15 segundos
-        except Exception as e:
-            logger.error(f"Worker-Bulk: Erro crítico no loop principal: {e}. Tentando novamente em 15 segundos...", exc_info=True)
-            await asyncio.sleep(15)
+    get_graph_api_client()
+    try:
+        while True:
+            try:
+                await process_bulk_queue()
+                await asyncio.sleep(15) # Verifica a fila a cada 15 segundos
+            except Exception as e:
+                logger.error(f"Worker-Bulk: Erro crítico no loop principal: {e}. Tentando novamente em 15 segundos...", exc_info=True)
+                await asyncio.sleep(15)
+    finally:
+        await close_graph_api_client()
 
 if __name__ == "__main__":
     try:
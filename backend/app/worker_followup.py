@@ -12,6 +12,8 @@ from app.db import models
 from app.crud import crud_user, crud_atendimento
 from app.services.gemini_service import get_gemini_service
 from app.services.whatsapp_service import get_whatsapp_service
+from app.services.outbound_rate_limiter import PRIORITY_AUTOMATED
+from app.services.graph_api_client import get_graph_api_client, close_graph_api_client
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -221,7 +223,7 @@ async def process_atendimento_followup_task(atendimento_id: int, company_id: int
                 message_to_send = message_to_send.replace('\\n', '\n').replace('\\', '')
                 
                 whatsapp_service = get_whatsapp_service()
-                sent_info = await whatsapp_service.send_text_message(company, at.whatsapp, message_to_send)
+                sent_info = await whatsapp_service.send_text_message(company, at.whatsapp, message_to_send, priority=PRIORITY_AUTOMATED)
                 
                 new_message = {
                     "id": sent_info.get('id'), "role": "assistant", "content": message_to_send,
@@ -327,7 +329,11 @@ async def followup_poller():
 
 async def main():
     logger.info("--- INICIANDO SERVIÇO DE WORKER (FOLLOW-UP) ---")
-    await followup_poller()
+    get_graph_api_client()
+    try:
+        await followup_poller()
+    finally:
+        await close_graph_api_client()
 
 if __name__ == "__main__":
     try:
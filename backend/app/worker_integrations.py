@@ -1,12 +1,17 @@
 import asyncio
 import logging
 import sys
+import urllib.parse
+from collections import Counter
 from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
 
-from sqlalchemy import select
+from sqlalchemy import case, delete, or_, select, update, func
+from app.core.config import settings
 from app.db.database import SessionLocal
 from app.db import models
 from app.services.integration_service import IntegrationService
+from app.services.integration_http_client import close_integration_http_client
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,58 +20,353 @@ logging.basicConfig(
 )
 logger = logging.getLogger("worker_integrations")
 
-async def sync_due_integrations():
+
+def host_key(url: str) -> str:
     """
-    Verifica e executa integrações do tipo Polling ativas que estão prontas para sincronização.
+    Chave usada no limite de concorrência por host de destino.
+
+    @param url: URL configurada na integração.
+    @returns: Hostname em minúsculas (vazio se a URL for inválida).
+    """
+    try:
+        return (urllib.parse.urlparse(url or "").hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class IntegrationScheduler:
+    """
+    Agendador das integrações: Polling e lotes de payloads recebidos pelo webhook de entrada.
+
+    - Busca as integrações vencidas pelo índice de next_run_at, com FOR UPDATE SKIP LOCKED: várias
+      réplicas do worker podem rodar ao mesmo tempo sem disputar as mesmas linhas.
+    - Ao reivindicar uma integração, empurra next_run_at e leased_until para agora + lease; se a réplica
+      morrer durante a execução, outra a assume quando o lease expirar. A sincronização manual da API
+      reivindica o mesmo lease (ver IntegrationService.run_manual_sync).
+    - Cada sincronização roda em sua própria tarefa e sessão, respeitando um limite global e um por host
+      (um endpoint lento de um cliente não atrasa os demais).
+    - Ao terminar (com sucesso ou erro), reagenda para agora + sync_interval_minutes.
+    - Payloads enfileirados pelo webhook de entrada são agrupados por integração: cada execução processa
+      de uma vez todos os pushes pendentes daquela integração (até INTEGRATION_WEBHOOK_COALESCE_MAX_JOBS).
+      O mesmo next_run_at serve de lease, garantindo uma única execução por integração entre as réplicas;
+      ao fim do lote, integrações Polling voltam à sua agenda e as de Webhook ficam livres na hora.
+      Lotes com erro voltam à fila com backoff (not_before) até INTEGRATION_WEBHOOK_MAX_ATTEMPTS execuções.
     """
-    async with SessionLocal() as db:
-        try:
-            now = datetime.now(timezone.utc)
-            stmt = select(models.Integration).where(
-                models.Integration.enabled == True,
-                models.Integration.integration_type == "polling"
-            )
-            res = await db.execute(stmt)
-            integrations = res.scalars().all()
 
-            if not integrations:
-                logger.debug("Nenhuma integração Polling ativa cadastrada.")
-                return
+    def __init__(self, max_concurrency: int, per_host_concurrency: int, claim_batch: int, lease_minutes: int):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.per_host_concurrency = max(per_host_concurrency, 1)
+        self.claim_batch = max(claim_batch, 1)
+        self.lease = timedelta(minutes=max(lease_minutes, 1))
+        self.running: Dict[asyncio.Task, Optional[str]] = {}
+        self.hosts: Counter = Counter()
+        self.last_purge_at: Optional[datetime] = None
 
-            tasks_to_run = []
-            for integration in integrations:
-                last_sync = integration.last_sync_at
+    async def claim_due(self) -> List[Tuple[int, str]]:
+        """
+        Reivindica as integrações vencidas que cabem nas vagas livres desta réplica.
+
+        @returns: Lista de (id da integração, host de destino) reivindicados.
+        """
+        free_slots = self.max_concurrency - len(self.running)
+        if free_slots <= 0:
+            return []
+
+        integ = models.Integration
+        claimed: List[Tuple[int, str]] = []
+        async with SessionLocal() as db:
+            async with db.begin():
+                stmt = (
+                    select(integ.id, integ.url)
+                    .where(
+                        integ.enabled == True,
+                        integ.integration_type == "polling",
+                        integ.next_run_at <= func.now(),
+                        or_(integ.leased_until.is_(None), integ.leased_until <= func.now())
+                    )
+                    .order_by(integ.next_run_at)
+                    .limit(self.claim_batch)
+                    .with_for_update(skip_locked=True)
+                )
+                rows = (await db.execute(stmt)).all()
+
+                # Hosts já saturados ficam para o próximo ciclo (ou para outra réplica); o lock é liberado no commit
+                hosts = Counter(self.hosts)
+                for integration_id, url in rows:
+                    if len(claimed) >= free_slots:
+                        break
+                    host = host_key(url)
+                    if hosts[host] >= self.per_host_concurrency:
+                        continue
+                    hosts[host] += 1
+                    claimed.append((integration_id, host))
+
+                if claimed:
+                    await db.execute(
+                        update(integ)
+                        .where(integ.id.in_([integration_id for integration_id, _ in claimed]))
+                        .values(next_run_at=datetime.now(timezone.utc) + self.lease, leased_until=datetime.now(timezone.utc) + self.lease)
+                        .execution_options(synchronize_session=False)
+                    )
+        return claimed
+
+    async def run_one(self, integration_id: int) -> None:
+        """
+        Executa a sincronização de uma integração em sessão própria e a reagenda ao final.
+
+        @param integration_id: ID da integração reivindicada.
+        """
+        interval_minutes = 5
+        try:
+            async with SessionLocal() as db:
+                integration = await db.get(models.Integration, integration_id)
+                if integration is None:
+                    return
                 interval_minutes = integration.sync_interval_minutes or 5
+                try:
+                    logger.info(f"Executando Polling para integração '{integration.name}' (ID: {integration.id})...")
+                    count = await IntegrationService.run_integration_sync(db, integration)
+                    logger.info(f"Sucesso na integração '{integration.name}' (ID: {integration.id})! {count} vetores atualizados.")
+                except Exception as e:
+                    logger.error(f"Erro ao sincronizar integração '{integration.name}' (ID: {integration_id}): {e}", exc_info=True)
+        finally:
+            # Sessão nova: a da execução pode ter ficado em estado inválido após um erro de banco
+            try:
+                async with SessionLocal() as db:
+                    await db.execute(
+                        update(models.Integration)
+                        .where(models.Integration.id == integration_id)
+                        .values(next_run_at=datetime.now(timezone.utc) + timedelta(minutes=interval_minutes), leased_until=None)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Erro ao reagendar a integração (ID: {integration_id}); nova tentativa após o lease: {e}", exc_info=True)
+
+    async def claim_webhook_batches(self) -> List[Tuple[int, List[str]]]:
+        """
+        Reivindica integrações com payloads do webhook na fila, cada uma com seu lote de jobs pendentes.
+
+        @returns: Lista de (id da integração, ids dos jobs em ordem de chegada).
+        """
+        free_slots = self.max_concurrency - len(self.running)
+        if free_slots <= 0:
+            return []
+
+        integ = models.Integration
+        job = models.IntegrationWebhookJob
+        claimed: List[Tuple[int, List[str]]] = []
+        async with SessionLocal() as db:
+            async with db.begin():
+                # Jobs 'processing' de integrações com lease vencido sobraram de uma réplica que morreu
+                # Integrações com jobs em backoff aguardam inteiras, para os pushes serem aplicados em ordem de chegada
+                pending = (
+                    select(job.integration_id)
+                    .where(job.status.in_(["queued", "processing"]))
+                    .group_by(job.integration_id)
+                    .having(func.max(job.not_before) <= func.now())
+                    .order_by(func.min(job.created_at))
+                    .limit(self.claim_batch)
+                )
+                candidates = [row[0] for row in (await db.execute(pending)).all()]
+                if not candidates:
+                    return []
 
-                # Se nunca sincronizou ou se já passou o tempo do intervalo
-                if last_sync is None or (now - last_sync) >= timedelta(minutes=interval_minutes):
-                    tasks_to_run.append(integration)
-
-            if tasks_to_run:
-                logger.info(f"Encontradas {len(tasks_to_run)} integrações prontas para sincronização por Polling.")
-                for integration in tasks_to_run:
-                    try:
-                        logger.info(f"Executando Polling para integração '{integration.name}' (ID: {integration.id})...")
-                        count = await IntegrationService.run_integration_sync(db, integration)
-                        logger.info(f"Sucesso na integração '{integration.name}' (ID: {integration.id})! {count} vetores atualizados.")
-                    except Exception as e:
-                        logger.error(f"Erro ao sincronizar integração '{integration.name}' (ID: {integration.id}): {e}", exc_info=True)
-            else:
-                logger.debug("Nenhuma integração pendente de sincronização neste ciclo.")
+                stmt = (
+                    select(integ.id)
+                    .where(
+                        integ.id.in_(candidates),
+                        integ.next_run_at <= func.now(),
+                        or_(integ.leased_until.is_(None), integ.leased_until <= func.now())
+                    )
+                    .with_for_update(skip_locked=True)
+                )
+                lockable = {row[0] for row in (await db.execute(stmt)).all()}
+                integration_ids = [i for i in candidates if i in lockable][:free_slots]
+                if not integration_ids:
+                    return []
 
+                now = datetime.now(timezone.utc)
+                await db.execute(
+                    update(integ)
+                    .where(integ.id.in_(integration_ids))
+                    .values(next_run_at=now + self.lease, leased_until=now + self.lease)
+                    .execution_options(synchronize_session=False)
+                )
+                for integration_id in integration_ids:
+                    job_ids = [row[0] for row in (await db.execute(
+                        select(job.id)
+                        .where(job.integration_id == integration_id, job.status.in_(["queued", "processing"]))
+                        .order_by(job.created_at)
+                        .limit(max(settings.INTEGRATION_WEBHOOK_COALESCE_MAX_JOBS, 1))
+                    )).all()]
+                    await db.execute(
+                        update(job)
+                        .where(job.id.in_(job_ids))
+                        .values(status="processing", started_at=now)
+                        .execution_options(synchronize_session=False)
+                    )
+                    claimed.append((integration_id, job_ids))
+        return claimed
+
+    async def run_webhook_batch(self, integration_id: int, job_ids: List[str]) -> None:
+        """
+        Processa, numa única execução e em sessão própria, os payloads enfileirados de uma integração.
+
+        @param integration_id: ID da integração reivindicada.
+        @param job_ids: Jobs do lote, em ordem de chegada.
+        """
+        job = models.IntegrationWebhookJob
+        values = {"status": "error", "error": "Integração não encontrada."}
+        retry = False
+        try:
+            async with SessionLocal() as db:
+                integration = await db.get(models.Integration, integration_id)
+                if integration is None:
+                    return
+                if not integration.enabled:
+                    raise ValueError("Integração desativada.")
+                retry = True
+                rows = await db.execute(select(job.payload).where(job.id.in_(job_ids)).order_by(job.created_at))
+                payloads = [row[0] for row in rows.all()]
+                count = await IntegrationService.process_coalesced_payloads(db, integration, payloads)
+                logger.info(f"Webhook da integração '{integration.name}' (ID: {integration_id}): {len(job_ids)} push(es) processado(s), {count} vetores atualizados.")
+            values = {"status": "done", "processed_count": count, "payload": None, "error": None}
         except Exception as e:
-            logger.error(f"Erro no ciclo do worker de integrações: {e}", exc_info=True)
+            logger.error(f"Erro ao processar payloads do Webhook (ID: {integration_id}): {e}", exc_info=True)
+            values = {"status": "error", "error": str(e)}
+        finally:
+            # Sessão nova: a da execução pode ter ficado em estado inválido após um erro de banco
+            try:
+                async with SessionLocal() as db:
+                    now = datetime.now(timezone.utc)
+                    if values["status"] == "error" and retry:
+                        # Falha possivelmente transitória (IA, banco): o lote volta à fila com backoff e só é
+                        # descartado depois de INTEGRATION_WEBHOOK_MAX_ATTEMPTS execuções
+                        exhausted = job.attempts + 1 >= settings.INTEGRATION_WEBHOOK_MAX_ATTEMPTS
+                        job_values = {
+                            "status": case((exhausted, "error"), else_="queued"),
+                            "attempts": job.attempts + 1,
+                            "not_before": now + func.make_interval(
+                                0, 0, 0, 0, 0, 0, settings.INTEGRATION_WEBHOOK_RETRY_SECONDS * func.power(2, job.attempts)
+                            ),
+                            "finished_at": case((exhausted, now), else_=None),
+                            "error": values["error"],
+                        }
+                    else:
+                        job_values = {"finished_at": now, **values}
+                    await db.execute(
+                        update(job).where(job.id.in_(job_ids)).values(**job_values)
+                        .execution_options(synchronize_session=False)
+                    )
+                    # Webhook: libera o lease para o próximo lote. Polling que recebeu push: o lease sobrescreveu
+                    # a agenda, que volta a ser a última sincronização + sync_interval_minutes
+                    integ = models.Integration
+                    integration_values = {"leased_until": None, "next_run_at": case(
+                        (integ.integration_type == "webhook", now),
+                        else_=func.coalesce(integ.last_sync_at, now) + func.make_interval(0, 0, 0, 0, 0, func.coalesce(integ.sync_interval_minutes, 5))
+                    )}
+                    if values["status"] == "error":
+                        integration_values.update(last_status="error", last_error=values.get("error"))
+                    await db.execute(
+                        update(integ).where(integ.id == integration_id).values(**integration_values)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Erro ao finalizar jobs do Webhook (ID: {integration_id}); nova tentativa após o lease: {e}", exc_info=True)
+
+    async def purge_finished_jobs(self) -> None:
+        """Remove, no máximo uma vez por hora, jobs do webhook concluídos há mais de INTEGRATION_WEBHOOK_JOB_RETENTION_HOURS."""
+        now = datetime.now(timezone.utc)
+        if self.last_purge_at and now - self.last_purge_at < timedelta(hours=1):
+            return
+        self.last_purge_at = now
+        job = models.IntegrationWebhookJob
+        async with SessionLocal() as db:
+            result = await db.execute(
+                delete(job).where(
+                    job.status.in_(["done", "error"]),
+                    job.finished_at < now - timedelta(hours=settings.INTEGRATION_WEBHOOK_JOB_RETENTION_HOURS)
+                )
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.info(f"{result.rowcount} job(s) antigo(s) do Webhook removido(s).")
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        host = self.running.pop(task, None)
+        if host is None:
+            return
+        self.hosts[host] -= 1
+        if self.hosts[host] <= 0:
+            del self.hosts[host]
+
+    def _spawn(self, coro, host: Optional[str]) -> None:
+        task = asyncio.create_task(coro)
+        self.running[task] = host
+        if host is not None:
+            self.hosts[host] += 1
+        task.add_done_callback(self._on_done)
+
+    async def tick(self) -> int:
+        """
+        Um ciclo do agendador: reivindica integrações vencidas e lotes do webhook e dispara as execuções sem aguardá-las.
+
+        @returns: Quantidade de execuções iniciadas.
+        """
+        claimed = await self.claim_due()
+        for integration_id, host in claimed:
+            self._spawn(self.run_one(integration_id), host)
+
+        batches = await self.claim_webhook_batches()
+        for integration_id, job_ids in batches:
+            self._spawn(self.run_webhook_batch(integration_id, job_ids), None)
+
+        started = len(claimed) + len(batches)
+        if started:
+            logger.info(
+                f"{len(claimed)} integração(ões) Polling e {len(batches)} lote(s) de Webhook iniciados. "
+                f"Em execução nesta réplica: {len(self.running)}."
+            )
 
-async def main():
-    logger.info("--- INICIANDO WORKER DE INTEGRAÇÕES (POLLING 5 MIN) ---")
-    while True:
         try:
-            await sync_due_integrations()
+            await self.purge_finished_jobs()
         except Exception as e:
-            logger.error(f"Erro crítico no loop principal do worker: {e}", exc_info=True)
-        
-        # Dorme 30 segundos antes de checar a próxima fila de integrações
-        await asyncio.sleep(30)
+            logger.warning(f"Falha ao limpar jobs antigos do Webhook: {e}")
+        return started
+
+    async def shutdown(self) -> None:
+        """Cancela as execuções em andamento (as integrações voltam a ser elegíveis quando o lease expirar)."""
+        tasks = list(self.running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main():
+    logger.info(
+        f"--- INICIANDO WORKER DE INTEGRAÇÕES (POLLING E WEBHOOK, até {settings.INTEGRATION_SYNC_MAX_CONCURRENCY} simultâneas, "
+        f"{settings.INTEGRATION_SYNC_PER_HOST_CONCURRENCY} por host) ---"
+    )
+    scheduler = IntegrationScheduler(
+        max_concurrency=settings.INTEGRATION_SYNC_MAX_CONCURRENCY,
+        per_host_concurrency=settings.INTEGRATION_SYNC_PER_HOST_CONCURRENCY,
+        claim_batch=settings.INTEGRATION_SYNC_CLAIM_BATCH,
+        lease_minutes=settings.INTEGRATION_SYNC_LEASE_MINUTES
+    )
+    try:
+        while True:
+            try:
+                await scheduler.tick()
+            except Exception as e:
+                logger.error(f"Erro crítico no loop principal do worker: {e}", exc_info=True)
+
+            # Aguarda antes de checar a próxima leva de integrações vencidas
+            await asyncio.sleep(settings.INTEGRATION_SCHEDULER_POLL_SECONDS)
+    finally:
+        await scheduler.shutdown()
+        await close_integration_http_client()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import sys
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import delete, exists, func, select, update
+from sqlalchemy.orm import aliased
+from app.core.config import settings
+from app.db.database import SessionLocal
+from app.db import models
+from app.services.config_service import ConfigService
+from app.services.google_drive_service import get_drive_service
+from app.services.sync_job_service import FINISHED_STATUSES, SyncJobProgressReporter, get_last_synced_revision
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stdout
+)
+logger = logging.getLogger("worker_sync")
+
+
+class SyncJobRunner:
+    """
+    Executor dos jobs de sincronização de Planilhas (system/rag) e Drive enfileirados pela API e pelo webhook do Drive.
+
+    - Reivindica jobs da fila com FOR UPDATE SKIP LOCKED; um job só é reivindicado se não houver outro em
+      execução para a mesma config e tipo (o índice único parcial garante isso também entre réplicas).
+    - A cada ciclo grava o heartbeat dos jobs em andamento e lê cancel_requested; jobs com pedido de
+      cancelamento têm a tarefa interrompida.
+    - Jobs 'running' sem heartbeat há SYNC_JOB_STALE_MINUTES sobraram de uma réplica que morreu e são
+      encerrados com erro, liberando a config para o próximo job da fila.
+    - Jobs adiados pelo debounce das notificações só são reivindicados a partir de run_after.
+    - Planilhas: a versão do arquivo no Drive é lida antes da sincronização; jobs vindos de notificação
+      cuja versão é igual à da última sincronização concluída terminam sem reprocessar nada.
+    """
+
+    def __init__(self, max_concurrency: int, stale_minutes: int):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.stale = timedelta(minutes=max(stale_minutes, 1))
+        self.running: Dict[asyncio.Task, int] = {}
+        self.cancelling: Set[int] = set()
+        self.last_purge_at: Optional[datetime] = None
+
+    async def expire_stale_jobs(self) -> None:
+        """Encerra com erro os jobs em execução cujo worker parou de enviar heartbeat."""
+        job = models.SyncJob
+        now = datetime.now(timezone.utc)
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(job)
+                .where(job.status == "running", job.heartbeat_at < now - self.stale)
+                .values(status="error", error="Execução interrompida (worker sem resposta).", finished_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.warning(f"{result.rowcount} job(s) de sincronização sem heartbeat encerrado(s) com erro.")
+
+    async def claim_queued(self) -> List[int]:
+        """
+        Reivindica os jobs da fila que cabem nas vagas livres desta réplica.
+
+        @returns: IDs dos jobs marcados como 'running'.
+        """
+        free_slots = self.max_concurrency - len(self.running)
+        if free_slots <= 0:
+            return []
+
+        job = models.SyncJob
+        active = aliased(models.SyncJob)
+        async with SessionLocal() as db:
+            async with db.begin():
+                stmt = (
+                    select(job.id)
+                    .where(
+                        job.status == "queued",
+                        job.run_after <= func.now(),
+                        ~exists().where(
+                            active.config_id == job.config_id,
+                            active.kind == job.kind,
+                            active.status == "running"
+                        )
+                    )
+                    .order_by(job.created_at)
+                    .limit(free_slots)
+                    .with_for_update(skip_locked=True)
+                )
+                job_ids = [row[0] for row in (await db.execute(stmt)).all()]
+                if job_ids:
+                    now = datetime.now(timezone.utc)
+                    await db.execute(
+                        update(job)
+                        .where(job.id.in_(job_ids))
+                        .values(status="running", started_at=now, heartbeat_at=now)
+                        .execution_options(synchronize_session=False)
+                    )
+        return job_ids
+
+    async def check_sheet_revision(self, sync_job: models.SyncJob) -> bool:
+        """
+        Registra no job a versão atual da planilha e indica se a sincronização pode ser pulada.
+
+        @param sync_job: Job de planilha ('system' ou 'rag') em execução.
+        @returns: True se o job veio de notificação e a planilha não mudou desde a última sincronização concluída.
+        """
+        try:
+            revision = await get_drive_service().get_file_revision(sync_job.resource_id)
+        except Exception as e:
+            logger.warning(f"Sync job {sync_job.id}: Não foi possível ler a versão da planilha; sincronizando mesmo assim: {e}")
+            return False
+        if not revision:
+            return False
+
+        async with SessionLocal() as db:
+            last_revision = await get_last_synced_revision(db, sync_job.config_id, sync_job.kind, sync_job.resource_id)
+            await db.execute(
+                update(models.SyncJob)
+                .where(models.SyncJob.id == sync_job.id)
+                .values(source_revision=revision)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        return sync_job.trigger == "webhook" and revision == last_revision
+
+    async def run_one(self, job_id: int) -> None:
+        """
+        Executa a sincronização de um job e grava o resultado (done, error ou cancelled).
+
+        @param job_id: ID do job reivindicado.
+        """
+        values: Dict[str, object] = {"status": "error", "error": "Job não encontrado."}
+        try:
+            async with SessionLocal() as db:
+                sync_job = await db.get(models.SyncJob, job_id)
+            if sync_job is None:
+                return
+
+            reporter = SyncJobProgressReporter(job_id)
+            logger.info(f"Executando sync job {job_id} (Config: {sync_job.config_id}, Tipo: {sync_job.kind}, Origem: {sync_job.trigger}).")
+            if sync_job.kind != "drive" and await self.check_sheet_revision(sync_job):
+                logger.info(f"Sync job {job_id}: Planilha sem alterações desde a última sincronização. Nada a fazer.")
+                values = {"status": "done", "report": {"skipped": 1}, "error": None}
+                return
+
+            if sync_job.kind == "drive":
+                report = await ConfigService.run_sync_drive(
+                    sync_job.config_id, sync_job.company_id, sync_job.resource_id,
+                    force_full=sync_job.force_full, on_progress=reporter
+                )
+            else:
+                report = await ConfigService.run_sync_sheet(
+                    sync_job.config_id, sync_job.company_id, sync_job.resource_id, sync_job.kind, on_progress=reporter
+                )
+
+            # Pedidos manuais renovam o watch do arquivo/pasta (as notificações dependem dele)
+            if sync_job.trigger == "manual":
+                await ConfigService.setup_drive_watch(sync_job.config_id, sync_job.resource_id, sync_job.kind)
+            values = {"status": "done", "report": report, "error": None}
+        except asyncio.CancelledError:
+            if job_id in self.cancelling:
+                logger.info(f"Sync job {job_id} cancelado a pedido do usuário.")
+                values = {"status": "cancelled", "error": None}
+            else:
+                values = {"status": "error", "error": "Worker encerrado durante a execução."}
+                raise
+        except Exception as e:
+            logger.error(f"Erro no sync job {job_id}: {e}", exc_info=True)
+            values = {"status": "error", "error": str(e)}
+        finally:
+            self.cancelling.discard(job_id)
+            # Sessão nova: a da sincronização pode ter ficado em estado inválido após um erro de banco
+            try:
+                async with SessionLocal() as db:
+                    await db.execute(
+                        update(models.SyncJob)
+                        .where(models.SyncJob.id == job_id)
+                        .values(finished_at=datetime.now(timezone.utc), **values)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Erro ao finalizar o sync job {job_id}; ele será encerrado pelo heartbeat: {e}", exc_info=True)
+
+    async def heartbeat(self) -> None:
+        """Renova o heartbeat dos jobs desta réplica e interrompe os que tiveram cancelamento pedido."""
+        if not self.running:
+            return
+        job = models.SyncJob
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(job)
+                .where(job.id.in_(list(self.running.values())), job.status == "running")
+                .values(heartbeat_at=datetime.now(timezone.utc))
+                .returning(job.id, job.cancel_requested)
+                .execution_options(synchronize_session=False)
+            )
+            to_cancel = {job_id for job_id, cancel_requested in result.all() if cancel_requested}
+            await db.commit()
+
+        for task, job_id in self.running.items():
+            if job_id in to_cancel and job_id not in self.cancelling:
+                self.cancelling.add(job_id)
+                task.cancel()
+
+    async def purge_finished_jobs(self) -> None:
+        """Remove, no máximo uma vez por hora, jobs concluídos há mais de SYNC_JOB_RETENTION_DAYS."""
+        now = datetime.now(timezone.utc)
+        if self.last_purge_at and now - self.last_purge_at < timedelta(hours=1):
+            return
+        self.last_purge_at = now
+        job = models.SyncJob
+        async with SessionLocal() as db:
+            result = await db.execute(
+                delete(job).where(
+                    job.status.in_(FINISHED_STATUSES),
+                    job.finished_at < now - timedelta(days=settings.SYNC_JOB_RETENTION_DAYS)
+                )
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.info(f"{result.rowcount} job(s) de sincronização antigo(s) removido(s).")
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        self.running.pop(task, None)
+
+    async def tick(self) -> int:
+        """
+        Um ciclo do executor: heartbeat/cancelamentos, limpeza de jobs órfãos e reivindicação da fila.
+
+        @returns: Quantidade de jobs iniciados.
+        """
+        await self.heartbeat()
+        await self.expire_stale_jobs()
+
+        job_ids = await self.claim_queued()
+        for job_id in job_ids:
+            task = asyncio.create_task(self.run_one(job_id))
+            self.running[task] = job_id
+            task.add_done_callback(self._on_done)
+        if job_ids:
+            logger.info(f"{len(job_ids)} sync job(s) iniciado(s). Em execução nesta réplica: {len(self.running)}.")
+
+        try:
+            await self.purge_finished_jobs()
+        except Exception as e:
+            logger.warning(f"Falha ao limpar jobs de sincronização antigos: {e}")
+        return len(job_ids)
+
+    async def shutdown(self) -> None:
+        """Interrompe as execuções em andamento (os jobs são encerrados com erro)."""
+        tasks = list(self.running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main():
+    logger.info(f"--- INICIANDO WORKER DE SINCRONIZAÇÃO (PLANILHAS E DRIVE, até {settings.SYNC_JOB_MAX_CONCURRENCY} simultâneas) ---")
+    runner = SyncJobRunner(
+        max_concurrency=settings.SYNC_JOB_MAX_CONCURRENCY,
+        stale_minutes=settings.SYNC_JOB_STALE_MINUTES
+    )
+    try:
+        while True:
+            try:
+                await runner.tick()
+            except Exception as e:
+                logger.error(f"Erro crítico no loop principal do worker: {e}", exc_info=True)
+
+            await asyncio.sleep(settings.SYNC_JOB_POLL_SECONDS)
+    finally:
+        await runner.shutdown()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Worker de Sincronização encerrado pelo usuário.")
@@ -14,6 +14,7 @@ logging.basicConfig(level=logging.INFO,
 from app.core.config import settings
 # Importa as funções de processamento que contêm a lógica de negócio
 from app.services.webhook_processor import process_official_message_task, process_official_status_task
+from app.services.graph_api_client import get_graph_api_client, close_graph_api_client
 logger = logging.getLogger(__name__)
 
 async def process_message(body: bytes) -> bool:
@@ -73,7 +74,7 @@ async def process_message(body: bytes) -> bool:
         logger.error(f"Erro ao processar a mensagem: {e}", exc_info=True)
         return False # Indica falha no processamento
 
-async def main() -> None:
+async def consume_queue() -> None:
     # aio_pika gerencia a reconexão automaticamente com `connect_robust`
     connection = await aio_pika.connect_robust(settings.RABBITMQ_URL)
     logger.info("Conexão com RabbitMQ estabelecida.")
@@ -105,6 +106,13 @@ async def main() -> None:
                     else:
                         logger.warning(" [!] Message processing failed, message rejected.")
 
+async def main() -> None:
+    get_graph_api_client()
+    try:
+        await consume_queue()
+    finally:
+        await close_graph_api_client()
+
 if __name__ == '__main__':
     try:
         asyncio.run(main())
@@ -1186,6 +1186,17 @@ function Configs() {
         }
     };
 
+    // --- Jobs de sincronização (executados pelo worker) ---
+    const waitForSyncJob = async (jobId) => {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 2000));
+            const { data: job } = await api.get(`/configs/sync_jobs/${jobId}`);
+            if (job.status === 'done') return job;
+            if (job.status === 'cancelled') throw new Error('Sincronização cancelada.');
+            if (job.status === 'error') throw new Error(job.error || 'Falha na sincronização.');
+        }
+    };
+
     // --- Sync Sheets (Genérico) ---
     const handleSyncSheet = async (type) => {
         if (!selectedConfig) return toast.error("Salve a configuração antes de sincronizar.");
@@ -1197,18 +1208,17 @@ function Configs() {
         setError('');
         try {
             const payload = { config_id: selectedConfig.id, spreadsheet_id: targetId, type: type };
-            const response = await api.post('/configs/sync_sheet', payload, {
-                timeout: 7200000 // 120 minutos para comportar grandes volumes
-            });
+            const response = await api.post('/configs/sync_sheet', payload);
+            const job = await waitForSyncJob(response.data.job_id);
 
             if (type === 'system') {
                 // Atualiza o form data localmente para garantir integridade ao salvar depois
                 setFormData(prev => ({ ...prev, contexto_json: null }));
             }
 
-            toast.success(`Sucesso! ${response.data.sheets_found} bases sincronizadas (${type.toUpperCase()}).`);
+            toast.success(`Sucesso! ${job.report?.items || 0} bases sincronizadas (${type.toUpperCase()}).`);
         } catch (err) {
-            setError(err.response?.data?.detail || 'Falha ao sincronizar. Verifique se compartilhou a planilha com o e-mail do robô.');
+            setError(err.response?.data?.detail || err.message || 'Falha ao sincronizar. Verifique se compartilhou a planilha com o e-mail do robô.');
         } finally {
             setIsSyncing(false);
         }
@@ -1223,18 +1233,17 @@ function Configs() {
         setError('');
         try {
             const payload = { config_id: selectedConfig.id, drive_id: driveFolderId };
-            const response = await api.post('/configs/sync_drive', payload, {
-                timeout: 7200000 // 120 minutos para comportar grandes volumes de arquivos
-            });
+            const response = await api.post('/configs/sync_drive', payload);
+            const job = await waitForSyncJob(response.data.job_id);
 
-            const filesCount = response.data.files_found || 0;
+            const filesCount = job.report?.items || 0;
 
             // Atualiza o form data localmente
             setFormData(prev => ({ ...prev, arquivos_drive_json: null }));
 
             toast.success(`Sincronização concluída! ${filesCount} dados atualizados.`);
         } catch (err) {
-            setError(err.response?.data?.detail || 'Falha ao sincronizar Drive. Verifique o ID e o compartilhamento.');
+            setError(err.response?.data?.detail || err.message || 'Falha ao sincronizar Drive. Verifique o ID e o compartilhamento.');
         } finally {
             setIsSyncing(false);
         }